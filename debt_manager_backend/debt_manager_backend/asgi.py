@@ -13,4 +13,9 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'debt_manager_backend.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# imported once apps are loaded
+from debt_manager_backend_api.streams import EventStreamRouter  # noqa: E402
+
+application = EventStreamRouter(django_application)
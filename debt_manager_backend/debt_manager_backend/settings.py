@@ -12,7 +12,7 @@ https://docs.djangoproject.com/en/3.0/ref/settings/
 import datetime
 import os
 import sys
-from corsheaders.defaults import default_methods
+from corsheaders.defaults import default_headers, default_methods
 import json
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
@@ -42,6 +42,16 @@ if TESTING_RUN:
 if not os.path.exists(os.path.join(BASE_DIR, LOG_DIR)):
     os.makedirs(os.path.join(BASE_DIR, LOG_DIR))
 
+# staff request profiling captures
+PROFILE_DIR = os.path.join(BASE_DIR, LOG_DIR, 'profiles')
+PROFILE_MAX_CONCURRENT = 2
+PROFILE_MAX_CAPTURES = 100
+
+# slow query detector, durations in seconds
+SLOW_QUERY_THRESHOLD = float(os.environ.get('SLOW_QUERY_THRESHOLD', 0.2))
+SLOW_QUERY_REPEAT_THRESHOLD = 10
+SLOW_QUERY_EXPLAIN_LIMIT = 3
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -54,23 +64,35 @@ LOGGING = {
             'format': '{levelname} {message}',
             'style': '{',
         },
+        'json': {
+            '()': 'debt_manager_backend_api.log.JSONFormatter',
+        },
     },
     'handlers': {
+        # one file per worker process, a rotating file can not be shared between processes
         'file': {
             'level': 'DEBUG',
-            'class': 'logging.FileHandler',
-            'filename': os.path.join(BASE_DIR, LOG_DIR, f"{format_time}.log"),
-            'formatter': 'verbose',
+            'class': 'logging.handlers.RotatingFileHandler',
+            'filename': os.path.join(BASE_DIR, LOG_DIR, f"{format_time}-{os.getpid()}.log"),
+            'maxBytes': 10 * 1024 * 1024,
+            'backupCount': 5,
+            'formatter': 'json',
         },
         'console': {
             'level': 'DEBUG',
             'class': 'logging.StreamHandler',
             'formatter': 'verbose',
         },
+        # file and console are written from a listener thread, request threads only enqueue records
+        'queue': {
+            'class': 'debt_manager_backend_api.log.QueueListenerHandler',
+            'handlers': ['cfg://handlers.file', 'cfg://handlers.console'],
+            'queue_size': 10000,
+        },
     },
     'loggers': {
         'django': {
-            'handlers': ['file', 'console'],
+            'handlers': ['queue'],
             'level': 'INFO',
             'propagate': True,
         },
@@ -103,6 +125,10 @@ ADMINS = [
 ]
 
 MIDDLEWARE = [
+    'debt_manager_backend_api.log.RequestIdMiddleware',
+    'debt_manager_backend_api.instrumentation.MetricsMiddleware',
+    'debt_manager_backend_api.db.routers.ReplicaStickinessMiddleware',
+    'debt_manager_backend_api.slow_queries.SlowQueryMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -135,20 +161,113 @@ WSGI_APPLICATION = 'debt_manager_backend.wsgi.application'
 CORS_ORIGIN_REGEX_WHITELIST = json.loads(os.environ.get('CORS_ORIGIN_REGEX_WHITELIST'))
 CORS_ALLOW_CREDENTIALS = True
 CORS_ALLOW_METHODS = list(default_methods)
+CORS_ALLOW_HEADERS = [*default_headers, 'idempotency-key']
+CORS_EXPOSE_HEADERS = ['Idempotent-Replayed']
+# rendered owner scoped GET responses kept per process, keyed by the owner data version; 0 disables
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', 0))
+# seconds page counts and balances are cached, the cache key changes with the owner data version anyway
+PAGE_AGGREGATE_CACHE_TIMEOUT = 300
+# concurrent identical reads wait for the first one, coordinated through a cache shared by the worker processes
+CACHE_DIR = os.environ.get('CACHE_DIR', os.path.join(BASE_DIR, 'cache'))
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'coalesce': {
+        'BACKEND': 'debt_manager_backend_api.cache_backends.FileBasedCache',
+        'LOCATION': os.path.join(CACHE_DIR, 'coalesce'),
+    },
+}
+SINGLE_FLIGHT_CACHE = 'coalesce'
+# seconds a caller waits for the first one before computing itself
+SINGLE_FLIGHT_WAIT = float(os.environ.get('SINGLE_FLIGHT_WAIT', 30))
+# seconds a lock of a crashed worker blocks the key
+SINGLE_FLIGHT_LOCK_TIMEOUT = 60
+# seconds results stay for late waiters, keys change with the owner data version
+SINGLE_FLIGHT_RESULT_TTL = 5
+SINGLE_FLIGHT_POLL_INTERVAL = 0.05
+# generated debtor reports kept on local disk, least recently used are removed above the size; 0 disables
+REPORT_CACHE_DIR = os.path.join(CACHE_DIR, 'reports')
+REPORT_CACHE_MAX_BYTES = int(os.environ.get('REPORT_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+# x-accel: stored reports are sent by nginx from the shared volume, behind the internal location of nginx.conf
+# with the same secret; django: streamed by the worker, for development
+REPORT_DELIVERY = os.environ.get('REPORT_DELIVERY', 'django')
+REPORT_ACCEL_LOCATION = '/protected/reports/'
+REPORT_ACCEL_SECRET = os.environ.get('REPORT_ACCEL_SECRET')
+# seconds a signed internal report uri is valid
+REPORT_ACCEL_TTL = 60
+# server-sent events of ledger changes, served by asgi.py; LocalBackend reaches streams of the writing process
+# only, PostgresNotifyBackend streams of every process
+EVENT_BACKEND = os.environ.get('EVENT_BACKEND', 'debt_manager_backend_api.events.LocalBackend')
+EVENT_STREAM_PATH = '/api/v1/events/'
+# seconds between keepalive comments of idle streams
+EVENT_STREAM_KEEPALIVE = 15
+# milliseconds browsers wait before reconnecting
+EVENT_STREAM_RETRY = 3000
+# events buffered per stream, slower clients are disconnected and resync
+EVENT_QUEUE_SIZE = 100
+# seconds before a failed event listener reconnects
+EVENT_LISTEN_RETRY = 5
+# sub-requests of one /api/v1/batch/ request, and threads per process running batched reads; 1 runs them inline
+BATCH_MAX_REQUESTS = 20
+BATCH_MAX_WORKERS = int(os.environ.get('BATCH_MAX_WORKERS', 4))
+# debtors changed by one /api/v1/debtor/bulk/ request
+DEBTOR_BULK_MAX_IDS = 1000
+# admin change lists show planner row estimates instead of COUNT(*) from this many rows,
+# admin actions change at most ADMIN_ACTION_MAX_ROWS rows at once
+ESTIMATED_COUNT_THRESHOLD = 10000
+ADMIN_ACTION_MAX_ROWS = 10000
+# responses of mutating requests with an Idempotency-Key header are replayed for retries this long
+IDEMPOTENCY_KEY_TTL = datetime.timedelta(hours=24)
 # Database
 # https://docs.djangoproject.com/en/3.0/ref/settings/#databases
 
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.postgresql',
+        'ENGINE': 'debt_manager_backend_api.db.backends.postgresql_pool',
         'NAME': os.environ.get('POSTGRES_DB'),
         'USER': os.environ.get('POSTGRES_USER'),
         'PASSWORD': os.environ.get('POSTGRES_PASSWORD'),
         'HOST': 'db',
         'PORT': 5432,
+        # connections are returned to the per process pool when django closes them after a request,
+        # see debt_manager_backend_api.db.backends.postgresql_pool
+        'CONN_MAX_AGE': 0,
+        'POOL': {
+            'MIN_SIZE': int(os.environ.get('DB_POOL_MIN_SIZE', 0)),
+            'MAX_SIZE': int(os.environ.get('DB_POOL_MAX_SIZE', 10)),
+            'TIMEOUT': float(os.environ.get('DB_POOL_TIMEOUT', 10)),
+            'MAX_IDLE': float(os.environ.get('DB_POOL_MAX_IDLE', 300)),
+            'CHECK_AFTER': float(os.environ.get('DB_POOL_CHECK_AFTER', 30)),
+        },
     }
 }
 
+# read replicas: json list of connection settings over the default ones, e.g. [{"HOST": "db-replica"}]
+for i, replica in enumerate(json.loads(os.environ.get('DATABASE_REPLICAS', '[]'))):
+    DATABASES[f'replica{i}'] = {**DATABASES['default'], **replica, 'TEST': {'MIRROR': 'default'}}
+REPLICA_DATABASES = [alias for alias in DATABASES if alias.startswith('replica')]
+# owner data shards: json object of alias to connection settings over the default ones, with optional
+# read replicas over the shard ones, e.g. {"shard1": {"HOST": "db-shard1", "REPLICAS": [{"HOST": "db-shard1-r"}]}};
+# the default database is always the first shard
+DATABASE_SHARDS = json.loads(os.environ.get('DATABASE_SHARDS', '{}'))
+SHARD_REPLICAS = {}
+for alias, shard in DATABASE_SHARDS.items():
+    replicas = shard.pop('REPLICAS', [])
+    DATABASES[alias] = {**DATABASES['default'], **shard}
+    SHARD_REPLICAS[alias] = [f'{alias}_replica{i}' for i in range(len(replicas))]
+    for replica_alias, replica in zip(SHARD_REPLICAS[alias], replicas):
+        DATABASES[replica_alias] = {**DATABASES[alias], **replica, 'TEST': {'MIRROR': alias}}
+SHARD_DATABASES = ['default', *DATABASE_SHARDS]
+# ids of debtors and transactions created on shard n start at n * SHARD_ID_BLOCK
+SHARD_ID_BLOCK = 10 ** 8
+DATABASE_ROUTERS = [
+    'debt_manager_backend_api.db.sharding.ShardRouter',
+    'debt_manager_backend_api.db.routers.ReplicaRouter',
+]
+# reads of a client stay on the primary for this long after its write, should exceed the replication lag
+REPLICA_STICKY_SECONDS = 10
+
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
 
@@ -197,6 +316,17 @@ REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': (
         'rest_framework.permissions.IsAuthenticated',
     ),
+    'DEFAULT_RENDERER_CLASSES': [
+        'debt_manager_backend_api.renderers.FastJSONRenderer',
+        'debt_manager_backend_api.renderers.MessagePackRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'debt_manager_backend_api.parsers.FastJSONParser',
+        'debt_manager_backend_api.parsers.MessagePackParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 100
 }
@@ -206,8 +336,14 @@ OAUTH2_PROVIDER = {
     'SCOPES': {'read': 'Read scope', 'write': 'Write scope', 'groups': 'Access to your groups'}
 }
 
+# precomputed OpenAPI schema, regenerated with generate_schema command when CODE_VERSION changes
+CODE_VERSION = os.environ.get('CODE_VERSION')
+SCHEMA_ROOT = os.path.join(BASE_DIR, 'schema')
+SCHEMA_CACHE_MAX_AGE = 60 * 60 * 24 * 365
+
 SWAGGER_SETTINGS = {
    'USE_SESSION_AUTH': False,
+   'SPEC_URL': 'schema-json',
    'SECURITY_DEFINITIONS': {
       'Your App API - Swagger': {
          'type': 'oauth2',
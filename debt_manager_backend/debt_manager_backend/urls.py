@@ -16,16 +16,12 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 from drf_yasg.views import get_schema_view
-from drf_yasg import openapi
 from rest_framework import permissions
+from debt_manager_backend_api.swagger import api_info, schema_json
+from debt_manager_backend_api.instrumentation import metrics_view
 
 schema_view = get_schema_view(
-    openapi.Info(
-        title="Debt manager API",
-        default_version='v1',
-        contact=openapi.Contact(email="klasd4000@gmail.com"),
-        license=openapi.License(name="BSD License"),
-    ),
+    api_info,
     public=True,
     permission_classes=(permissions.AllowAny,),
 )
@@ -33,5 +29,8 @@ schema_view = get_schema_view(
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include('debt_manager_backend_api.urls')),
+    path('metrics', metrics_view, name='metrics'),
     path('swagger/', schema_view.with_ui('swagger', cache_timeout=0), name='schema-swagger-ui'),
+    path('swagger/openapi.json', schema_json, name='schema-json'),
+    path('swagger/openapi-<str:version>.json', schema_json, name='schema-json-versioned'),
 ]
@@ -1,3 +1,273 @@
-from django.contrib import admin
+from django.conf import settings
+from django.contrib import admin, messages
+from django.contrib.admin.utils import get_fields_from_path
+from django.contrib.auth.admin import UserAdmin
+from django.contrib.auth.forms import UserChangeForm, UserCreationForm
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import Q
+from django.utils.functional import cached_property
+from .bulk import delete_debtors, delete_transactions
+from .db.estimates import estimated_count
+from .db.sharding import fan_out, fan_out_first, get_owner_shard, lock_owner_writes, use_shard
+from .events import record_change_event
+from .journal import journaled_write
+from .models import SlowQueryRecord, Debtor, Transaction, OwnerShard, Currency, CurrencyOwner, UniqEmailUser
 
-# Register your models here.
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Counts large change lists by the planner estimate instead of COUNT(*), the last page may be off
+    """
+
+    @cached_property
+    def count(self):
+        return estimated_count(self.object_list)
+
+
+class ShardFilter(admin.SimpleListFilter):
+    """
+    Show one shard at a time, the choices carry the (estimated) row count of every shard
+    """
+    title = 'shard'
+    parameter_name = 'shard'
+
+    def lookups(self, request, model_admin):
+        return [(alias, f'{alias} ({estimated_count(queryset)})')
+                for alias, queryset in fan_out(model_admin.model.objects.all())]
+
+    def choices(self, changelist):
+        value = self.value() or DEFAULT_DB_ALIAS
+        for lookup, title in self.lookup_choices:
+            yield {
+                'selected': value == lookup,
+                'query_string': changelist.get_query_string({self.parameter_name: lookup}),
+                'display': title,
+            }
+
+    def queryset(self, request, queryset):
+        shard = self.value()
+        return queryset.using(shard if shard in settings.SHARD_DATABASES else DEFAULT_DB_ALIAS)
+
+
+class LargeTableMixin:
+    """
+    Admin of tables too large to scan: estimated counts, search_fields matched exactly so searches use
+    their indexes, no per object delete_selected action.
+    """
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_actions(self, request):
+        actions = super().get_actions(request)
+        actions.pop('delete_selected', None)
+        return actions
+
+    def get_search_results(self, request, queryset, search_term):
+        search_term = search_term.strip()
+        if not search_term or not self.search_fields:
+            return queryset, False
+        query = Q()
+        for name in self.search_fields:
+            try:
+                value = get_fields_from_path(self.model, name)[-1].to_python(search_term)
+            except ValidationError:
+                # not a valid value of the field, e.g. text for an id
+                continue
+            query |= Q(**{name: value})
+        return queryset.filter(query) if query else queryset.none(), False
+
+    def get_action_rows(self, request, queryset, *fields):
+        """
+        values_list() rows of the queryset, None with an error message above ADMIN_ACTION_MAX_ROWS rows
+        """
+        rows = list(queryset.order_by().values_list(*fields)[:settings.ADMIN_ACTION_MAX_ROWS + 1])
+        if len(rows) > settings.ADMIN_ACTION_MAX_ROWS:
+            self.message_user(request, f'At most {settings.ADMIN_ACTION_MAX_ROWS} rows can be changed at once.',
+                              messages.ERROR)
+            return None
+        return rows
+
+
+class ShardedModelAdmin(LargeTableMixin, admin.ModelAdmin):
+    """
+    Admin of owner data: the change list shows the shard picked in the shard filter,
+    objects are looked up on every shard and saved back to their shard
+    """
+
+    def get_list_filter(self, request):
+        return [ShardFilter, *super().get_list_filter(request)]
+
+    def get_object(self, request, object_id, from_field=None):
+        queryset = self.get_queryset(request)
+        model = queryset.model
+        field = model._meta.pk if from_field is None else model._meta.get_field(from_field)
+        try:
+            object_id = field.to_python(object_id)
+        except (ValidationError, ValueError):
+            return None
+        return fan_out_first(queryset.filter(**{field.name: object_id}))
+
+
+class LedgerModelAdmin(ShardedModelAdmin):
+    """
+    Admin of debtors and transactions: saves are journaled and published like API writes, deletes are
+    the soft deletes of the bulk actions. The owner and is_active of a row are not changed here.
+    """
+    owner_field = None
+
+    def get_owner_id(self, obj):
+        raise NotImplementedError
+
+    def get_readonly_fields(self, request, obj=None):
+        readonly_fields = [*super().get_readonly_fields(request, obj), 'is_active']
+        return readonly_fields if obj is None else [*readonly_fields, self.owner_field]
+
+    def save_model(self, request, obj, form, change):
+        owner_id = self.get_owner_id(obj)
+        with use_shard(get_owner_shard(owner_id)), journaled_write(self.model, [owner_id]):
+            super().save_model(request, obj, form, change)
+            record_change_event(owner_id, obj, 'updated' if change else 'created')
+
+
+@admin.register(Debtor)
+class DebtorAdmin(LedgerModelAdmin):
+    list_display = ['id', 'name', 'owner_id', 'is_active', 'updated_at']
+    list_filter = ['is_active']
+    raw_id_fields = ['owner']
+    search_fields = ['id', 'owner', 'name']
+    actions = ['delete_selected_debtors']
+    owner_field = 'owner'
+
+    def get_owner_id(self, obj):
+        return obj.owner_id
+
+    def delete_model(self, request, obj):
+        # transactions reference their debtor without a cascade, both are kept inactive
+        if obj.is_active:
+            with use_shard(obj._state.db), journaled_write(Debtor, [obj.owner_id]):
+                delete_debtors(obj.owner_id, [obj.pk])
+
+    def delete_selected_debtors(self, request, queryset):
+        with use_shard(queryset.db), journaled_write(Debtor):
+            rows = self.get_action_rows(request, queryset.filter(is_active=True), 'owner_id', 'id')
+            if rows is None:
+                return
+            lock_owner_writes(queryset.db, {owner_id for owner_id, debtor_id in rows})
+            by_owner = {}
+            for owner_id, debtor_id in rows:
+                by_owner.setdefault(owner_id, []).append(debtor_id)
+            for owner_id, ids in by_owner.items():
+                delete_debtors(owner_id, ids)
+        self.message_user(request, f'{len(rows)} debtors deleted with their transactions.')
+    delete_selected_debtors.short_description = 'Delete selected debtors with their transactions'
+
+
+@admin.register(Transaction)
+class TransactionAdmin(LedgerModelAdmin):
+    list_display = ['id', 'debtor_id', 'debtor_name', 'date', 'sum', 'is_active']
+    # relative date ranges, a date_hierarchy would scan the whole table for the years on every page
+    list_filter = ['is_active', 'date']
+    list_select_related = ['debtor']
+    raw_id_fields = ['debtor']
+    search_fields = ['id', 'debtor']
+    actions = ['delete_selected_transactions']
+    owner_field = 'debtor'
+
+    def debtor_name(self, obj):
+        return obj.debtor.name
+
+    def get_owner_id(self, obj):
+        return obj.debtor.owner_id
+
+    def delete_model(self, request, obj):
+        if obj.is_active:
+            with use_shard(obj._state.db), journaled_write(Transaction, [obj.debtor.owner_id]):
+                delete_transactions([(obj.debtor.owner_id, obj.debtor_id, obj.pk)])
+
+    def delete_selected_transactions(self, request, queryset):
+        with use_shard(queryset.db), journaled_write(Transaction):
+            rows = self.get_action_rows(request, queryset.filter(is_active=True),
+                                        'debtor__owner_id', 'debtor_id', 'id')
+            if rows is None:
+                return
+            lock_owner_writes(queryset.db, {row[0] for row in rows})
+            delete_transactions(rows)
+        self.message_user(request, f'{len(rows)} transactions deleted.')
+    delete_selected_transactions.short_description = 'Delete selected transactions'
+
+
+@admin.register(Currency)
+class CurrencyAdmin(LargeTableMixin, admin.ModelAdmin):
+    list_display = ['id', 'name', 'is_active']
+    list_filter = ['is_active']
+    search_fields = ['id', 'name']
+    actions = ['activate_selected', 'deactivate_selected']
+
+    def activate_selected(self, request, queryset):
+        self.message_user(request, f'{queryset.update(is_active=True)} currencies activated.')
+    activate_selected.short_description = 'Activate selected currencies'
+
+    def deactivate_selected(self, request, queryset):
+        self.message_user(request, f'{queryset.update(is_active=False)} currencies deactivated.')
+    deactivate_selected.short_description = 'Deactivate selected currencies'
+
+
+@admin.register(CurrencyOwner)
+class CurrencyOwnerAdmin(LargeTableMixin, admin.ModelAdmin):
+    list_display = ['id', 'owner', 'currency', 'current']
+    list_filter = ['current']
+    list_select_related = ['owner', 'currency']
+    raw_id_fields = ['owner', 'currency']
+    search_fields = ['owner', 'currency']
+
+
+class UniqEmailUserCreationForm(UserCreationForm):
+    class Meta(UserCreationForm.Meta):
+        model = UniqEmailUser
+
+
+class UniqEmailUserChangeForm(UserChangeForm):
+    class Meta(UserChangeForm.Meta):
+        model = UniqEmailUser
+
+
+@admin.register(UniqEmailUser)
+class UniqEmailUserAdmin(LargeTableMixin, UserAdmin):
+    form = UniqEmailUserChangeForm
+    add_form = UniqEmailUserCreationForm
+    list_display = ['id', 'username', 'email', 'is_active', 'is_staff', 'date_joined']
+    search_fields = ['id', 'username', 'email']
+    ordering = ['-id']
+    actions = ['deactivate_selected']
+
+    def deactivate_selected(self, request, queryset):
+        self.message_user(request, f'{queryset.update(is_active=False)} users deactivated.')
+    deactivate_selected.short_description = 'Deactivate selected users'
+
+
+@admin.register(OwnerShard)
+class OwnerShardAdmin(admin.ModelAdmin):
+    list_display = ['owner', 'shard', 'moving']
+    list_filter = ['shard', 'moving']
+    list_select_related = ['owner']
+    raw_id_fields = ['owner']
+    readonly_fields = ['shard', 'moving']
+
+    def has_add_permission(self, request):
+        # owners are placed on registration and moved with the move_owner_shard command
+        return False
+
+
+@admin.register(SlowQueryRecord)
+class SlowQueryRecordAdmin(admin.ModelAdmin):
+    list_display = ['kind', 'route', 'sql', 'max_duration', 'max_repeat', 'occurrences', 'last_seen']
+    list_filter = ['kind', 'route']
+    search_fields = ['sql']
+    ordering = ['-last_seen']
+    readonly_fields = ['fingerprint', 'kind', 'route', 'sql', 'explain', 'max_duration', 'max_repeat',
+                       'occurrences', 'first_seen', 'last_seen']
+
+    def has_add_permission(self, request):
+        return False
@@ -1,5 +1,10 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class DebtManagerBackendApiConfig(AppConfig):
     name = 'debt_manager_backend_api'
+
+    def ready(self):
+        from .db.sharding import reserve_shard_id_range
+        post_migrate.connect(reserve_shard_id_range, sender=self)
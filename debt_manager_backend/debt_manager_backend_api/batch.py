@@ -0,0 +1,127 @@
+import contextvars
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from urllib.parse import urlsplit
+from django.conf import settings
+from django.core.handlers.wsgi import WSGIRequest
+from django.db import connections
+from django.urls import Resolver404, resolve
+from rest_framework import status
+from rest_framework.views import APIView
+from .db.routers import SAFE_METHODS
+
+lh = logging.getLogger('django')
+
+# environment of the batch request kept for sub-requests, the client is the same
+INHERITED_META = ['HTTP_HOST', 'HTTP_USER_AGENT', 'HTTP_ACCEPT_LANGUAGE', 'HTTP_X_FORWARDED_FOR',
+                  'HTTP_X_FORWARDED_PROTO', 'HTTP_X_REQUEST_ID', 'REMOTE_ADDR', 'SCRIPT_NAME', 'SERVER_NAME',
+                  'SERVER_PORT', 'SERVER_PROTOCOL']
+# sub-requests run as the user of the batch request
+IGNORED_HEADERS = {'authorization', 'cookie', 'content-type', 'content-length'}
+
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    Thread pool shared by all batch requests of the process, BATCH_MAX_WORKERS threads
+    """
+    with _executor_lock:
+        if not hasattr(get_executor, 'executor'):
+            get_executor.executor = ThreadPoolExecutor(settings.BATCH_MAX_WORKERS, thread_name_prefix='batch')
+    return get_executor.executor
+
+
+def build_request(request, method, path, headers, body):
+    """
+    Django request for a sub-request, authenticated as the batch request without checking credentials again
+    """
+    url = urlsplit(path)
+    content = b'' if body is None else json.dumps(body).encode()
+    meta = {name: request.META[name] for name in INHERITED_META if name in request.META}
+    meta.update({f'HTTP_{name.upper().replace("-", "_")}': value for name, value in headers.items()
+                 if name.lower() not in IGNORED_HEADERS})
+    meta.update({
+        'REQUEST_METHOD': method,
+        'PATH_INFO': url.path,
+        'QUERY_STRING': url.query,
+        'CONTENT_TYPE': 'application/json',
+        'CONTENT_LENGTH': str(len(content)),
+        'HTTP_ACCEPT': 'application/json',
+        'wsgi.input': BytesIO(content),
+        'wsgi.url_scheme': request.scheme,
+    })
+    sub_request = WSGIRequest(meta)
+    # rest_framework.request.Request uses ForcedAuthentication for these
+    sub_request._force_auth_user = request.user
+    sub_request._force_auth_token = request.auth
+    return sub_request
+
+
+def get_body(response):
+    if hasattr(response, 'data'):
+        return response.data
+    # rendered bodies kept by ConditionalGetMixin
+    if not response.streaming and response.get('Content-Type', '').startswith('application/json'):
+        return json.loads(response.content)
+    return None
+
+
+def run_request(request, sub_request, exclude_view):
+    """
+    Run the API view of a sub-request and return its status, headers and body
+    """
+    try:
+        match = resolve(sub_request.path_info)
+    except Resolver404:
+        match = None
+    view_class = getattr(match.func, 'cls', None) if match else None
+    if view_class is None or not issubclass(view_class, APIView) or issubclass(view_class, exclude_view):
+        return {'status': status.HTTP_404_NOT_FOUND, 'headers': {}, 'body': {'detail': 'Not found.'}}
+    try:
+        response = match.func(sub_request, *match.args, **match.kwargs)
+    except Exception:
+        lh.exception(f'batch sub-request failed: {sub_request.method} {sub_request.get_full_path()}')
+        return {'status': status.HTTP_500_INTERNAL_SERVER_ERROR, 'headers': {},
+                'body': {'detail': 'A server error occurred.'}}
+    return {'status': response.status_code, 'headers': dict(response.items()), 'body': get_body(response)}
+
+
+def run_in_worker(context, request, sub_request, exclude_view):
+    try:
+        return context.run(run_request, request, sub_request, exclude_view)
+    finally:
+        # connections are per thread, pooled ones go back to the pool
+        connections.close_all()
+
+
+def run_batch(request, sub_requests, exclude_view):
+    """
+    Run sub-requests given as (method, path, headers, body) in order and return their responses.
+    Consecutive reads run in parallel on the shared thread pool, writes one by one in the request thread,
+    so a read sees the writes before it. With BATCH_MAX_WORKERS=1 everything runs in the request thread.
+    """
+    responses = []
+    reads = []
+
+    def run_reads():
+        if settings.BATCH_MAX_WORKERS == 1 or len(reads) == 1:
+            responses.extend(run_request(request, sub_request, exclude_view) for sub_request in reads)
+        else:
+            futures = [get_executor().submit(run_in_worker, contextvars.copy_context(), request, sub_request,
+                                             exclude_view) for sub_request in reads]
+            responses.extend(future.result() for future in futures)
+        reads.clear()
+
+    for method, path, headers, body in sub_requests:
+        sub_request = build_request(request, method, path, headers, body)
+        if method in SAFE_METHODS:
+            reads.append(sub_request)
+            continue
+        run_reads()
+        responses.append(run_request(request, sub_request, exclude_view))
+    run_reads()
+    return responses
@@ -0,0 +1,72 @@
+from django.db.models import Case, CharField, Value, When
+from django.utils import timezone
+from rest_framework import exceptions
+from .events import publish_bulk_change
+from .journal import record_changes
+from .models import Debtor, Transaction
+from .permissions import DebtorPermission
+
+
+def lock_owner_debtors(owner_id, ids):
+    """
+    Lock the debtors for the rest of the transaction, all of them must be active debtors of the owner
+    """
+    found = set(Debtor.objects.select_for_update().filter(id__in=ids, owner=owner_id, is_active=True)
+                .values_list('id', flat=True))
+    if found != set(ids):
+        raise exceptions.PermissionDenied(DebtorPermission.message)
+
+
+def merge_debtors(owner_id, ids, target):
+    """
+    Move the transactions of the debtors to the target debtor in one update and delete the debtors
+    """
+    lock_owner_debtors(owner_id, [*ids, target])
+    now = timezone.now()
+    moved = list(Transaction.objects.filter(debtor__in=ids, is_active=True).values_list('id', flat=True))
+    Transaction.objects.filter(debtor__in=ids).update(debtor=target, updated_at=now)
+    Debtor.objects.filter(id__in=ids).update(is_active=False, updated_at=now)
+    # the target is journaled for its balance
+    record_changes(owner_id, Debtor, [*ids, target])
+    record_changes(owner_id, Transaction, moved)
+    publish_bulk_change(owner_id, Debtor, 'merged', ids, debtor=target)
+
+
+def rename_debtors(owner_id, names):
+    """
+    Rename debtors given as id to name in one update
+    """
+    lock_owner_debtors(owner_id, list(names))
+    Debtor.objects.filter(id__in=names).update(
+        name=Case(*[When(id=debtor_id, then=Value(name)) for debtor_id, name in names.items()],
+                  output_field=CharField()),
+        updated_at=timezone.now())
+    record_changes(owner_id, Debtor, list(names))
+    publish_bulk_change(owner_id, Debtor, 'renamed', list(names))
+
+
+def delete_debtors(owner_id, ids):
+    """
+    Delete the debtors with their transactions, like DebtorViewSet.perform_destroy for each of them
+    """
+    lock_owner_debtors(owner_id, ids)
+    now = timezone.now()
+    Debtor.objects.filter(id__in=ids).update(is_active=False, updated_at=now)
+    Transaction.objects.filter(debtor__in=ids).update(is_active=False, updated_at=now)
+    record_changes(owner_id, Debtor, ids)
+    publish_bulk_change(owner_id, Debtor, 'deleted', ids)
+
+
+def delete_transactions(rows):
+    """
+    Delete transactions given as (owner id, debtor id, id) in one update, journaled per owner
+    """
+    Transaction.objects.filter(id__in=[row[2] for row in rows]).update(is_active=False, updated_at=timezone.now())
+    by_owner, by_debtor = {}, {}
+    for owner_id, debtor_id, transaction_id in rows:
+        by_owner.setdefault(owner_id, []).append(transaction_id)
+        by_debtor.setdefault((owner_id, debtor_id), []).append(transaction_id)
+    for owner_id, ids in by_owner.items():
+        record_changes(owner_id, Transaction, ids)
+    for (owner_id, debtor_id), ids in by_debtor.items():
+        publish_bulk_change(owner_id, Transaction, 'deleted', ids, debtor=debtor_id)
@@ -0,0 +1,30 @@
+import os
+import tempfile
+from django.core.cache.backends import filebased
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+
+
+class FileBasedCache(filebased.FileBasedCache):
+    """
+    FileBasedCache with add() atomic across processes, so it can hold locks shared by the workers of a host
+    """
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self._createdir()
+        fname = self._key_to_file(key, version)
+        fd, tmp_path = tempfile.mkstemp(dir=self._dir)
+        try:
+            with open(fd, 'wb') as f:
+                self._write_content(f, timeout, value)
+            # link fails if the file exists, unlike the check and rename of the base class
+            for _ in range(2):
+                try:
+                    os.link(tmp_path, fname)
+                    return True
+                except FileExistsError:
+                    # has_key removes an expired file, then the second attempt succeeds
+                    if self.has_key(key, version):
+                        return False
+            return False
+        finally:
+            os.remove(tmp_path)
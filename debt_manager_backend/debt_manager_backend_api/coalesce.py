@@ -0,0 +1,75 @@
+import functools
+import hashlib
+import logging
+import time
+import uuid
+from collections import namedtuple
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.response import Response
+
+lh = logging.getLogger('django')
+
+MISSING = object()
+# DRF responses are not picklable before rendering
+StoredResponse = namedtuple('StoredResponse', ['data', 'status'])
+
+
+def get_flight_cache():
+    return caches[settings.SINGLE_FLIGHT_CACHE]
+
+
+def run_single_flight(key, compute):
+    """
+    Run compute() once for concurrent callers with the same key, in any process sharing the cache.
+    The first caller takes a lock and stores the result for SINGLE_FLIGHT_RESULT_TTL seconds, the others wait
+    for it; if the lock holder fails the lock is released and the next waiter takes it. A caller waiting longer
+    than SINGLE_FLIGHT_WAIT seconds computes itself.
+    Keys must change with the data the result depends on, e.g. contain the owner data version.
+    """
+    cache = get_flight_cache()
+    key = hashlib.sha1(key.encode()).hexdigest()
+    result_key, lock_key = f'single-flight:result:{key}', f'single-flight:lock:{key}'
+    deadline = time.monotonic() + settings.SINGLE_FLIGHT_WAIT
+    while True:
+        result = cache.get(result_key, MISSING)
+        if result is not MISSING:
+            return result
+        token = uuid.uuid4().hex
+        if cache.add(lock_key, token, settings.SINGLE_FLIGHT_LOCK_TIMEOUT):
+            try:
+                result = compute()
+                cache.set(result_key, result, settings.SINGLE_FLIGHT_RESULT_TTL)
+                return result
+            finally:
+                if cache.get(lock_key) == token:
+                    cache.delete(lock_key)
+        if time.monotonic() >= deadline:
+            lh.warning(f'single flight wait timed out for {key}')
+            return compute()
+        time.sleep(settings.SINGLE_FLIGHT_POLL_INTERVAL)
+
+
+def single_flight(get_key):
+    """
+    Decorator coalescing concurrent calls with the same get_key(*args, **kwargs) key, None disables it for the call.
+    Results must be picklable, DRF responses are stored as data and status.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = get_key(*args, **kwargs)
+            if key is None:
+                return func(*args, **kwargs)
+
+            def compute():
+                result = func(*args, **kwargs)
+                if isinstance(result, Response):
+                    return StoredResponse(result.data, result.status_code)
+                return result
+            result = run_single_flight(f'{func.__module__}.{func.__qualname__}:{key}', compute)
+            if isinstance(result, StoredResponse):
+                return Response(result.data, status=result.status)
+            return result
+        return wrapper
+    return decorator
@@ -0,0 +1,114 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags
+from rest_framework import status
+from rest_framework.response import Response
+from .journal import get_owner_version
+from .models import CurrencyOwner
+from .swagger import get_code_version
+
+
+class ResponseCache:
+    """
+    In-process LRU of rendered response bodies bounded by RESPONSE_CACHE_MAX_BYTES, disabled when it is 0
+    """
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return settings.RESPONSE_CACHE_MAX_BYTES > 0
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, content, content_type):
+        max_bytes = settings.RESPONSE_CACHE_MAX_BYTES
+        # a single large body should not flush the cache
+        if len(content) > max_bytes // 8:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[0])
+            self.entries[key] = (content, content_type)
+            self.size += len(content)
+            while self.size > max_bytes:
+                _, (evicted, _) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+response_cache = ResponseCache()
+
+
+def get_current_currency(owner_id):
+    """
+    Name of the current currency of the owner, None when it is not configured
+    """
+    return CurrencyOwner.objects.filter(owner=owner_id, current=True).values_list('currency__name', flat=True).first()
+
+
+class ConditionalGetMixin:
+    """
+    Strong ETag for owner scoped GET actions from the owner data version, which changes with every ledger write,
+    and the owner state not journaled (get_etag_state). If-None-Match is answered with 304 before the action runs,
+    rendered bodies are kept in response_cache keyed by the ETag, that is by owner, version, state, url and
+    media type.
+    """
+    etag_actions = {'list', 'retrieve'}
+
+    def get_etag_state(self, request):
+        """
+        Owner data in the response that is not journaled: the current currency of the list envelopes
+        """
+        return get_current_currency(request.user.id) if self.action == 'list' else None
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if request.method not in ('GET', 'HEAD') or self.action not in self.etag_actions \
+                or not request.user.is_authenticated:
+            return
+        # also key cached page aggregates and coalesced list responses
+        self.data_version = version = get_owner_version(request.user.id)
+        self.data_state = state = self.get_etag_state(request)
+        key = f'{get_code_version()} {request.user.id} {version} {state!r} ' \
+              f'{request.get_full_path()} {request.accepted_media_type}'
+        etag = f'"{hashlib.sha1(key.encode()).hexdigest()}"'
+        method = request.method.lower()
+        handler = getattr(self, method)
+
+        def conditional_handler(request, *args, **kwargs):
+            if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+            if if_none_match and etag in parse_etags(if_none_match):
+                response = Response(status=status.HTTP_304_NOT_MODIFIED)
+            else:
+                cached = response_cache.get(etag) if response_cache.enabled else None
+                if cached is not None:
+                    response = HttpResponse(cached[0], content_type=cached[1])
+                else:
+                    response = handler(request, *args, **kwargs)
+                    if response_cache.enabled and response.status_code == status.HTTP_200_OK:
+                        response.add_post_render_callback(
+                            lambda r: response_cache.set(etag, r.content, r['Content-Type']))
+            response['ETag'] = etag
+            # clients revalidate every time, the version may change with any write
+            patch_cache_control(response, private=True, no_cache=True)
+            return response
+        # dispatch looks the handler up after initial
+        setattr(self, method, conditional_handler)
@@ -0,0 +1,78 @@
+import atexit
+import psycopg2.extensions
+from django.db.backends.postgresql import base, creation
+from django.utils.asyncio import async_unsafe
+from ...pool import ConnectionPool, close_pools, get_pool
+
+atexit.register(close_pools)
+
+BROKEN_STATUSES = (psycopg2.extensions.TRANSACTION_STATUS_INERROR, psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN)
+
+
+def check_connection(connection):
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT 1')
+    # the check must not leave a transaction open when autocommit is off
+    if connection.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+        connection.rollback()
+    return True
+
+
+class DatabaseCreation(creation.DatabaseCreation):
+
+    def _destroy_test_db(self, test_database_name, verbosity):
+        # idle pooled connections to the test database would block DROP DATABASE
+        close_pools()
+        super()._destroy_test_db(test_database_name, verbosity)
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """
+    PostgreSQL backend taking connections from a per process pool, configured with the POOL database setting:
+    MIN_SIZE, MAX_SIZE, TIMEOUT (seconds to wait for a free connection), MAX_IDLE (seconds before an idle connection
+    above MIN_SIZE is closed) and CHECK_AFTER (idle seconds after which a connection is checked on checkout).
+    Closing the connection, e.g. at the end of a request, returns it to the pool.
+    """
+    creation_class = DatabaseCreation
+
+    def get_pool(self, conn_params):
+        config = self.settings_dict.get('POOL', {})
+        key = (self.alias, tuple(sorted((k, str(v)) for k, v in conn_params.items())))
+
+        def factory():
+            return ConnectionPool(
+                self.alias,
+                connect=lambda: base.DatabaseWrapper.get_new_connection(self, conn_params),
+                check=check_connection,
+                min_size=config.get('MIN_SIZE', 0),
+                max_size=config.get('MAX_SIZE', 10),
+                timeout=config.get('TIMEOUT', 10.0),
+                max_idle=config.get('MAX_IDLE', 300.0),
+                check_after=config.get('CHECK_AFTER', 30.0),
+            )
+        return get_pool(key, factory)
+
+    @async_unsafe
+    def get_new_connection(self, conn_params):
+        self._pool = self.get_pool(conn_params)
+        connection = self._pool.getconn()
+        # set by the base class for new connections only
+        options = self.settings_dict['OPTIONS']
+        self.isolation_level = options.get('isolation_level', connection.isolation_level)
+        return connection
+
+    @async_unsafe
+    def _close(self):
+        pool = getattr(self, '_pool', None)
+        if pool is None:
+            return super()._close()
+        connection = self.connection
+        # a connection closed inside atomic stays referenced by this wrapper until the next connect
+        discard = connection.closed or self.in_atomic_block \
+            or connection.get_transaction_status() in BROKEN_STATUSES
+        if not discard and connection.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                connection.rollback()
+            except psycopg2.Error:
+                discard = True
+        pool.putconn(connection, discard=discard)
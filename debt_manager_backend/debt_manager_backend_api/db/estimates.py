@@ -0,0 +1,31 @@
+import json
+from django.conf import settings
+from django.db import connections
+
+
+def get_row_estimate(queryset):
+    """
+    Planner estimate of the queryset row count on PostgreSQL, None on other databases
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+    sql, params = queryset.query.get_compiler(using=queryset.db).as_sql()
+    with connection.cursor() as cursor:
+        cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+        plan = cursor.fetchone()[0]
+    # psycopg2 decodes json columns
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def estimated_count(queryset):
+    """
+    Row count of the queryset, the planner estimate from ESTIMATED_COUNT_THRESHOLD rows on,
+    smaller results are counted exactly
+    """
+    estimate = get_row_estimate(queryset)
+    if estimate is None or estimate < settings.ESTIMATED_COUNT_THRESHOLD:
+        return queryset.count()
+    return estimate
@@ -0,0 +1,176 @@
+import os
+import threading
+import time
+from collections import deque
+from ..instrumentation import DB_POOL_EVENTS, DB_POOL_WAIT
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    """
+    Thread safe pool of DB-API connections.
+    Up to max_size connections are open, getconn() waits up to timeout seconds for a free one.
+    Connections idle longer than max_idle are closed above min_size, connections idle longer than
+    check_after are checked with check() before they are handed out.
+    """
+
+    def __init__(self, name, connect, check, min_size=0, max_size=10, timeout=10.0, max_idle=300.0,
+                 check_after=30.0):
+        self.name = name
+        self.connect = connect
+        self.check = check
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.check_after = check_after
+        self._lock = threading.Condition()
+        self._reset()
+
+    def _reset(self):
+        # (connection, returned at)
+        self._idle = deque()
+        self._size = 0
+        self._pid = os.getpid()
+        self._closed = False
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def idle(self):
+        return len(self._idle)
+
+    def getconn(self):
+        start = time.monotonic()
+        deadline = start + self.timeout
+        with self._lock:
+            if self._pid != os.getpid():
+                # connections inherited from the parent process belong to it
+                self._reset()
+            while True:
+                conn, idle_for = self._take_idle()
+                if conn is not None:
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    DB_POOL_EVENTS.labels(self.name, 'timeout').inc()
+                    raise PoolTimeout(f'no free connection in pool {self.name} after {self.timeout}s')
+                self._lock.wait(remaining)
+        DB_POOL_WAIT.labels(self.name).observe(time.monotonic() - start)
+        if conn is None:
+            conn = self._open()
+        elif not self._healthy(conn, idle_for):
+            DB_POOL_EVENTS.labels(self.name, 'unhealthy').inc()
+            self._discard(conn)
+            return self.getconn()
+        return conn
+
+    def putconn(self, conn, discard=False):
+        if self._pid != os.getpid():
+            return
+        if discard or self._closed:
+            self._discard(conn)
+            return
+        with self._lock:
+            self._idle.append((conn, time.monotonic()))
+            self._lock.notify()
+
+    def fill(self):
+        """
+        Open connections up to min_size
+        """
+        while True:
+            with self._lock:
+                if self._size >= self.min_size:
+                    return
+                self._size += 1
+            self.putconn(self._open())
+
+    def close(self):
+        """
+        Close idle connections, connections in use are closed when they are returned
+        """
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, deque()
+            self._size -= len(idle)
+        for conn, _ in idle:
+            self._close(conn)
+
+    def _take_idle(self):
+        """
+        Most recently used idle connection and its idle time, expired ones are closed;
+        called with the lock held
+        """
+        now = time.monotonic()
+        # the oldest connections are at the left end and expire first
+        while self._idle and self._size > self.min_size and now - self._idle[0][1] > self.max_idle:
+            conn, _ = self._idle.popleft()
+            self._size -= 1
+            DB_POOL_EVENTS.labels(self.name, 'recycled').inc()
+            self._close(conn)
+        if not self._idle:
+            return None, 0
+        conn, returned_at = self._idle.pop()
+        return conn, now - returned_at
+
+    def _healthy(self, conn, idle_for):
+        if idle_for < self.check_after:
+            return True
+        try:
+            return self.check(conn)
+        except Exception:
+            return False
+
+    def _open(self):
+        try:
+            conn = self.connect()
+        except Exception:
+            with self._lock:
+                self._size -= 1
+                self._lock.notify()
+            raise
+        DB_POOL_EVENTS.labels(self.name, 'created').inc()
+        return conn
+
+    def _discard(self, conn):
+        with self._lock:
+            self._size -= 1
+            self._lock.notify()
+        self._close(conn)
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(key, factory):
+    """
+    Pool registered under key, created with factory() on first use
+    """
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = factory()
+        return _pools[key]
+
+
+def close_pools():
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
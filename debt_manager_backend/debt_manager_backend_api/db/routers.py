@@ -0,0 +1,109 @@
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+STICKY_COOKIE = 'primary_until'
+
+pinned_to_primary = ContextVar('pinned_to_primary', default=False)
+
+
+@contextmanager
+def use_primary():
+    """
+    Route reads inside the block to the primary database
+    """
+    token = pinned_to_primary.set(True)
+    try:
+        yield
+    finally:
+        pinned_to_primary.reset(token)
+
+
+def get_replicas(primary):
+    """
+    Read replicas of a primary database, REPLICA_DATABASES for the default database and SHARD_REPLICAS for shards
+    """
+    if primary == DEFAULT_DB_ALIAS:
+        return settings.REPLICA_DATABASES
+    return settings.SHARD_REPLICAS.get(primary, [])
+
+
+def get_primary(alias):
+    """
+    Primary database of a replica, other databases are their own primary
+    """
+    if alias in settings.REPLICA_DATABASES:
+        return DEFAULT_DB_ALIAS
+    for primary, replicas in settings.SHARD_REPLICAS.items():
+        if alias in replicas:
+            return primary
+    return alias
+
+
+def route_read(primary, **hints):
+    """
+    Database for a read of data kept on the primary: a random replica of it, or the primary itself
+    inside transaction.atomic and while pinned
+    """
+    replicas = get_replicas(primary)
+    instance = hints.get('instance')
+    if instance is not None and instance._state.db in [primary, *replicas]:
+        return instance._state.db
+    if not replicas or pinned_to_primary.get() or connections[primary].in_atomic_block:
+        return primary
+    return random.choice(replicas)
+
+
+class ReplicaRouter:
+    """
+    Send reads to a random one of REPLICA_DATABASES, writes to the primary.
+    Reads stay on the primary inside transaction.atomic and while pinned by use_primary
+    or ReplicaStickinessMiddleware. Owner data is routed by ShardRouter to the replicas of its shard.
+    """
+
+    def db_for_read(self, model, **hints):
+        return route_read(DEFAULT_DB_ALIAS, **hints)
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return get_primary(db) == db
+
+
+class ReplicaStickinessMiddleware:
+    """
+    Read your own writes: unsafe requests and requests within REPLICA_STICKY_SECONDS after a successful
+    unsafe request of the same client (tracked by a cookie) read from the primary
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        unsafe = request.method not in SAFE_METHODS
+        try:
+            sticky = float(request.COOKIES.get(STICKY_COOKIE, 0)) > time.time()
+        except ValueError:
+            sticky = False
+        token = pinned_to_primary.set(unsafe or sticky)
+        try:
+            response = self.get_response(request)
+        finally:
+            pinned_to_primary.reset(token)
+        if unsafe and response.status_code < 400 \
+                and (settings.REPLICA_DATABASES or any(settings.SHARD_REPLICAS.values())):
+            # the front is served from another origin, cross site cookies need SameSite=None over https
+            secure = request.is_secure()
+            response.set_cookie(STICKY_COOKIE, str(time.time() + settings.REPLICA_STICKY_SECONDS),
+                                max_age=settings.REPLICA_STICKY_SECONDS, httponly=True, secure=secure,
+                                samesite='None' if secure else 'Lax')
+        return response
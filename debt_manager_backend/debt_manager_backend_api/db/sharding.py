@@ -0,0 +1,196 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from .routers import get_primary, route_read
+
+APP_LABEL = 'debt_manager_backend_api'
+# owner data, everything else lives in the default database
+SHARDED_MODELS = {'debtor', 'transaction', 'changejournal'}
+
+current_shard = ContextVar('current_shard', default=None)
+
+
+def is_sharded(model):
+    return model._meta.app_label == APP_LABEL and model._meta.model_name in SHARDED_MODELS
+
+
+@contextmanager
+def use_shard(alias):
+    """
+    Route owner data queries inside the block to the shard
+    """
+    token = current_shard.set(alias)
+    try:
+        yield
+    finally:
+        current_shard.reset(token)
+
+
+def get_owner_mapping(owner_id):
+    """
+    OwnerShard row of the owner, None when there is only the default database or the owner is not mapped
+    """
+    if len(settings.SHARD_DATABASES) == 1:
+        return None
+    from ..models import OwnerShard
+    return OwnerShard.objects.using(DEFAULT_DB_ALIAS).filter(owner_id=owner_id).first()
+
+
+def get_owner_shard(owner_id):
+    mapping = get_owner_mapping(owner_id)
+    return mapping.shard if mapping is not None else DEFAULT_DB_ALIAS
+
+
+def assign_owner_shard(owner_id):
+    """
+    Place a new owner on a shard, owners not assigned stay in the default database
+    """
+    if len(settings.SHARD_DATABASES) == 1:
+        return DEFAULT_DB_ALIAS
+    from ..models import OwnerShard
+    shard = settings.SHARD_DATABASES[owner_id % len(settings.SHARD_DATABASES)]
+    OwnerShard.objects.using(DEFAULT_DB_ALIAS).update_or_create(owner_id=owner_id, defaults={'shard': shard})
+    return shard
+
+
+def fan_out(queryset):
+    """
+    Yield (shard, queryset on that shard) for every shard
+    """
+    for alias in settings.SHARD_DATABASES:
+        yield alias, queryset.using(alias)
+
+
+def fan_out_count(queryset):
+    return {alias: shard_queryset.count() for alias, shard_queryset in fan_out(queryset)}
+
+
+def fan_out_first(queryset):
+    """
+    First object of the queryset on any shard, ids do not overlap between shards
+    """
+    for alias, shard_queryset in fan_out(queryset):
+        obj = shard_queryset.first()
+        if obj is not None:
+            return obj
+    return None
+
+
+def reserve_shard_id_range(using, **kwargs):
+    """
+    post_migrate handler: start id sequences of sharded tables on shard n at n * SHARD_ID_BLOCK,
+    so rows keep their ids when an owner is moved to another shard
+    """
+    if using not in settings.SHARD_DATABASES or using == DEFAULT_DB_ALIAS:
+        return
+    from ..models import ChangeJournal, Debtor, Transaction
+    start = settings.SHARD_DATABASES.index(using) * settings.SHARD_ID_BLOCK
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        for model in [Debtor, Transaction, ChangeJournal]:
+            table = model._meta.db_table
+            if connection.vendor == 'postgresql':
+                cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [table])
+                sequence = cursor.fetchone()[0]
+                cursor.execute(f'SELECT setval(%s, %s, false) FROM {sequence} WHERE last_value < %s',
+                               [sequence, start, start])
+            elif connection.vendor == 'sqlite':
+                cursor.execute('UPDATE sqlite_sequence SET seq = %s WHERE name = %s AND seq < %s',
+                               [start, table, start])
+                cursor.execute('INSERT INTO sqlite_sequence (name, seq) SELECT %s, %s '
+                               'WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = %s)',
+                               [table, start, table])
+
+
+class ShardRouter:
+    """
+    Owner data goes to the shard of the current request owner, set by ShardMixin or use_shard.
+    Reads go to the replicas of the shard like ReplicaRouter reads, objects loaded from a shard or its replicas
+    are saved back to the shard.
+    """
+
+    @staticmethod
+    def get_shard(**hints):
+        instance = hints.get('instance')
+        if instance is not None and is_sharded(type(instance)) and instance._state.db:
+            return get_primary(instance._state.db)
+        return current_shard.get() or DEFAULT_DB_ALIAS
+
+    def db_for_read(self, model, **hints):
+        if not is_sharded(model):
+            return None
+        # ReplicaRouter is not asked once a router answers, replicas of the shard are picked here
+        return route_read(self.get_shard(**hints), **hints)
+
+    def db_for_write(self, model, **hints):
+        if not is_sharded(model):
+            return None
+        return self.get_shard(**hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # debtor owner is a user in the default database, the foreign key has no constraint
+        if is_sharded(type(obj1)) or is_sharded(type(obj2)):
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db == DEFAULT_DB_ALIAS or db not in settings.SHARD_DATABASES:
+            return None
+        return app_label == APP_LABEL and model_name in SHARDED_MODELS
+
+
+class ShardMoving(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'Data is being moved, try again later.'
+    default_code = 'shard_moving'
+
+
+# first key of the owner write locks, the second one is the owner id
+OWNER_WRITE_LOCK = 1
+
+
+def lock_owner_writes(using, owner_ids, exclusive=False):
+    """
+    Transaction level lock of the owners data on the database, PostgreSQL only. Writes hold it shared and
+    are refused once the owner is being moved, move_owner_shard takes it exclusively to wait for the writes
+    started before it set the moving flag.
+    """
+    if connections[using].vendor == 'postgresql':
+        function = 'pg_advisory_xact_lock' if exclusive else 'pg_advisory_xact_lock_shared'
+        with connections[using].cursor() as cursor:
+            for owner_id in sorted(owner_ids):
+                cursor.execute(f'SELECT {function}(%s, %s)', [OWNER_WRITE_LOCK, owner_id])
+    if exclusive:
+        return
+    for owner_id in owner_ids:
+        mapping = get_owner_mapping(owner_id)
+        if mapping is not None and (mapping.moving or mapping.shard != using):
+            raise ShardMoving()
+
+
+class ShardMixin:
+    """
+    Route owner data queries of the request to the shard of the authenticated user.
+    Writes are refused while the owner is moved between shards.
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        token = current_shard.set(None)
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        finally:
+            current_shard.reset(token)
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if not request.user.is_authenticated:
+            return
+        mapping = get_owner_mapping(request.user.id)
+        if mapping is None:
+            return
+        if mapping.moving and request.method not in ('GET', 'HEAD', 'OPTIONS'):
+            raise ShardMoving()
+        current_shard.set(mapping.shard)
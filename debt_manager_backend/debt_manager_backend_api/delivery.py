@@ -0,0 +1,35 @@
+import base64
+import hashlib
+import os
+import time
+from urllib.parse import quote
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.http import FileResponse, HttpResponse
+
+X_ACCEL = 'x-accel'
+
+
+def sign_internal_uri(uri, expires):
+    """
+    Signature checked by the nginx secure_link module, secure_link_md5 "$secure_link_expires$uri <secret>"
+    """
+    if not settings.REPORT_ACCEL_SECRET:
+        raise ImproperlyConfigured('REPORT_ACCEL_SECRET is required with x-accel report delivery')
+    digest = hashlib.md5(f'{expires}{uri} {settings.REPORT_ACCEL_SECRET}'.encode()).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b'=').decode()
+
+
+def send_report_file(path, content_type):
+    """
+    Response for a file in REPORT_CACHE_DIR. With x-accel delivery the body is empty and nginx sends the file
+    from the shared volume, found by a signed internal uri valid for REPORT_ACCEL_TTL seconds; otherwise the
+    file is streamed by Django.
+    """
+    if settings.REPORT_DELIVERY != X_ACCEL:
+        return FileResponse(open(path, 'rb'), content_type=content_type)
+    uri = settings.REPORT_ACCEL_LOCATION + quote(os.path.relpath(path, settings.REPORT_CACHE_DIR))
+    expires = int(time.time()) + settings.REPORT_ACCEL_TTL
+    response = HttpResponse(content_type=content_type)
+    response['X-Accel-Redirect'] = f'{uri}?md5={sign_internal_uri(uri, expires)}&expires={expires}'
+    return response
@@ -0,0 +1,213 @@
+import asyncio
+import json
+import logging
+import psycopg2
+from collections import deque
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import close_old_connections, connections, router, transaction
+from django.db.models import Q, Sum
+from django.utils.module_loading import import_string
+from .db.sharding import get_owner_shard
+from .journal import get_owner_version, record_change
+from .models import Transaction
+
+lh = logging.getLogger('django')
+
+# debtor changes sent with balances, transaction changes always are
+BALANCE_ACTIONS = {'deleted', 'merged'}
+
+
+class Subscription:
+
+    def __init__(self, owner_id):
+        self.owner_id = owner_id
+        # None closes the stream
+        self.queue = asyncio.Queue(settings.EVENT_QUEUE_SIZE)
+
+
+class Broker:
+    """
+    In-process pub/sub of owner events for the event streams of this process.
+    Subscriptions belong to the event loop serving the streams, publish() may be called from any thread.
+    Events of an owner are delivered one at a time in publish order by a single task.
+    """
+
+    def __init__(self):
+        self.subscriptions = {}
+        # owner id to events waiting for the delivering task of the owner
+        self.pending = {}
+        self.loop = None
+
+    def subscribe(self, owner_id):
+        self.loop = asyncio.get_running_loop()
+        subscription = Subscription(owner_id)
+        self.subscriptions.setdefault(owner_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        subscriptions = self.subscriptions.get(subscription.owner_id, set())
+        subscriptions.discard(subscription)
+        if not subscriptions:
+            self.subscriptions.pop(subscription.owner_id, None)
+
+    def publish(self, owner_id, event):
+        if self.loop is None or owner_id not in self.subscriptions:
+            return
+        self.loop.call_soon_threadsafe(self.dispatch, owner_id, event)
+
+    def dispatch(self, owner_id, event):
+        if owner_id not in self.subscriptions:
+            return
+        pending = self.pending.get(owner_id)
+        if pending is None:
+            pending = self.pending[owner_id] = deque()
+            asyncio.ensure_future(self.deliver_pending(owner_id, pending))
+        pending.append(event)
+
+    async def deliver_pending(self, owner_id, pending):
+        # a later event without balances must not overtake one waiting for its balances
+        try:
+            while pending:
+                await self.deliver(owner_id, pending.popleft())
+        finally:
+            self.pending.pop(owner_id, None)
+
+    async def deliver(self, owner_id, event):
+        if event['type'] == 'transaction' or event['action'] in BALANCE_ACTIONS:
+            # once per event for all streams of the owner
+            try:
+                event = {**event, **await sync_to_async(get_balances)(owner_id, event.get('debtor'))}
+            except Exception:
+                lh.exception('event balances failed')
+        for subscription in list(self.subscriptions.get(owner_id, ())):
+            try:
+                subscription.queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # a client not keeping up is disconnected, it reconnects with Last-Event-ID and gets a reset
+                self.unsubscribe(subscription)
+                subscription.queue.get_nowait()
+                subscription.queue.put_nowait(None)
+
+
+broker = Broker()
+
+
+class LocalBackend:
+    """
+    Events reach the streams of the publishing process only, for development and tests
+    """
+
+    def __init__(self, broker):
+        self.broker = broker
+
+    def publish(self, using, owner_id, event):
+        transaction.on_commit(lambda: self.broker.publish(owner_id, event), using=using)
+
+    def start(self):
+        pass
+
+
+class PostgresNotifyBackend:
+    """
+    Events sent with NOTIFY in the write transaction, PostgreSQL delivers them on commit to every process
+    listening on the primary databases
+    """
+    channel = 'owner_events'
+    # PostgreSQL refuses payloads of 8000 bytes and more, failing the write transaction
+    max_payload = 7999
+
+    def __init__(self, broker):
+        self.broker = broker
+
+    @staticmethod
+    def get_payload(owner_id, event):
+        return json.dumps({'owner': owner_id, 'event': event}, cls=DjangoJSONEncoder)
+
+    def publish(self, using, owner_id, event):
+        payload = self.get_payload(owner_id, event)
+        with connections[using].cursor() as cursor:
+            cursor.execute('SELECT pg_notify(%s, %s)', [self.channel, payload])
+
+    def start(self):
+        for alias in settings.SHARD_DATABASES:
+            self.listen(alias)
+
+    def listen(self, alias):
+        loop = asyncio.get_running_loop()
+        try:
+            # a dedicated connection, pooled ones are returned after every request; connecting blocks the loop
+            # but happens on start and after failures only
+            conn = psycopg2.connect(**connections[alias].get_connection_params())
+            conn.autocommit = True
+            with conn.cursor() as cursor:
+                cursor.execute(f'LISTEN {self.channel}')
+        except psycopg2.Error as e:
+            lh.error(f'event listener for {alias} failed: {e}')
+            loop.call_later(settings.EVENT_LISTEN_RETRY, self.listen, alias)
+            return
+        loop.add_reader(conn.fileno(), self.receive, alias, conn)
+
+    def receive(self, alias, conn):
+        try:
+            conn.poll()
+        except psycopg2.Error as e:
+            lh.error(f'event listener for {alias} lost: {e}')
+            loop = asyncio.get_running_loop()
+            loop.remove_reader(conn.fileno())
+            conn.close()
+            loop.call_later(settings.EVENT_LISTEN_RETRY, self.listen, alias)
+            return
+        while conn.notifies:
+            message = json.loads(conn.notifies.pop(0).payload)
+            self.broker.dispatch(message['owner'], message['event'])
+
+
+def get_backend():
+    if not hasattr(get_backend, 'backend'):
+        get_backend.backend = import_string(settings.EVENT_BACKEND)(broker)
+    return get_backend.backend
+
+
+def get_balances(owner_id, debtor_id):
+    """
+    Balance of the debtor and total balance of the owner as they are now, from the owner primary database
+    """
+    close_old_connections()
+    try:
+        return Transaction.objects.using(get_owner_shard(owner_id)).filter(is_active=True, debtor__owner=owner_id)\
+            .aggregate(balance=Sum('sum', filter=Q(debtor=debtor_id)), total_balance=Sum('sum'))
+    finally:
+        close_old_connections()
+
+
+def publish_change(owner_id, obj, action, entry):
+    """
+    Publish the change of a debtor or transaction journaled as entry. Called in the write transaction,
+    subscribers get it once it commits; balances are added by the process serving the streams.
+    """
+    debtor_id = obj.debtor_id if isinstance(obj, Transaction) else obj.pk
+    event = {'type': obj._meta.model_name, 'action': action, 'id': obj.pk, 'debtor': debtor_id, 'version': entry.id}
+    get_backend().publish(obj._state.db, owner_id, event)
+
+
+def publish_bulk_change(owner_id, model, action, ids, debtor=None):
+    """
+    Publish a change of several debtors or transactions as one event, version is the last journal entry
+    of the owner. Merges name the target debtor and transaction changes their debtor, which gets the balance.
+    The event carries the number of changed rows only, clients get the rows with /sync/; id lists would
+    not fit into a NOTIFY payload.
+    """
+    event = {'type': model._meta.model_name, 'action': action, 'count': len(ids),
+             'version': get_owner_version(owner_id)}
+    if debtor is not None:
+        event['debtor'] = debtor
+    get_backend().publish(router.db_for_write(model), owner_id, event)
+
+
+def record_change_event(owner_id, obj, action):
+    """
+    Journal and publish a created, updated or deleted debtor or transaction
+    """
+    publish_change(owner_id, obj, action, record_change(owner_id, obj))
@@ -0,0 +1,55 @@
+from django.contrib.postgres.search import SearchQuery, SearchVector
+from django.db import connections
+from rest_framework import filters
+from rest_framework.compat import coreapi, coreschema
+from .serializers import TransactionFilterSerializer
+
+
+class TransactionFilter(filters.BaseFilterBackend):
+    # must match the expression of transaction_comment_search_idx
+    search_config = 'simple'
+    schema_fields = {
+        'date_from': (coreschema.String, 'Transactions made on or after this date (YYYY-MM-DD)'),
+        'date_to': (coreschema.String, 'Transactions made on or before this date (YYYY-MM-DD)'),
+        'min_sum': (coreschema.Number, 'Minimum transaction sum'),
+        'max_sum': (coreschema.Number, 'Maximum transaction sum'),
+        'sign': (coreschema.String, 'lent - only positive sums, borrowed - only negative sums'),
+        'search': (coreschema.String, 'Full text search over the transaction comment'),
+    }
+
+    def filter_queryset(self, request, queryset, view):
+        serializer = TransactionFilterSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        params = serializer.validated_data
+        if 'date_from' in params:
+            queryset = queryset.filter(date__gte=params['date_from'])
+        if 'date_to' in params:
+            queryset = queryset.filter(date__lte=params['date_to'])
+        if 'min_sum' in params:
+            queryset = queryset.filter(sum__gte=params['min_sum'])
+        if 'max_sum' in params:
+            queryset = queryset.filter(sum__lte=params['max_sum'])
+        if params.get('sign') == 'lent':
+            queryset = queryset.filter(sum__gt=0)
+        elif params.get('sign') == 'borrowed':
+            queryset = queryset.filter(sum__lt=0)
+        if 'search' in params:
+            queryset = self.search_comment(queryset, params['search'])
+        # add context using in paginator class
+        request.parser_context['transaction_filters'] = params
+        return queryset
+
+    def search_comment(self, queryset, text):
+        if connections[queryset.db].vendor != 'postgresql':
+            return queryset.filter(comment__icontains=text)
+        return queryset.annotate(
+            comment_search=SearchVector('comment', config=self.search_config)
+        ).filter(comment_search=SearchQuery(text, config=self.search_config))
+
+    def get_schema_fields(self, view):
+        assert coreapi is not None, 'coreapi must be installed to use `get_schema_fields()`'
+        assert coreschema is not None, 'coreschema must be installed to use `get_schema_fields()`'
+        return [
+            coreapi.Field(name=name, required=False, location='query', schema=schema(description=description))
+            for name, (schema, description) in self.schema_fields.items()
+        ]
@@ -0,0 +1,79 @@
+import hashlib
+import json
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, transaction
+from django.utils import timezone
+from rest_framework import exceptions, status
+from rest_framework.response import Response
+from .models import IdempotencyKey
+
+IDEMPOTENCY_HEADER = 'HTTP_IDEMPOTENCY_KEY'
+IDEMPOTENT_ACTIONS = {'create', 'update', 'partial_update', 'destroy', 'bulk'}
+
+
+class IdempotencyKeyMismatch(exceptions.APIException):
+    status_code = status.HTTP_422_UNPROCESSABLE_ENTITY
+    default_detail = 'Idempotency-Key was already used for another request.'
+    default_code = 'idempotency_key_mismatch'
+
+
+def request_fingerprint(request):
+    # parsed data, the raw body may already be consumed by authentication
+    data = json.dumps(request.data, sort_keys=True, default=str)
+    return hashlib.sha1(f'{request.method} {request.get_full_path()} {data}'.encode()).hexdigest()
+
+
+def claim_key(user, key, fingerprint):
+    """
+    Create the key row, committed before the request runs so duplicates find it; existing rows are kept
+    """
+    now = timezone.now()
+    IdempotencyKey.objects.filter(user=user, created_at__lt=now - settings.IDEMPOTENCY_KEY_TTL).delete()
+    try:
+        with transaction.atomic(using=DEFAULT_DB_ALIAS):
+            IdempotencyKey.objects.create(user=user, key=key, fingerprint=fingerprint, created_at=now)
+    except IntegrityError:
+        pass
+
+
+def run_idempotent(request, key, handler, *args, **kwargs):
+    """
+    Run the handler once per user and key and store its response, retries get the stored response.
+    A duplicate sent while the first request runs waits on the row lock until it finishes.
+    The row stays without a response if the handler fails, so the next retry runs the handler again.
+    """
+    fingerprint = request_fingerprint(request)
+    claim_key(request.user, key, fingerprint)
+    with transaction.atomic(using=DEFAULT_DB_ALIAS):
+        record = IdempotencyKey.objects.select_for_update().get(user=request.user, key=key)
+        if record.fingerprint != fingerprint:
+            raise IdempotencyKeyMismatch()
+        if record.status_code is not None:
+            return Response(record.response, status=record.status_code, headers={'Idempotent-Replayed': 'true'})
+        response = handler(request, *args, **kwargs)
+        record.status_code = response.status_code
+        record.response = response.data
+        record.save(update_fields=['status_code', 'response'])
+    return response
+
+
+class IdempotencyMixin:
+    """
+    Create, update and delete sent with an Idempotency-Key header run once, retries with the same key
+    within IDEMPOTENCY_KEY_TTL get the first response without running the action again
+    """
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        key = request.META.get(IDEMPOTENCY_HEADER)
+        if key is None or self.action not in IDEMPOTENT_ACTIONS:
+            return
+        if not 0 < len(key) <= 255:
+            raise exceptions.ValidationError({'Idempotency-Key': 'Must be 1 to 255 characters long.'})
+        method = request.method.lower()
+        handler = getattr(self, method)
+
+        def idempotent_handler(request, *args, **kwargs):
+            return run_idempotent(request, key, handler, *args, **kwargs)
+        # dispatch looks the handler up after initial
+        setattr(self, method, idempotent_handler)
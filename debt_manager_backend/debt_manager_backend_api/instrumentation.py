@@ -0,0 +1,115 @@
+import os
+import time
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+from django.db import connections
+from django.http import HttpResponse
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, \
+    generate_latest, multiprocess
+
+current_route = ContextVar('current_route', default=None)
+
+REQUEST_LATENCY = Histogram('http_request_duration_seconds', 'Request latency',
+                            ['route', 'method', 'status'])
+REQUEST_DB_QUERIES = Histogram('http_request_db_queries', 'Database queries per request', ['route'],
+                               buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89, 144, float('inf')))
+REQUEST_DB_DURATION = Histogram('http_request_db_duration_seconds', 'Database time per request', ['route'])
+RESPONSE_SIZE = Histogram('http_response_size_bytes', 'Response body size', ['route'],
+                          buckets=(256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, float('inf')))
+PHASE_DURATION = Histogram('app_phase_duration_seconds', 'Duration of request internal phases',
+                           ['route', 'phase'])
+DB_POOL_WAIT = Histogram('db_pool_wait_seconds', 'Time waited for a pooled database connection', ['pool'],
+                         buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf')))
+DB_POOL_EVENTS = Counter('db_pool_events', 'Pooled database connections created, recycled, found unhealthy '
+                                           'and checkouts timed out', ['pool', 'event'])
+
+
+class QueryRecorder:
+    """
+    Execute wrapper for every database connection of the current thread, counts queries and their time.
+    With capture_sql executed queries are kept in queries list.
+    """
+
+    def __init__(self, capture_sql=False):
+        self.capture_sql = capture_sql
+        self.count = 0
+        self.duration = 0.0
+        self.queries = []
+        self._stack = None
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - start
+            self.count += 1
+            self.duration += duration
+            if self.capture_sql:
+                self.queries.append({'alias': context['connection'].alias, 'sql': sql, 'params': params,
+                                     'many': many, 'duration': duration})
+
+    def __enter__(self):
+        self._stack = ExitStack()
+        for connection in connections.all():
+            self._stack.enter_context(connection.execute_wrapper(self))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stack.close()
+
+
+@contextmanager
+def track_phase(phase):
+    """
+    Record duration of an internal phase of the current request, usable as a decorator
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        PHASE_DURATION.labels(current_route.get() or 'unresolved', phase).observe(time.perf_counter() - start)
+
+
+class MetricsMiddleware:
+    """
+    Record latency, database queries and response size per resolved url name
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = current_route.set(None)
+        start = time.perf_counter()
+        try:
+            with QueryRecorder() as queries:
+                response = self.get_response(request)
+            duration = time.perf_counter() - start
+            route = current_route.get() or 'unresolved'
+            REQUEST_LATENCY.labels(route, request.method, response.status_code).observe(duration)
+            REQUEST_DB_QUERIES.labels(route).observe(queries.count)
+            REQUEST_DB_DURATION.labels(route).observe(queries.duration)
+            if not response.streaming:
+                RESPONSE_SIZE.labels(route).observe(len(response.content))
+            elif response.has_header('Content-Length'):
+                # streamed files
+                RESPONSE_SIZE.labels(route).observe(int(response['Content-Length']))
+            return response
+        finally:
+            current_route.reset(token)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        current_route.set(request.resolver_match.url_name or request.resolver_match.view_name)
+
+
+def metrics_view(request):
+    """
+    Prometheus text exposition, aggregated over gunicorn workers when PROMETHEUS_MULTIPROC_DIR is set
+    """
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return HttpResponse(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,61 @@
+from contextlib import contextmanager
+from django.db import router, transaction
+from .db.sharding import current_shard, get_owner_shard, lock_owner_writes
+from .models import ChangeJournal, Debtor, Transaction
+
+
+@contextmanager
+def journaled_write(model, owner_ids=(), savepoint=False):
+    """
+    Transaction of a ledger write and its journal entry, on the database the model is written to.
+    Holds the write lock of the owners, writes of owners being moved are refused with ShardMoving.
+    """
+    using = router.db_for_write(model)
+    # no savepoint by default: a failed write fails the request
+    with transaction.atomic(using=using, savepoint=savepoint):
+        lock_owner_writes(using, owner_ids)
+        yield
+
+
+def record_change(owner_id, obj):
+    """
+    Append and return a journal entry for a created, updated or deleted debtor or transaction
+    """
+    return ChangeJournal.objects.using(obj._state.db).create(owner_id=owner_id, model=obj._meta.model_name,
+                                                             object_id=obj.pk)
+
+
+def record_changes(owner_id, model, object_ids, batch_size=5000):
+    """
+    Journal entries for debtors or transactions changed in bulk, in the transaction of the write
+    """
+    ChangeJournal.objects.using(router.db_for_write(model)).bulk_create(
+        [ChangeJournal(owner_id=owner_id, model=model._meta.model_name, object_id=object_id)
+         for object_id in object_ids], batch_size=batch_size)
+
+
+def record_snapshot(owner_ids, using, batch_size=5000):
+    """
+    Journal entries for all active debtors and transactions of the owners, for data written in bulk
+    """
+    entries = []
+    debtors = Debtor.objects.using(using).filter(owner__in=owner_ids, is_active=True).order_by('id')
+    transactions = Transaction.objects.using(using)\
+        .filter(debtor__owner__in=owner_ids, debtor__is_active=True, is_active=True).order_by('id')
+    for queryset, owner_field in [(debtors, 'owner_id'), (transactions, 'debtor__owner_id')]:
+        model_name = queryset.model._meta.model_name
+        for owner_id, object_id in queryset.values_list(owner_field, 'id').iterator(chunk_size=batch_size):
+            entries.append(ChangeJournal(owner_id=owner_id, model=model_name, object_id=object_id))
+            if len(entries) == batch_size:
+                ChangeJournal.objects.using(using).bulk_create(entries)
+                entries = []
+    ChangeJournal.objects.using(using).bulk_create(entries)
+
+
+def get_owner_version(owner_id):
+    """
+    Data version of the owner, the last journal id; changes with every debtor and transaction write
+    """
+    using = current_shard.get() or get_owner_shard(owner_id)
+    return ChangeJournal.objects.using(using).filter(owner_id=owner_id).order_by('-id')\
+        .values_list('id', flat=True).first() or 0
@@ -0,0 +1,115 @@
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+import re
+import uuid
+from contextvars import ContextVar
+from logging.config import ConvertingList
+from logging.handlers import QueueHandler, QueueListener
+from .instrumentation import current_route
+
+request_id = ContextVar('request_id', default=None)
+REQUEST_ID_RE = re.compile(r'[0-9A-Za-z-]{1,64}')
+
+
+class QueueListenerHandler(QueueHandler):
+    """
+    Put records on a bounded in-memory queue, the wrapped handlers write them from a listener thread.
+    Configured from LOGGING with handlers as 'cfg://handlers.<name>' references.
+    Records are dropped and counted when the queue is full, so logging never blocks a request.
+    """
+
+    def __init__(self, handlers, queue_size=10000):
+        super().__init__(queue.Queue(queue_size))
+        if isinstance(handlers, ConvertingList):
+            handlers = [handlers[i] for i in range(len(handlers))]
+        self.handlers = handlers
+        self.dropped = 0
+        self.listener = None
+        self.start()
+        atexit.register(self.stop)
+        # a listener thread does not survive fork, start one in the child
+        os.register_at_fork(after_in_child=self.start)
+
+    def start(self):
+        self.listener = QueueListener(self.queue, *self.handlers, respect_handler_level=True)
+        self.listener.start()
+
+    def stop(self):
+        if self.listener is not None and self.listener._thread is not None:
+            self.listener.stop()
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        # context variables are not visible in the listener thread
+        record.request_id = request_id.get()
+        record.route = current_route.get()
+        if self.dropped:
+            record.dropped = self.dropped
+            self.dropped = 0
+        # message and traceback are rendered here, args and exc_info may not be thread safe
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = record.exc_text or logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        self.stop()
+        super().close()
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    One json object per line with the request id and route of the logging request
+    """
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'module': record.module,
+            'process': record.process,
+            'thread': record.thread,
+            'request_id': getattr(record, 'request_id', None),
+            'route': getattr(record, 'route', None),
+            'message': record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc_info'] = record.exc_text
+        if getattr(record, 'dropped', 0):
+            entry['dropped_before'] = record.dropped
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class RequestIdMiddleware:
+    """
+    Take the request id from the X-Request-ID header set by nginx or generate one, return it in the response
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        value = request.META.get('HTTP_X_REQUEST_ID', '')
+        token = request_id.set(value if REQUEST_ID_RE.fullmatch(value) else uuid.uuid4().hex)
+        try:
+            response = self.get_response(request)
+            response['X-Request-ID'] = request_id.get()
+            return response
+        finally:
+            request_id.reset(token)
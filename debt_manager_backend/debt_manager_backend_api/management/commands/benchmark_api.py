@@ -0,0 +1,187 @@
+import json
+import queue
+import random
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+from django.db import connections
+from django.test import Client
+from django.urls import reverse
+from oauth2_provider.models import AccessToken
+from debt_manager_backend_api.models import Debtor
+from .seed_load import APPLICATION_NAME
+
+# name: (url name, url args, query params); url args are filled with the chosen debtor id
+ENDPOINTS = {
+    'debtor_list': ('debtor-list', False, {}),
+    'debtor_list_small_page': ('debtor-list', False, {'size': 5}),
+    'debtor_detail': ('debtor-detail', True, {}),
+    'transaction_list': ('debtor-transaction-list', True, {}),
+    'transaction_list_filtered': ('debtor-transaction-list', True, {'sign': 'lent', 'date_from': '2020-01-01'}),
+    'transaction_list_sparse': ('debtor-transaction-list', True, {'fields': 'id,sum'}),
+    'report': ('debtor-report', True, {'extension': 'xlsx'}),
+    'current_user': ('user-current', False, {}),
+}
+WRITE_ENDPOINTS = {
+    'transaction_create': ('debtor-transaction-list', True, {'sum': 100, 'comment': 'benchmark'}),
+}
+
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile of sorted values
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))]
+
+
+class Command(BaseCommand):
+    help = 'Drive the API routes with users seeded by seed_load and report latency percentiles and throughput ' \
+           'per endpoint as json'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help='requests per endpoint')
+        parser.add_argument('--concurrency', type=int, default=4, help='parallel clients')
+        parser.add_argument('--endpoints', nargs='+', help=f'subset of {", ".join({**ENDPOINTS, **WRITE_ENDPOINTS})}')
+        parser.add_argument('--writes', action='store_true', help='include endpoints that create data')
+        parser.add_argument('--base-url', help='send requests to a running server, e.g. http://localhost:8000, '
+                                               'by default the in-process test client is used')
+        parser.add_argument('--host', help='Host header for the test client, first ALLOWED_HOSTS entry by default')
+        parser.add_argument('--random-seed', type=int, default=0)
+        parser.add_argument('--output', help='write the json report to this file instead of stdout')
+
+    def handle(self, *args, **options):
+        if options['requests'] < 1 or options['concurrency'] < 1:
+            raise CommandError('--requests and --concurrency must be at least 1')
+        endpoints = {**ENDPOINTS, **WRITE_ENDPOINTS} if options['writes'] else dict(ENDPOINTS)
+        if options['endpoints']:
+            unknown = set(options['endpoints']) - set(endpoints)
+            if unknown:
+                raise CommandError(f'unknown endpoints: {", ".join(sorted(unknown))}')
+            endpoints = {name: endpoints[name] for name in options['endpoints']}
+        targets = self.get_targets()
+        rnd = random.Random(options['random_seed'])
+        send = self.get_sender(options)
+
+        report = {
+            'config': {key: options[key] for key in ['requests', 'concurrency', 'base_url', 'random_seed']},
+            'users': len(targets),
+            'endpoints': {},
+        }
+        for name, (url_name, with_debtor, params) in endpoints.items():
+            method = 'post' if name in WRITE_ENDPOINTS else 'get'
+            plan = []
+            for _ in range(options['requests']):
+                token, debtor_ids = rnd.choice(targets)
+                args = (rnd.choice(debtor_ids),) if with_debtor else ()
+                plan.append((method, reverse(url_name, args=args), params, token))
+            report['endpoints'][name] = self.run_endpoint(send, plan, options['concurrency'])
+
+        result = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(result)
+        else:
+            self.stdout.write(result)
+
+    def get_targets(self):
+        """
+        (access token, active debtor ids) of every user seeded by seed_load
+        """
+        tokens = dict(AccessToken.objects.filter(application__name=APPLICATION_NAME)
+                      .values_list('user_id', 'token'))
+        debtors = {}
+        for owner_id, debtor_id in Debtor.objects.filter(owner_id__in=tokens, is_active=True)\
+                .values_list('owner_id', 'id'):
+            debtors.setdefault(owner_id, []).append(debtor_id)
+        targets = [(tokens[owner_id], ids) for owner_id, ids in debtors.items()]
+        if not targets:
+            raise CommandError('no seeded users found, run seed_load first')
+        return targets
+
+    def get_sender(self, options):
+        """
+        Return send(method, path, params, token) -> status code, through the test client or to base_url
+        """
+        if options['base_url']:
+            base_url = options['base_url'].rstrip('/')
+
+            def send(method, path, params, token):
+                data = None
+                if method == 'get':
+                    path = f'{path}?{urllib.parse.urlencode(params)}' if params else path
+                else:
+                    data = json.dumps(params).encode()
+                request = urllib.request.Request(base_url + path, data=data, method=method.upper(),
+                                                 headers={'Authorization': f'Bearer {token}',
+                                                          'Content-Type': 'application/json'})
+                try:
+                    with urllib.request.urlopen(request) as response:
+                        response.read()
+                        return response.status
+                except urllib.error.HTTPError as e:
+                    return e.code
+            return send
+
+        host = options['host'] or next((h.lstrip('.') for h in settings.ALLOWED_HOSTS if h != '*'), 'localhost')
+        local = threading.local()
+
+        def send(method, path, params, token):
+            if not hasattr(local, 'client'):
+                local.client = Client(HTTP_HOST=host)
+            if method == 'get':
+                response = local.client.get(path, params, HTTP_AUTHORIZATION=f'Bearer {token}')
+            else:
+                response = local.client.post(path, params, content_type='application/json',
+                                             HTTP_AUTHORIZATION=f'Bearer {token}')
+            if response.streaming:
+                b''.join(response.streaming_content)
+            return response.status_code
+        return send
+
+    def run_endpoint(self, send, plan, concurrency):
+        def run(item):
+            start = time.perf_counter()
+            status = send(*item)
+            return time.perf_counter() - start, status
+
+        def worker(items):
+            results = []
+            try:
+                while True:
+                    try:
+                        item = items.get_nowait()
+                    except queue.Empty:
+                        return results
+                    results.append(run(item))
+            finally:
+                # database connections of the in-process client are per thread
+                connections.close_all()
+
+        start = time.perf_counter()
+        if concurrency == 1:
+            results = [run(item) for item in plan]
+        else:
+            items = queue.Queue()
+            for item in plan:
+                items.put(item)
+            with ThreadPoolExecutor(concurrency) as pool:
+                results = [r for f in [pool.submit(worker, items) for _ in range(concurrency)] for r in f.result()]
+        elapsed = time.perf_counter() - start
+        latencies = sorted(latency for latency, _ in results)
+        # stats of an empty plan are null
+        mean = sum(latencies) / len(latencies) if latencies else None
+        return {
+            'requests': len(plan),
+            'errors': sum(status >= 400 for _, status in results),
+            **{f'{name}_ms': value * 1e3 if value is not None else None for name, value in [
+                ('p50', percentile(latencies, 50)), ('p95', percentile(latencies, 95)),
+                ('p99', percentile(latencies, 99)), ('mean', mean)]},
+            'throughput_rps': len(plan) / elapsed if plan else None,
+        }
@@ -0,0 +1,41 @@
+import time
+from datetime import date, timedelta
+from django.core.management import BaseCommand
+from rest_framework.renderers import JSONRenderer
+from debt_manager_backend_api.renderers import FastJSONRenderer, MessagePackRenderer
+
+
+class Command(BaseCommand):
+    help = 'Compare render time of transaction list pages with the available renderers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, nargs='+', default=[100, 1000, 10000], help='page sizes to measure')
+        parser.add_argument('--repeat', type=int, default=20, help='best of N runs is reported')
+
+    def handle(self, *args, **options):
+        renderers = [('drf json', JSONRenderer()), ('fast json', FastJSONRenderer()),
+                     ('msgpack', MessagePackRenderer())]
+        self.stdout.write(f'{"renderer":<16}{"rows":>8}{"ms/page":>12}{"us/row":>10}{"bytes":>12}')
+        for size in options['rows']:
+            page = self.get_page(size)
+            for name, renderer in renderers:
+                best = None
+                for _ in range(options['repeat']):
+                    start = time.perf_counter()
+                    body = renderer.render(page, renderer.media_type, {})
+                    elapsed = time.perf_counter() - start
+                    best = elapsed if best is None else min(best, elapsed)
+                self.stdout.write(f'{name:<16}{size:>8}{best * 1e3:>12.3f}{best / size * 1e6:>10.2f}{len(body):>12}')
+
+    def get_page(self, size):
+        start = date(2020, 1, 1)
+        return {
+            'next': 'http://testserver/api/v1/debtor/1/transaction/?page=2',
+            'previous': None,
+            'count': size * 2,
+            'total_balance': 1234.5,
+            'currency': 'руб',
+            'debtor_props': {'name': 'debtor'},
+            'results': [{'id': i, 'date': (start + timedelta(days=i % 365)).isoformat(), 'sum': (i % 17 - 8) * 10.5,
+                         'comment': f'комментарий к транзакции {i}'} for i in range(size)],
+        }
@@ -0,0 +1,66 @@
+import time
+from django.contrib.auth import get_user_model
+from django.core.management import BaseCommand
+from django.db import transaction
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+from debt_manager_backend_api.models import Debtor, Transaction
+from debt_manager_backend_api.serializers import DebtorSerializer, TransactionSerializer, ValuesRowMapper
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = 'Compare per-row cost of the serializer and values() list read paths. Seeded rows are rolled back.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, nargs='+', default=[100, 1000], help='page sizes to measure')
+        parser.add_argument('--repeat', type=int, default=5, help='best of N runs is reported')
+
+    def handle(self, *args, **options):
+        rows = options['rows']
+        with transaction.atomic():
+            debtors, transactions = self.seed(max(rows))
+            request = Request(APIRequestFactory().get('/'))
+            self.stdout.write(f'{"path":<40}{"rows":>8}{"total us/row":>16}{"render us/row":>16}')
+            for size in rows:
+                for name, serializer_class, queryset in [('debtor', DebtorSerializer, debtors),
+                                                         ('transaction', TransactionSerializer, transactions)]:
+                    page = queryset[:size]
+                    mapper = ValuesRowMapper.for_request(serializer_class, request)
+                    paths = {
+                        'serializer': (lambda: list(page),
+                                       lambda r: serializer_class(r, many=True, context={'request': request}).data),
+                        'values': (lambda: list(mapper.get_values(page)), mapper.to_representation),
+                    }
+                    rendered = [JSONRenderer().render(render(fetch())) for fetch, render in paths.values()]
+                    assert rendered[0] == rendered[1], f'{name}: values path output differs'
+                    for path_name, (fetch, render) in paths.items():
+                        total = self.measure(lambda: render(fetch()), options['repeat'])
+                        fetched = fetch()
+                        render_only = self.measure(lambda: render(fetched), options['repeat'])
+                        self.stdout.write(f'{name + " " + path_name:<40}{size:>8}'
+                                          f'{total / size * 1e6:>16.2f}{render_only / size * 1e6:>16.2f}')
+            transaction.set_rollback(True)
+
+    def measure(self, func, repeat):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    def seed(self, count):
+        user = User.objects.create(username='benchmark_serializers', email='benchmark@example.com')
+        Debtor.objects.bulk_create([Debtor(name=f'debtor {i}', owner=user) for i in range(count)])
+        debtors = Debtor.objects.filter(owner=user, is_active=True).order_by('id')
+        debtor = debtors[0]
+        Transaction.objects.bulk_create(
+            [Transaction(sum=i % 17 - 8 or 1, comment=f'comment {i}', debtor=debtor) for i in range(count)],
+            batch_size=1000)
+        Transaction.objects.bulk_create([Transaction(sum=1, debtor=d) for d in debtors[1:]], batch_size=1000)
+        transactions = Transaction.objects.filter(is_active=True, debtor=debtor).order_by('-date')
+        return debtors, transactions
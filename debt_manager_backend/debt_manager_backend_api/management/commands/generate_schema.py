@@ -0,0 +1,11 @@
+from django.core.management import BaseCommand
+from debt_manager_backend_api.swagger import precomputed_schema, get_code_version
+
+
+class Command(BaseCommand):
+    help = 'Generate the OpenAPI schema served by /swagger/openapi.json for the current code version'
+
+    def handle(self, *args, **options):
+        version = get_code_version()
+        precomputed_schema.generate(version)
+        print(f'OpenAPI schema generated: {precomputed_schema.get_path(version)}')
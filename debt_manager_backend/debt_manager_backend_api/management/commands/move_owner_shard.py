@@ -0,0 +1,76 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management import BaseCommand, CommandError
+from django.db import transaction
+from debt_manager_backend_api.db.sharding import get_owner_shard, lock_owner_writes
+from debt_manager_backend_api.journal import record_snapshot
+from debt_manager_backend_api.models import ChangeJournal, Debtor, OwnerShard, Transaction
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = 'Move debtors and transactions of one owner to another shard. Ids are kept, writes of the owner ' \
+           'are refused with 503 while the data is copied. The change journal is rebuilt on the target.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('owner', help='owner id or username')
+        parser.add_argument('shard', choices=settings.SHARD_DATABASES)
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        owner = self.get_owner(options['owner'])
+        source, target = get_owner_shard(owner.id), options['shard']
+        if source == target:
+            self.stdout.write(f'{owner.username} is already on {target}')
+            return
+        OwnerShard.objects.update_or_create(owner=owner, defaults={'shard': source, 'moving': True})
+        try:
+            # writes that started before the flag are waited for, later ones see it and are refused
+            with transaction.atomic(using=source):
+                lock_owner_writes(source, [owner.id], exclusive=True)
+            debtors, transactions = self.copy(owner, source, target, options['batch_size'])
+        except Exception:
+            OwnerShard.objects.filter(owner=owner).update(moving=False)
+            raise
+        OwnerShard.objects.filter(owner=owner).update(shard=target, moving=False)
+        # reads switched to the target, the source copy is not visible anymore
+        with transaction.atomic(using=source):
+            Transaction.objects.using(source).filter(debtor__owner=owner).delete()
+            Debtor.objects.using(source).filter(owner=owner).delete()
+            ChangeJournal.objects.using(source).filter(owner=owner).delete()
+        self.stdout.write(f'moved {owner.username} from {source} to {target}: '
+                          f'{debtors} debtors, {transactions} transactions')
+
+    def get_owner(self, value):
+        owners = User.objects.filter(id=int(value)) if value.isdigit() else User.objects.filter(username=value)
+        owner = owners.filter(is_active=True).first()
+        if owner is None:
+            raise CommandError(f'owner not found: {value}')
+        return owner
+
+    def copy(self, owner, source, target, batch_size):
+        debtors = Debtor.objects.using(source).filter(owner=owner).order_by('id')
+        transactions = Transaction.objects.using(source).filter(debtor__owner=owner).order_by('id')
+        for queryset in [debtors, transactions]:
+            ids = list(queryset.values_list('id', flat=True))
+            for i in range(0, len(ids), batch_size):
+                if queryset.model.objects.using(target).filter(id__in=ids[i:i + batch_size]).exists():
+                    raise CommandError(f'ids of {owner.username} data already exist on {target}')
+        with transaction.atomic(using=target):
+            debtors_count = self.copy_rows(debtors, target, batch_size)
+            transactions_count = self.copy_rows(transactions, target, batch_size)
+            # journal ids are per shard, clients with a cursor of the source shard sync again from the start
+            record_snapshot([owner.id], target, batch_size)
+        return debtors_count, transactions_count
+
+    def copy_rows(self, queryset, target, batch_size):
+        batch, count = [], 0
+        for obj in queryset.iterator(chunk_size=batch_size):
+            batch.append(obj)
+            if len(batch) == batch_size:
+                queryset.model.objects.using(target).bulk_create(batch)
+                count += len(batch)
+                batch = []
+        queryset.model.objects.using(target).bulk_create(batch)
+        return count + len(batch)
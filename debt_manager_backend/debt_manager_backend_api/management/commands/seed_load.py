@@ -0,0 +1,100 @@
+import math
+import random
+from datetime import date, timedelta
+from django.contrib.auth import get_user_model
+from django.core.management import BaseCommand
+from django.db import router, transaction
+from django.utils import timezone
+from oauth2_provider.models import AccessToken, Application
+from debt_manager_backend_api.journal import record_snapshot
+from debt_manager_backend_api.models import ChangeJournal, Currency, CurrencyOwner, Debtor, Transaction
+
+User = get_user_model()
+
+# currency name and share of users
+CURRENCIES = [('руб', 0.6), ('dollars', 0.2), ('euro', 0.15), ('тенге', 0.05)]
+COMMENTS = ['', '', '', 'lunch', 'taxi', 'rent', 'за продукты', 'долг за билеты', 'coffee', 'gift']
+APPLICATION_NAME = 'load benchmark'
+
+
+def get_token(prefix, user_index):
+    return f'{prefix}-token-{user_index}'
+
+
+class Command(BaseCommand):
+    help = 'Seed users with a realistic amount of debtors and transactions for load benchmarks. ' \
+           'Every user gets an access token <prefix>-token-<n> used by benchmark_api.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100, help='number of users to create')
+        parser.add_argument('--debtors', type=float, default=15, help='mean debtors per user')
+        parser.add_argument('--transactions', type=float, default=40, help='mean transactions per debtor')
+        parser.add_argument('--prefix', default='load', help='username prefix of seeded users')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--random-seed', type=int, default=0, help='same seed gives the same data')
+        parser.add_argument('--clear', action='store_true', help='remove users seeded with the prefix first')
+
+    def handle(self, *args, **options):
+        prefix = options['prefix']
+        rnd = random.Random(options['random_seed'])
+        batch_size = options['batch_size']
+        with transaction.atomic():
+            if options['clear']:
+                self.clear(prefix)
+            currencies = {name: Currency.objects.update_or_create(name=name, defaults={'is_active': True})[0]
+                          for name, _ in CURRENCIES}
+            application, _ = Application.objects.get_or_create(
+                name=APPLICATION_NAME, defaults={'client_type': Application.CLIENT_CONFIDENTIAL,
+                                                 'authorization_grant_type': Application.GRANT_PASSWORD})
+            users = User.objects.bulk_create(
+                [User(username=f'{prefix}{i}@example.com', email=f'{prefix}{i}@example.com', password='!')
+                 for i in range(options['users'])], batch_size=batch_size)
+            users = list(User.objects.filter(username__in=[u.username for u in users]).order_by('id'))
+            expires = timezone.now() + timedelta(days=30)
+            AccessToken.objects.bulk_create(
+                [AccessToken(user=u, token=get_token(prefix, i), scope='read write', expires=expires,
+                             application=application) for i, u in enumerate(users)], batch_size=batch_size)
+            names, weights = zip(*CURRENCIES)
+            CurrencyOwner.objects.bulk_create(
+                [CurrencyOwner(owner=u, currency=currencies[rnd.choices(names, weights)[0]], current=True)
+                 for u in users], batch_size=batch_size)
+
+            # few users have many debtors, most have a handful
+            Debtor.objects.bulk_create(
+                [Debtor(name=f'debtor {j}', owner=u, is_active=rnd.random() > 0.05)
+                 for u in users for j in range(self.long_tail(rnd, options['debtors']))], batch_size=batch_size)
+            debtor_ids = list(Debtor.objects.filter(owner__in=users).values_list('id', flat=True))
+            transactions_count = 0
+            batch = []
+            today = date.today()
+            for debtor_id in debtor_ids:
+                for _ in range(self.long_tail(rnd, options['transactions'])):
+                    amount = round(rnd.lognormvariate(6, 1.2), 2)
+                    days_ago = int(rnd.expovariate(1 / 180))
+                    batch.append(Transaction(debtor_id=debtor_id, date=today - timedelta(days=days_ago),
+                                             sum=amount if rnd.random() < 0.55 else -amount,
+                                             comment=rnd.choice(COMMENTS), is_active=rnd.random() > 0.03))
+                if len(batch) >= batch_size:
+                    Transaction.objects.bulk_create(batch, batch_size=batch_size)
+                    transactions_count += len(batch)
+                    batch = []
+            Transaction.objects.bulk_create(batch, batch_size=batch_size)
+            transactions_count += len(batch)
+            record_snapshot([u.id for u in users], router.db_for_write(Debtor), batch_size)
+        self.stdout.write(f'seeded {len(users)} users, {len(debtor_ids)} debtors, '
+                          f'{transactions_count} transactions; tokens {get_token(prefix, 0)}..'
+                          f'{get_token(prefix, len(users) - 1)}')
+
+    def long_tail(self, rnd, mean):
+        """
+        Integer from a lognormal distribution with the given mean, at least 1
+        """
+        sigma = 1.0
+        return max(1, int(rnd.lognormvariate(0, sigma) * mean / math.exp(sigma ** 2 / 2)))
+
+    def clear(self, prefix):
+        users = User.objects.filter(username__startswith=prefix, username__endswith='@example.com')
+        Transaction.objects.filter(debtor__owner__in=users).delete()
+        Debtor.objects.filter(owner__in=users).delete()
+        ChangeJournal.objects.filter(owner__in=users).delete()
+        users.delete()
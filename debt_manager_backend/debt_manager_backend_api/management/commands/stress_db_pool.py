@@ -0,0 +1,61 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management import BaseCommand, CommandError
+from django.db import connections
+from debt_manager_backend_api.db.pool import PoolTimeout
+from debt_manager_backend_api.models import Debtor
+from .benchmark_api import percentile
+
+
+class Command(BaseCommand):
+    help = 'Check out connections of a database from many threads at once, like concurrent requests do, ' \
+           'and report checkout latency percentiles, timeouts and pool size as json'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default')
+        parser.add_argument('--threads', type=int, default=20, help='more threads than POOL MAX_SIZE make them wait')
+        parser.add_argument('--iterations', type=int, default=100, help='checkouts per thread')
+        parser.add_argument('--hold', type=float, default=0.005, help='seconds a connection is held after the query')
+
+    def handle(self, *args, **options):
+        alias = options['database']
+        if alias not in connections:
+            raise CommandError(f'unknown database {alias}')
+
+        def worker(_):
+            latencies, timeouts = [], 0
+            connection = connections[alias]
+            for _ in range(options['iterations']):
+                start = time.perf_counter()
+                try:
+                    connection.ensure_connection()
+                except PoolTimeout:
+                    timeouts += 1
+                    continue
+                latencies.append(time.perf_counter() - start)
+                Debtor.objects.using(alias).exists()
+                time.sleep(options['hold'])
+                # the end of a request
+                connection.close()
+            return latencies, timeouts, getattr(connection, '_pool', None)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(options['threads']) as executor:
+            results = list(executor.map(worker, range(options['threads'])))
+        elapsed = time.perf_counter() - start
+        latencies = sorted(latency for thread_latencies, _, _ in results for latency in thread_latencies)
+        # None unless the database uses the pooling backend
+        pool = next((pool for _, _, pool in results if pool is not None), None)
+        report = {
+            'config': {key: options[key] for key in ['database', 'threads', 'iterations', 'hold']},
+            'checkouts': len(latencies),
+            'timeouts': sum(timeouts for _, timeouts, _ in results),
+            'checkout_p50_ms': percentile(latencies, 50) * 1e3 if latencies else None,
+            'checkout_p99_ms': percentile(latencies, 99) * 1e3 if latencies else None,
+            'checkout_max_ms': latencies[-1] * 1e3 if latencies else None,
+            'throughput_per_s': len(latencies) / elapsed,
+            'pool_size': pool.size if pool is not None else None,
+            'pool_idle': pool.idle if pool is not None else None,
+        }
+        self.stdout.write(json.dumps(report, indent=2))
@@ -0,0 +1,40 @@
+from django.db import migrations, models
+
+
+COMMENT_SEARCH_INDEX = 'transaction_comment_search_idx'
+
+
+def create_comment_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    table = apps.get_model('debt_manager_backend_api', 'Transaction')._meta.db_table
+    schema_editor.execute(
+        f"CREATE INDEX {COMMENT_SEARCH_INDEX} ON {schema_editor.quote_name(table)} "
+        f"USING gin (to_tsvector('simple'::regconfig, COALESCE(comment, '')))"
+    )
+
+
+def drop_comment_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(f'DROP INDEX IF EXISTS {COMMENT_SEARCH_INDEX}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('debt_manager_backend_api', '0002_auto_20200605_1845'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['debtor', 'is_active', 'date'], name='transaction_debtor_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['debtor', 'is_active', 'sum'], name='transaction_debtor_sum_idx'),
+        ),
+        migrations.RunPython(create_comment_search_index, drop_comment_search_index,
+                             hints={'model_name': 'transaction'}),
+    ]
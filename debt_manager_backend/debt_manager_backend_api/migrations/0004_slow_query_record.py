@@ -0,0 +1,28 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('debt_manager_backend_api', '0003_transaction_filter_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SlowQueryRecord',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fingerprint', models.CharField(max_length=40, unique=True)),
+                ('kind', models.CharField(choices=[('slow', 'slow'), ('repeated', 'repeated')], max_length=16)),
+                ('route', models.CharField(max_length=255)),
+                ('sql', models.TextField()),
+                ('params', models.TextField(blank=True)),
+                ('explain', models.TextField(blank=True)),
+                ('max_duration', models.FloatField(default=0)),
+                ('max_repeat', models.IntegerField(default=1)),
+                ('occurrences', models.IntegerField(default=1)),
+                ('first_seen', models.DateTimeField()),
+                ('last_seen', models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
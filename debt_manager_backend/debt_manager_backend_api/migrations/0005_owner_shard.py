@@ -0,0 +1,30 @@
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('debt_manager_backend_api', '0004_slow_query_record'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='debtor',
+            name='owner',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING,
+                                    to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.CreateModel(
+            name='OwnerShard',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shard', models.CharField(max_length=64)),
+                ('moving', models.BooleanField(default=False)),
+                ('owner', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE,
+                                               to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
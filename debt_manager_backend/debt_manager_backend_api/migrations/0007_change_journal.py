@@ -0,0 +1,60 @@
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def backfill_journal(apps, schema_editor):
+    """
+    One journal entry per active debtor and transaction, so syncing from the start returns existing data
+    """
+    Debtor = apps.get_model('debt_manager_backend_api', 'Debtor')
+    Transaction = apps.get_model('debt_manager_backend_api', 'Transaction')
+    ChangeJournal = apps.get_model('debt_manager_backend_api', 'ChangeJournal')
+    qn = schema_editor.quote_name
+    journal, debtor, tr = (qn(m._meta.db_table) for m in [ChangeJournal, Debtor, Transaction])
+    now = django.utils.timezone.now()
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(f"INSERT INTO {journal} (owner_id, model, object_id, created_at) "
+                       f"SELECT owner_id, 'debtor', id, %s FROM {debtor} WHERE is_active ORDER BY id", [now])
+        cursor.execute(f"INSERT INTO {journal} (owner_id, model, object_id, created_at) "
+                       f"SELECT d.owner_id, 'transaction', t.id, %s FROM {tr} t JOIN {debtor} d ON d.id = t.debtor_id "
+                       f"WHERE t.is_active AND d.is_active ORDER BY t.id", [now])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('debt_manager_backend_api', '0006_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='debtor',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.CreateModel(
+            name='ChangeJournal',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('model', models.CharField(choices=[('debtor', 'debtor'), ('transaction', 'transaction')],
+                                           max_length=16)),
+                ('object_id', models.IntegerField()),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('owner', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING,
+                                            related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='changejournal',
+            index=models.Index(fields=['owner', 'id'], name='changejournal_owner_id_idx'),
+        ),
+        migrations.RunPython(backfill_journal, migrations.RunPython.noop, hints={'model_name': 'changejournal'}),
+    ]
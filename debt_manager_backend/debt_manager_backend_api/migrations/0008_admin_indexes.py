@@ -0,0 +1,27 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('debt_manager_backend_api', '0007_change_journal'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='debtor',
+            index=models.Index(fields=['name'], name='debtor_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['date'], name='transaction_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='uniqemailuser',
+            index=models.Index(fields=['username'], name='user_username_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='uniqemailuser',
+            index=models.Index(fields=['email'], name='user_email_idx'),
+        ),
+    ]
@@ -0,0 +1,15 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('debt_manager_backend_api', '0008_admin_indexes'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='slowqueryrecord',
+            name='params',
+        ),
+    ]
@@ -2,6 +2,8 @@ from django.db import models
 from django.conf import settings
 from datetime import date
 from django.contrib.auth.models import AbstractUser
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
 
 
 # Create your models here.
@@ -10,6 +12,13 @@ class UniqEmailUser(AbstractUser):
     email = models.EmailField()
     username = models.CharField(max_length=150)
 
+    class Meta(AbstractUser.Meta):
+        # admin search and registration checks look users up by these
+        indexes = [
+            models.Index(fields=['username'], name='user_username_idx'),
+            models.Index(fields=['email'], name='user_email_idx'),
+        ]
+
 
 class Currency(models.Model):
     name = models.CharField(max_length=255, unique=True)
@@ -24,8 +33,13 @@ class CurrencyOwner(models.Model):
 
 class Debtor(models.Model):
     name = models.CharField(max_length=255)
-    owner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.DO_NOTHING)
+    # debtors may live in a shard database without the user table
+    owner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.DO_NOTHING, db_constraint=False)
     is_active = models.BooleanField(default=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['name'], name='debtor_name_idx')]
 
 
 class Transaction(models.Model):
@@ -34,3 +48,75 @@ class Transaction(models.Model):
     comment = models.TextField(blank=True)
     debtor = models.ForeignKey(Debtor, on_delete=models.DO_NOTHING)
     is_active = models.BooleanField(default=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        # full text index over comment is created in migration 0003 (postgresql only)
+        indexes = [
+            models.Index(fields=['debtor', 'is_active', 'date'], name='transaction_debtor_date_idx'),
+            models.Index(fields=['debtor', 'is_active', 'sum'], name='transaction_debtor_sum_idx'),
+            # admin date filter over all owners
+            models.Index(fields=['date'], name='transaction_date_idx'),
+        ]
+
+
+class SlowQueryRecord(models.Model):
+    """
+    Slow or repeated query found by SlowQueryMiddleware, aggregated per route and normalized sql
+    """
+    KINDS = [('slow', 'slow'), ('repeated', 'repeated')]
+
+    fingerprint = models.CharField(max_length=40, unique=True)
+    kind = models.CharField(max_length=16, choices=KINDS)
+    route = models.CharField(max_length=255)
+    sql = models.TextField()
+    explain = models.TextField(blank=True)
+    max_duration = models.FloatField(default=0)
+    max_repeat = models.IntegerField(default=1)
+    occurrences = models.IntegerField(default=1)
+    first_seen = models.DateTimeField()
+    last_seen = models.DateTimeField(db_index=True)
+
+
+class OwnerShard(models.Model):
+    """
+    Shard database of the owner debtors and transactions, owners without a row are in the default database
+    """
+    owner = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    shard = models.CharField(max_length=64)
+    moving = models.BooleanField(default=False)
+
+
+class IdempotencyKey(models.Model):
+    """
+    First response to a mutating request sent with an Idempotency-Key header, replayed for retries of the request.
+    status_code is null while the first request runs.
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    key = models.CharField(max_length=255)
+    fingerprint = models.CharField(max_length=40)
+    status_code = models.IntegerField(null=True)
+    response = models.JSONField(null=True, encoder=DjangoJSONEncoder)
+    created_at = models.DateTimeField()
+
+    class Meta:
+        unique_together = [('user', 'key')]
+        indexes = [models.Index(fields=['user', 'created_at'], name='idempotency_user_created_idx')]
+
+
+class ChangeJournal(models.Model):
+    """
+    Append-only log of debtor and transaction writes of an owner, the id is the sync cursor.
+    Stored on the shard of the owner next to the changed rows.
+    """
+    MODELS = [('debtor', 'debtor'), ('transaction', 'transaction')]
+
+    id = models.BigAutoField(primary_key=True)
+    owner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.DO_NOTHING, db_constraint=False,
+                              related_name='+')
+    model = models.CharField(max_length=16, choices=MODELS)
+    object_id = models.IntegerField()
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [models.Index(fields=['owner', 'id'], name='changejournal_owner_id_idx')]
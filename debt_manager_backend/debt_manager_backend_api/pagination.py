@@ -1,17 +1,125 @@
+import hashlib
 import logging
-from django.db.models import Sum
+from django.conf import settings
+from django.core.cache import cache
+from django.core.paginator import EmptyPage, Page, PageNotAnInteger, Paginator
+from django.db.models import Count, Sum
+from django.utils.encoding import force_str
 from rest_framework import pagination
+from rest_framework.exceptions import NotFound
+from rest_framework.compat import coreapi, coreschema
 from rest_framework.response import Response
 from .models import Transaction, CurrencyOwner
+from .serializers import get_fieldset, is_requested
+from .instrumentation import track_phase
+from .coalesce import single_flight
 from rest_framework import serializers
 
 lh = logging.getLogger('django')
 
 
+class CountedPaginator(Paginator):
+    """
+    Paginator with the count computed by the caller
+    """
+
+    def __init__(self, object_list, per_page, count, **kwargs):
+        super().__init__(object_list, per_page, **kwargs)
+        self.count = count
+
+
+class CountlessPage(Page):
+
+    def __init__(self, object_list, number, paginator, has_more):
+        super().__init__(object_list, number, paginator)
+        self.has_more = has_more
+
+    def has_next(self):
+        return self.has_more
+
+    def next_page_number(self):
+        return self.number + 1
+
+    def previous_page_number(self):
+        return self.number - 1
+
+
+class CountlessPaginator(Paginator):
+    """
+    Pages without COUNT(*), one extra row is fetched to know if there is a next page
+    """
+
+    def validate_number(self, number):
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger('That page number is not an integer')
+        if number < 1:
+            raise EmptyPage('That page number is less than 1')
+        return number
+
+    def page(self, number):
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        rows = list(self.object_list[bottom:bottom + self.per_page + 1])
+        if not rows and number > 1:
+            raise EmptyPage('That page contains no results')
+        return CountlessPage(rows[:self.per_page], number, self, len(rows) > self.per_page)
+
+    @property
+    def num_pages(self):
+        # only used for the browsable api page controls
+        return 1
+
+
 class PagiantionWithBalance(pagination.PageNumberPagination):
     page_size_query_param = 'size'
+    count_query_param = 'count'
+    fields_query_description = 'Comma separated list of fields to return, applies to results and page properties'
+    omit_query_description = 'Comma separated list of fields to skip, applies to results and page properties'
+    count_query_description = 'false - skip counting, count is null and next is known from one extra row'
+
+    @track_phase('paginate')
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.view = view
+        if request.query_params.get(self.count_query_param, '').lower() in ('false', '0'):
+            if request.query_params.get(self.page_query_param) in self.last_page_strings:
+                raise NotFound('The last page is not known without count.')
+            self.django_paginator_class = CountlessPaginator
+        else:
+            count = self.get_count(queryset) if self.get_page_size(request) else None
+            self.django_paginator_class = lambda object_list, per_page: \
+                CountedPaginator(object_list, per_page, count)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_count(self, queryset):
+        return self.get_aggregate(queryset, count=Count('id'))['count']
+
+    def get_aggregate(self, queryset, **aggregates):
+        """
+        queryset.aggregate(**aggregates), cached until the owner data changes when the view knows the data version
+        """
+        # values('pk') drops row annotations like debtor balances, otherwise computed for every row in a subquery
+        queryset = queryset.order_by().values('pk')
+        version = getattr(self.view, 'data_version', None)
+        if version is None:
+            return queryset.aggregate(**aggregates)
+        sql, params = queryset.query.sql_with_params()
+        key = f'{self.request.user.id} {version} {sorted(aggregates.items())} {sql} {params}'
+        return cache.get_or_set(f'page-aggregate:{hashlib.sha1(key.encode()).hexdigest()}',
+                                lambda: queryset.aggregate(**aggregates), settings.PAGE_AGGREGATE_CACHE_TIMEOUT)
 
+    def get_count_value(self):
+        return self.page.paginator.count if self.page.paginator is not None \
+            and not isinstance(self.page.paginator, CountlessPaginator) else None
+
+    @track_phase('currency')
     def get_current_currency(self):
+        # read by ConditionalGetMixin for the ETag
+        currency = getattr(self.view, 'data_state', None)
+        if currency is not None:
+            return currency
         user = self.request.user
         try:
             currency = CurrencyOwner.objects.get(owner=user, current=True).currency
@@ -23,47 +131,108 @@ class PagiantionWithBalance(pagination.PageNumberPagination):
     def get_total_balance(self):
         pass
 
+    def get_requested_props(self, props):
+        """
+        Compute only page properties requested with ?fields= and ?omit=
+        """
+        fieldset = get_fieldset(self.request)
+        return {name: getter() for name, getter in props.items() if is_requested(name, fieldset)}
+
+    def get_schema_fields(self, view):
+        fields = super().get_schema_fields(view)
+        fields += [
+            coreapi.Field(name='fields', required=False, location='query',
+                          schema=coreschema.String(description=force_str(self.fields_query_description))),
+            coreapi.Field(name='omit', required=False, location='query',
+                          schema=coreschema.String(description=force_str(self.omit_query_description))),
+            coreapi.Field(name=self.count_query_param, required=False, location='query',
+                          schema=coreschema.Boolean(description=force_str(self.count_query_description))),
+        ]
+        return fields
+
+
+def balance_flight_key(pagination):
+    """
+    Single flight key of the owner balances, none when the view does not know the data version
+    """
+    version = getattr(pagination.view, 'data_version', None)
+    if version is None:
+        return None
+    debtor_id = pagination.request.parser_context['kwargs'].get('debtor_pk')
+    return f'{pagination.request.user.id} {version} {debtor_id}'
+
 
 class DebtorPagination(PagiantionWithBalance):
 
     def get_paginated_response(self, data):
-        tb = self.get_total_balance()
-        currency = self.get_current_currency()
         return Response({
             'next': self.get_next_link(),
             'previous': self.get_previous_link(),
-            'count': self.page.paginator.count,
-            'total_balance': tb,
-            'currency': currency,
+            'count': self.get_count_value(),
+            **self.get_requested_props({
+                'total_balance': self.get_total_balance,
+                'currency': self.get_current_currency,
+            }),
             'results': data
         })
 
+    @track_phase('total_balance')
+    @single_flight(balance_flight_key)
     def get_total_balance(self):
         user = self.request.user
-        balance = Transaction.objects.filter(is_active=True, debtor__owner=user).aggregate(Sum('sum'))
-        return balance['sum__sum']
+        return self.get_aggregate(Transaction.objects.filter(is_active=True, debtor__owner=user),
+                                  balance=Sum('sum'))['balance']
 
 
 class TransactionPagination(PagiantionWithBalance):
 
     def get_paginated_response(self, data):
-        tb = self.get_total_balance()
-        currency = self.get_current_currency()
-        debtor = self.get_debtor()
+        props = {
+            'total_balance': self.get_total_balance,
+            'currency': self.get_current_currency,
+            'debtor_props': self.get_debtor,
+        }
+        if self.request.parser_context.get('transaction_filters'):
+            props['filtered_balance'] = self.get_filtered_balance
         return Response({
             'next': self.get_next_link(),
             'previous': self.get_previous_link(),
-            'count': self.page.paginator.count,
-            'total_balance': tb,
-            'currency': currency,
-            'debtor_props': debtor,
+            'count': self.get_count_value(),
+            **self.get_requested_props(props),
             'results': data
         })
 
+    def paginate_queryset(self, queryset, request, view=None):
+        self.queryset = queryset
+        self.balances = {}
+        return super().paginate_queryset(queryset, request, view)
+
+    def is_filtered(self):
+        return bool(self.request.parser_context.get('transaction_filters'))
+
+    def get_count(self, queryset):
+        # the balance of the listed transactions comes with the count in one query
+        aggregate = self.get_aggregate(queryset, count=Count('id'), balance=Sum('sum'))
+        self.balances['filtered' if self.is_filtered() else 'total'] = aggregate['balance']
+        return aggregate['count']
+
+    @track_phase('total_balance')
     def get_total_balance(self):
+        if 'total' not in self.balances:
+            self.balances['total'] = self.get_debtor_balance()
+        return self.balances['total']
+
+    @single_flight(balance_flight_key)
+    def get_debtor_balance(self):
         debtor_id = self.request.parser_context['kwargs']['debtor_pk']
-        balance = Transaction.objects.filter(is_active=True, debtor=debtor_id).aggregate(Sum('sum'))
-        return balance['sum__sum']
+        return self.get_aggregate(Transaction.objects.filter(is_active=True, debtor=debtor_id),
+                                  balance=Sum('sum'))['balance']
+
+    @track_phase('filtered_balance')
+    def get_filtered_balance(self):
+        if 'filtered' not in self.balances:
+            self.balances['filtered'] = self.get_aggregate(self.queryset, balance=Sum('sum'))['balance']
+        return self.balances['filtered']
 
     def get_debtor(self):
         debtor = self.request.parser_context['debtor']
@@ -0,0 +1,113 @@
+import cProfile
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from datetime import datetime
+from django.conf import settings
+from .instrumentation import QueryRecorder
+
+lh = logging.getLogger('django')
+CAPTURE_ID_RE = r'[0-9]{14}-[0-9a-f]{8}'
+profiling_slots = threading.BoundedSemaphore(settings.PROFILE_MAX_CONCURRENT)
+
+
+class RequestProfiler:
+    """
+    Deterministic profile and SQL capture of one request, stored in PROFILE_DIR
+    """
+
+    def __init__(self, request):
+        self.request = request
+        self.capture_id = f'{datetime.now().strftime("%Y%m%d%H%M%S")}-{uuid.uuid4().hex[:8]}'
+        self.profile = cProfile.Profile()
+        self.queries = QueryRecorder(capture_sql=True)
+        self.start_time = None
+
+    @classmethod
+    def is_requested(cls, request):
+        return bool(request.META.get('HTTP_X_PROFILE') or request.query_params.get('profile'))
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        self.queries.__enter__()
+        self.profile.enable()
+
+    def stop(self, response):
+        self.profile.disable()
+        self.queries.__exit__(None, None, None)
+        duration = time.perf_counter() - self.start_time
+        os.makedirs(settings.PROFILE_DIR, exist_ok=True)
+        self.profile.dump_stats(get_capture_path(self.capture_id, 'prof'))
+        meta = {
+            'id': self.capture_id,
+            'method': self.request.method,
+            'path': self.request.get_full_path(),
+            'user': self.request.user.username,
+            'status': response.status_code,
+            'duration': duration,
+            'query_count': self.queries.count,
+            'query_duration': self.queries.duration,
+            'queries': [{k: v for k, v in q.items() if k != 'params'} for q in self.queries.queries],
+        }
+        with open(get_capture_path(self.capture_id, 'json'), 'w') as f:
+            json.dump(meta, f)
+        remove_old_captures()
+
+
+class ProfilingMixin:
+    """
+    Profile the request with ?profile=1 or X-Profile header, allowed only for staff users.
+    At most PROFILE_MAX_CONCURRENT requests are profiled at the same time in a process.
+    """
+
+    def initial(self, request, *args, **kwargs):
+        self.profiler = None
+        super().initial(request, *args, **kwargs)
+        if not RequestProfiler.is_requested(request) or not request.user.is_staff:
+            return
+        if not profiling_slots.acquire(blocking=False):
+            lh.warning('profiling skipped: too many concurrent profiled requests')
+            return
+        self.profiler = RequestProfiler(request)
+        self.profiler.start()
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        profiler = getattr(self, 'profiler', None)
+        if profiler is None:
+            return response
+        try:
+            profiler.stop(response)
+        finally:
+            self.profiler = None
+            profiling_slots.release()
+        response['X-Profile-Id'] = profiler.capture_id
+        return response
+
+
+def get_capture_path(capture_id, ext):
+    if not re.fullmatch(CAPTURE_ID_RE, capture_id):
+        raise ValueError(f'wrong capture id: {capture_id}')
+    return os.path.join(settings.PROFILE_DIR, f'{capture_id}.{ext}')
+
+
+def list_captures():
+    try:
+        names = os.listdir(settings.PROFILE_DIR)
+    except FileNotFoundError:
+        return []
+    return sorted((n[:-5] for n in names if n.endswith('.json') and re.fullmatch(CAPTURE_ID_RE, n[:-5])),
+                  reverse=True)
+
+
+def remove_old_captures():
+    for capture_id in list_captures()[settings.PROFILE_MAX_CAPTURES:]:
+        for ext in ['prof', 'json']:
+            try:
+                os.remove(get_capture_path(capture_id, ext))
+            except FileNotFoundError:
+                pass
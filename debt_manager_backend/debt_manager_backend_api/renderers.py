@@ -0,0 +1,49 @@
+from rest_framework import renderers
+from rest_framework.utils import encoders
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class FastJSONRenderer(renderers.JSONRenderer):
+    """
+    JSONRenderer encoding with orjson, types unknown to orjson are encoded like in JSONRenderer.
+    Falls back to JSONRenderer for indented or ascii output and data orjson can not encode.
+    """
+    if orjson is not None:
+        options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if orjson is None or self.ensure_ascii or not self.compact or \
+                self.get_indent(accepted_media_type, renderer_context or {}) is not None:
+            return super().render(data, accepted_media_type, renderer_context)
+        try:
+            ret = orjson.dumps(data, default=self.encoder_class().default, option=self.options)
+        except TypeError:
+            return super().render(data, accepted_media_type, renderer_context)
+        if b'\xe2\x80\xa8' in ret or b'\xe2\x80\xa9' in ret:
+            ret = ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+        return ret
+
+
+class MessagePackRenderer(renderers.BaseRenderer):
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+    encoder_class = encoders.JSONEncoder
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        assert msgpack is not None, 'msgpack must be installed to use MessagePackRenderer'
+        if data is None:
+            return b''
+        return msgpack.packb(data, default=self.encoder_class().default, use_bin_type=True)
@@ -0,0 +1,107 @@
+import hashlib
+import os
+import tempfile
+from django.conf import settings
+from .swagger import get_code_version
+
+
+class ReportCache:
+    """
+    Generated report files on local disk, bounded by REPORT_CACHE_MAX_BYTES with least recently used eviction,
+    disabled when it is 0. Keys contain the ledger version, so a write makes the stored reports of the owner
+    unreachable; they are removed when the debtor report is stored again or evicted.
+    The directory may be shared by the worker processes, the modification time of a file is its last use.
+    """
+
+    @property
+    def enabled(self):
+        return settings.REPORT_CACHE_MAX_BYTES > 0
+
+    @property
+    def directory(self):
+        return settings.REPORT_CACHE_DIR
+
+    @staticmethod
+    def get_key(debtor_id, ext, version, currency):
+        # the layout may change with the code
+        key = f'{get_code_version()} {debtor_id} {ext} {version} {currency}'
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def get_path(self, debtor_id, ext, key):
+        return os.path.join(self.directory, f'{debtor_id}-{key}.{ext}')
+
+    def get(self, debtor_id, ext, key):
+        """
+        Path of the stored report or None
+        """
+        path = self.get_path(debtor_id, ext, key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def set(self, debtor_id, ext, key, content):
+        """
+        Store the report, replacing older reports of the debtor, and return its path
+        """
+        if len(content) > settings.REPORT_CACHE_MAX_BYTES:
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.get_path(debtor_id, ext, key)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with open(fd, 'wb') as f:
+                f.write(content)
+            # mkstemp files are private, reports are also read by nginx from a shared volume
+            os.chmod(tmp_path, 0o644)
+            # readers never see a partially written file
+            os.replace(tmp_path, path)
+        except OSError:
+            os.remove(tmp_path)
+            raise
+        self.invalidate(debtor_id, keep=path)
+        self.evict()
+        return path
+
+    def invalidate(self, debtor_id, keep=None):
+        for entry in self.scan():
+            if entry.name.startswith(f'{debtor_id}-') and entry.path != keep:
+                self.remove(entry.path)
+
+    def evict(self):
+        entries = []
+        for entry in self.scan():
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= settings.REPORT_CACHE_MAX_BYTES:
+                break
+            self.remove(path)
+            total -= size
+
+    def scan(self):
+        try:
+            with os.scandir(self.directory) as entries:
+                return [entry for entry in entries if entry.is_file() and not entry.name.endswith('.tmp')]
+        except FileNotFoundError:
+            return []
+
+    @staticmethod
+    def remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # removed by another worker
+            pass
+
+    def clear(self):
+        for entry in self.scan():
+            self.remove(entry.path)
+
+
+report_cache = ReportCache()
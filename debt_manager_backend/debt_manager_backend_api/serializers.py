@@ -2,16 +2,111 @@ import logging
 from django.core.exceptions import ValidationError
 from rest_framework import serializers
 from .models import Debtor, Transaction, Currency, CurrencyOwner
-from django.db.models import Sum
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import Sum, Subquery, OuterRef
 from django.contrib.auth import get_user_model
 from django.contrib.auth.password_validation import validate_password
+from django.conf import settings
 from django.db import transaction
+from .db.sharding import assign_owner_shard
 
 lh = logging.getLogger('django')
 User = get_user_model()
 
 
-class DebtorSerializer(serializers.HyperlinkedModelSerializer):
+def get_fieldset(request):
+    """
+    Parse ?fields= and ?omit= query params into (fields, omit) name sets, fields is None if not limited
+    """
+    fields = request.query_params.get('fields')
+    omit = request.query_params.get('omit')
+    fields = {f.strip() for f in fields.split(',') if f.strip()} if fields else None
+    omit = {f.strip() for f in omit.split(',') if f.strip()} if omit else set()
+    return fields, omit
+
+
+def is_requested(name, fieldset):
+    fields, omit = fieldset
+    return (fields is None or name in fields) and name not in omit
+
+
+class SparseFieldsetMixin:
+    """
+    Drop serializer fields which are not requested with ?fields= or ?omit= on read requests
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        request = self.context.get('request')
+        if request is None or request.method != 'GET':
+            return
+        fieldset = get_fieldset(request)
+        for name in list(self.fields):
+            if not is_requested(name, fieldset):
+                self.fields.pop(name)
+
+    @classmethod
+    def get_deferred_fields(cls, request):
+        """
+        Model fields which could be excluded from the select query
+        """
+        fieldset = get_fieldset(request)
+        model_fields = {f.name for f in cls.Meta.model._meta.concrete_fields if not f.primary_key}
+        return [name for name in cls.Meta.fields if name in model_fields and not is_requested(name, fieldset)]
+
+
+class ValuesRowMapper:
+    """
+    Fast read path renderer of queryset.values() rows, gives the same output as the serializer class.
+    Field converters are built once per serializer class and requested fieldset.
+    SerializerMethodField values are taken from the serializer get_values_annotations() query annotations.
+    """
+    _mappers = {}
+
+    def __init__(self, serializer_class, names):
+        self.annotations = {}
+        self.converters = []
+        annotations = getattr(serializer_class, 'get_values_annotations', dict)()
+        for name, field in serializer_class().fields.items():
+            if field.write_only or name not in names:
+                continue
+            if isinstance(field, serializers.SerializerMethodField):
+                self.annotations[name] = annotations[name]
+                self.converters.append((name, name, None))
+            elif '.' in field.source or field.source == '*':
+                raise ImproperlyConfigured(f'{serializer_class.__name__}.{name}: nested source is not supported')
+            else:
+                self.converters.append((name, field.source, field.to_representation))
+
+    @classmethod
+    def for_fields(cls, serializer_class, names):
+        key = (serializer_class, tuple(names))
+        if key not in cls._mappers:
+            cls._mappers[key] = cls(*key)
+        return cls._mappers[key]
+
+    @classmethod
+    def for_request(cls, serializer_class, request):
+        fieldset = get_fieldset(request)
+        return cls.for_fields(serializer_class,
+                              [name for name in serializer_class.Meta.fields if is_requested(name, fieldset)])
+
+    def get_values(self, queryset):
+        return queryset.annotate(**self.annotations).values(*[source for _, source, _ in self.converters])
+
+    def to_representation(self, rows):
+        converters = self.converters
+        data = []
+        for row in rows:
+            item = {}
+            for name, source, convert in converters:
+                value = row[source]
+                item[name] = value if value is None or convert is None else convert(value)
+            data.append(item)
+        return data
+
+
+class DebtorSerializer(SparseFieldsetMixin, serializers.HyperlinkedModelSerializer):
     balance = serializers.SerializerMethodField()
 
     class Meta:
@@ -22,13 +117,19 @@ class DebtorSerializer(serializers.HyperlinkedModelSerializer):
         balance = Transaction.objects.filter(is_active=True, debtor=obj.id).aggregate(Sum('sum'))
         return balance['sum__sum']
 
+    @classmethod
+    def get_values_annotations(cls):
+        balance = Transaction.objects.filter(is_active=True, debtor=OuterRef('pk')).order_by()\
+            .values('debtor').annotate(balance=Sum('sum')).values('balance')
+        return {'balance': Subquery(balance)}
+
     def create(self, validated_data):
         user = self.context['request'].user
         name = validated_data['name']
         return Debtor.objects.create(name=name, owner=user)
 
 
-class TransactionSerializer(serializers.HyperlinkedModelSerializer):
+class TransactionSerializer(SparseFieldsetMixin, serializers.HyperlinkedModelSerializer):
     class Meta:
         model = Transaction
         fields = ['id', 'date', 'sum', 'comment']
@@ -44,6 +145,95 @@ class TransactionSerializer(serializers.HyperlinkedModelSerializer):
         return Transaction.objects.create(**validated_data)
 
 
+class DebtorSyncSerializer(DebtorSerializer):
+    class Meta(DebtorSerializer.Meta):
+        fields = ['id', 'name', 'balance', 'updated_at']
+
+
+class TransactionSyncSerializer(TransactionSerializer):
+    debtor = serializers.IntegerField(source='debtor_id', read_only=True)
+
+    class Meta(TransactionSerializer.Meta):
+        fields = ['id', 'debtor', 'date', 'sum', 'comment', 'updated_at']
+
+
+class SyncQuerySerializer(serializers.Serializer):
+    since = serializers.RegexField(r'^([\w-]+:)?\d+$', default='0',
+                                   help_text='cursor of the previous sync, <shard>:<journal id>')
+    size = serializers.IntegerField(min_value=1, max_value=1000, default=500)
+
+    def validate_since(self, value):
+        """
+        (shard, journal id), shard is None for plain ids
+        """
+        shard, _, journal_id = value.rpartition(':')
+        return shard or None, int(journal_id)
+
+
+class BatchRequestSerializer(serializers.Serializer):
+    method = serializers.ChoiceField(choices=['GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE'], default='GET')
+    path = serializers.RegexField(r'^/', max_length=2048, help_text='Path with query string, e.g. /api/v1/debtor/')
+    headers = serializers.DictField(child=serializers.CharField(), default=dict)
+    body = serializers.JSONField(required=False, allow_null=True, default=None)
+
+
+class BatchResponseSerializer(serializers.Serializer):
+    status = serializers.IntegerField()
+    headers = serializers.DictField(child=serializers.CharField())
+    body = serializers.JSONField(allow_null=True)
+
+
+class DebtorNameSerializer(serializers.Serializer):
+    id = serializers.IntegerField()
+    name = serializers.CharField(max_length=255)
+
+
+class DebtorBulkSerializer(serializers.Serializer):
+    """
+    merge: ids are merged into target, rename: names lists new names, delete: ids are deleted
+    """
+    operation = serializers.ChoiceField(choices=['merge', 'rename', 'delete'])
+    ids = serializers.ListField(child=serializers.IntegerField(), required=False,
+                                max_length=settings.DEBTOR_BULK_MAX_IDS)
+    target = serializers.IntegerField(required=False)
+    names = serializers.ListField(child=DebtorNameSerializer(), required=False,
+                                  max_length=settings.DEBTOR_BULK_MAX_IDS)
+
+    def validate(self, data):
+        required = {'merge': ['ids', 'target'], 'rename': ['names'], 'delete': ['ids']}[data['operation']]
+        missing = [name for name in required if not data.get(name)]
+        if missing:
+            raise serializers.ValidationError({name: 'This field is required.' for name in missing})
+        if 'ids' in required:
+            data['ids'] = list(dict.fromkeys(data['ids']))
+        if data['operation'] == 'merge' and data['target'] in data['ids']:
+            raise serializers.ValidationError({'target': 'The target is merged into itself.'})
+        if data['operation'] == 'rename':
+            data['names'] = {item['id']: item['name'] for item in data['names']}
+        return data
+
+
+class DebtorBulkResponseSerializer(serializers.Serializer):
+    debtors = DebtorSerializer(many=True)
+    total_balance = serializers.FloatField(allow_null=True)
+
+
+class TransactionFilterSerializer(serializers.Serializer):
+    date_from = serializers.DateField(required=False)
+    date_to = serializers.DateField(required=False)
+    min_sum = serializers.FloatField(required=False)
+    max_sum = serializers.FloatField(required=False)
+    sign = serializers.ChoiceField(choices=['lent', 'borrowed'], required=False)
+    search = serializers.CharField(required=False)
+
+    def validate(self, data):
+        if 'date_from' in data and 'date_to' in data and data['date_from'] > data['date_to']:
+            raise serializers.ValidationError('date_from is later than date_to')
+        if 'min_sum' in data and 'max_sum' in data and data['min_sum'] > data['max_sum']:
+            raise serializers.ValidationError('min_sum is greater than max_sum')
+        return data
+
+
 class CurrencyRelatedField(serializers.RelatedField):
 
     def get_attribute(self, instance):
@@ -99,6 +289,7 @@ class UserRegistrationSerializer(serializers.HyperlinkedModelSerializer):
             new_currency, created = Currency.objects.update_or_create(name=currency, defaults={'is_active': True})
             new_currency_owner = CurrencyOwner.objects.create(currency=new_currency, owner=user, current=True)
             new_currency_owner.save()
+            assign_owner_shard(user.id)
         return user
 
 
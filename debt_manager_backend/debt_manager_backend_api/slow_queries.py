@@ -0,0 +1,113 @@
+import hashlib
+import json
+import logging
+import re
+from collections import Counter
+from django.conf import settings
+from django.db import DatabaseError, connections, transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.utils import timezone
+from .instrumentation import QueryRecorder, current_route
+
+lh = logging.getLogger('django')
+
+IN_LIST_RE = re.compile(r'IN \((?:%s, )*%s\)')
+SPACES_RE = re.compile(r'\s+')
+
+
+def normalize_sql(sql):
+    """
+    Parameters are passed separately, so queries differ only by IN list length and whitespace
+    """
+    return IN_LIST_RE.sub('IN (...)', SPACES_RE.sub(' ', sql).strip())
+
+
+def analyze_queries(queries):
+    """
+    Return queries over SLOW_QUERY_THRESHOLD, slowest first,
+    and normalized statements executed at least SLOW_QUERY_REPEAT_THRESHOLD times with their count
+    """
+    slow = sorted((q for q in queries if q['duration'] >= settings.SLOW_QUERY_THRESHOLD),
+                  key=lambda q: q['duration'], reverse=True)
+    counts = Counter(normalize_sql(q['sql']) for q in queries)
+    repeated = [(sql, count) for sql, count in counts.most_common() if count >= settings.SLOW_QUERY_REPEAT_THRESHOLD]
+    return slow, repeated
+
+
+def explain(query):
+    """
+    Plan of a captured SELECT without executing it, None when the database refuses.
+    The parameters are bound only for the EXPLAIN, text parameters echoed in the plan are masked.
+    """
+    if query['many'] or not query['sql'].lstrip().upper().startswith('SELECT'):
+        return None
+    connection = connections[query['alias']]
+    try:
+        with transaction.atomic(using=query['alias']), connection.cursor() as cursor:
+            cursor.execute(f'{connection.ops.explain_query_prefix()} {query["sql"]}', query['params'])
+            plan = '\n'.join(' '.join(str(col) for col in row) for row in cursor.fetchall())
+    except DatabaseError as e:
+        plan = f'explain failed: {e}'
+    for param in query['params'] or ():
+        if isinstance(param, str) and param:
+            plan = plan.replace(param, '...')
+    return plan
+
+
+def save_record(kind, route, sql, duration=0.0, repeat=1, plan=None):
+    from .models import SlowQueryRecord
+    fingerprint = hashlib.sha1(f'{kind}\0{route}\0{sql}'.encode()).hexdigest()
+    now = timezone.now()
+    changes = {'occurrences': F('occurrences') + 1, 'last_seen': now,
+               'max_duration': Greatest('max_duration', duration), 'max_repeat': Greatest('max_repeat', repeat)}
+    if plan is not None:
+        changes['explain'] = plan
+    if not SlowQueryRecord.objects.filter(fingerprint=fingerprint).update(**changes):
+        SlowQueryRecord.objects.get_or_create(fingerprint=fingerprint, defaults={
+            'kind': kind, 'route': route, 'sql': sql, 'explain': plan or '',
+            'max_duration': duration, 'max_repeat': repeat, 'first_seen': now, 'last_seen': now})
+
+
+class SlowQueryMiddleware:
+    """
+    Flag slow and repeated (N+1) queries of a request, explain the slowest SELECTs.
+    Findings go to the log as json and are aggregated in SlowQueryRecord for the admin.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with QueryRecorder(capture_sql=True) as recorder:
+            response = self.get_response(request)
+        slow, repeated = analyze_queries(recorder.queries)
+        if slow or repeated:
+            try:
+                self.report(request, response, recorder, slow, repeated)
+            except DatabaseError:
+                lh.exception('slow query report failed')
+        return response
+
+    def report(self, request, response, recorder, slow, repeated):
+        route = current_route.get() or 'unresolved'
+        explained = slow[:settings.SLOW_QUERY_EXPLAIN_LIMIT]
+        plans = [explain(q) for q in explained]
+        slow_rows = [{'sql': normalize_sql(q['sql']), 'duration': q['duration'], 'explain': plan}
+                     for q, plan in zip(explained, plans)]
+        slow_rows += [{'sql': normalize_sql(q['sql']), 'duration': q['duration']} for q in slow[len(explained):]]
+        lh.warning(json.dumps({
+            'event': 'slow_queries',
+            'route': route,
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'query_count': recorder.count,
+            'query_duration': recorder.duration,
+            'slow': slow_rows,
+            'repeated': [{'sql': sql, 'count': count} for sql, count in repeated],
+        }))
+        for q, plan in zip(explained, plans):
+            save_record('slow', route, normalize_sql(q['sql']), duration=q['duration'], plan=plan)
+        for sql, count in repeated:
+            save_record('repeated', route, sql, repeat=count)
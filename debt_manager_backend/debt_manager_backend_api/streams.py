@@ -0,0 +1,142 @@
+import asyncio
+import json
+import re
+from urllib.parse import parse_qs
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import close_old_connections
+from oauth2_provider.models import AccessToken
+from .events import broker, get_backend
+from .journal import get_owner_version
+
+
+def get_owner_id(token):
+    """
+    Owner of a valid access token with read scope, or None
+    """
+    try:
+        access_token = AccessToken.objects.select_related('user').get(token=token)
+    except AccessToken.DoesNotExist:
+        return None
+    if not access_token.is_valid(['read']) or not access_token.user.is_active:
+        return None
+    return access_token.user_id
+
+
+def format_event(event):
+    data = json.dumps(event, cls=DjangoJSONEncoder)
+    return f'id: {event["version"]}\nevent: {event["type"]}\ndata: {data}\n\n'.encode()
+
+
+class EventStreamApp:
+    """
+    ASGI app streaming ledger change events of the token owner as server-sent events.
+    EventSource can not send headers, so the token is also accepted as access_token query parameter.
+    An idle stream is a coroutine waiting on its queue, with a keepalive comment every EVENT_STREAM_KEEPALIVE
+    seconds. Clients reconnecting with Last-Event-ID behind the current owner version get a reset event
+    and reload their data.
+    """
+
+    def __init__(self):
+        self.started = False
+
+    async def __call__(self, scope, receive, send):
+        headers = {name.decode('latin1').lower(): value.decode('latin1') for name, value in scope['headers']}
+        query = parse_qs(scope['query_string'].decode())
+        response_headers = self.get_cors_headers(headers.get('origin'))
+        if scope['method'] != 'GET':
+            await self.send_error(send, 405, response_headers + [(b'allow', b'GET')])
+            return
+        authorization = headers.get('authorization', '')
+        token = authorization[7:] if authorization.startswith('Bearer ') else query.get('access_token', [None])[0]
+        last_event_id = headers.get('last-event-id') or query.get('last_event_id', [None])[0]
+        owner_id = await sync_to_async(self.query)(get_owner_id, token) if token else None
+        if owner_id is None:
+            await self.send_error(send, 401, response_headers + [(b'www-authenticate', b'Bearer')])
+            return
+        if not self.started:
+            self.started = True
+            get_backend().start()
+        # subscribed before the version is read, events committed in between are queued
+        subscription = broker.subscribe(owner_id)
+        disconnect = asyncio.ensure_future(self.wait_disconnect(receive))
+        try:
+            version = await sync_to_async(self.query)(get_owner_version, owner_id) \
+                if last_event_id is not None else None
+            await send({'type': 'http.response.start', 'status': 200, 'headers': response_headers + [
+                (b'content-type', b'text/event-stream'),
+                (b'cache-control', b'no-cache'),
+                # nginx must not buffer the stream
+                (b'x-accel-buffering', b'no'),
+            ]})
+            preamble = f'retry: {settings.EVENT_STREAM_RETRY}\n\n'
+            if last_event_id is not None and last_event_id != str(version):
+                preamble += f'id: {version}\nevent: reset\ndata: {{}}\n\n'
+            await send({'type': 'http.response.body', 'body': preamble.encode(), 'more_body': True})
+            await self.stream(subscription, disconnect, send)
+        finally:
+            broker.unsubscribe(subscription)
+            disconnect.cancel()
+
+    async def stream(self, subscription, disconnect, send):
+        while True:
+            event = asyncio.ensure_future(subscription.queue.get())
+            done, _ = await asyncio.wait({event, disconnect}, timeout=settings.EVENT_STREAM_KEEPALIVE,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if event not in done:
+                event.cancel()
+                if disconnect in done:
+                    return
+                await send({'type': 'http.response.body', 'body': b': keepalive\n\n', 'more_body': True})
+            elif event.result() is None:
+                await send({'type': 'http.response.body', 'body': b''})
+                return
+            else:
+                await send({'type': 'http.response.body', 'body': format_event(event.result()), 'more_body': True})
+
+    @staticmethod
+    async def wait_disconnect(receive):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    @staticmethod
+    def query(func, *args):
+        """
+        Database access of the stream, in a worker thread
+        """
+        close_old_connections()
+        try:
+            return func(*args)
+        finally:
+            close_old_connections()
+
+    @staticmethod
+    def get_cors_headers(origin):
+        # the stream is served outside of Django middleware
+        if origin and any(re.match(pattern, origin) for pattern in settings.CORS_ORIGIN_REGEX_WHITELIST):
+            return [(b'access-control-allow-origin', origin.encode('latin1')),
+                    (b'access-control-allow-credentials', b'true'),
+                    (b'vary', b'Origin')]
+        return []
+
+    @staticmethod
+    async def send_error(send, status, headers):
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': b''})
+
+
+class EventStreamRouter:
+    """
+    Serves EVENT_STREAM_PATH with EventStreamApp and everything else with the Django application
+    """
+
+    def __init__(self, application):
+        self.application = application
+        self.event_stream = EventStreamApp()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http' and scope['path'] == settings.EVENT_STREAM_PATH:
+            await self.event_stream(scope, receive, send)
+        else:
+            await self.application(scope, receive, send)
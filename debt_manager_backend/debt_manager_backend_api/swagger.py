@@ -1,9 +1,98 @@
+import hashlib
+import os
+from django.conf import settings
+from django.http import HttpResponse
+from django.shortcuts import redirect
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition, require_GET
+from drf_yasg import openapi
+from drf_yasg.app_settings import swagger_settings
+from drf_yasg.codecs import OpenAPICodecJson
 from drf_yasg.inspectors import SwaggerAutoSchema
 
+api_info = openapi.Info(
+    title="Debt manager API",
+    default_version='v1',
+    contact=openapi.Contact(email="klasd4000@gmail.com"),
+    license=openapi.License(name="BSD License"),
+)
+
 
 class SwaggerAutoSchemaWithoutParam(SwaggerAutoSchema):
 
     def get_query_parameters(self):
         params = super().get_query_parameters()
         params = [p for p in params if p.name not in self.overrides['extra_overrides']['exluded_params']]
-        return params
\ No newline at end of file
+        return params
+
+
+def get_code_version():
+    """
+    CODE_VERSION setting or a hash of the project python sources
+    """
+    if settings.CODE_VERSION:
+        return settings.CODE_VERSION
+    if not hasattr(get_code_version, 'source_hash'):
+        source_hash = hashlib.sha1()
+        for root, dirs, files in os.walk(settings.BASE_DIR):
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.') and d not in ('logs', 'asserts'))
+            for name in sorted(f for f in files if f.endswith('.py')):
+                with open(os.path.join(root, name), 'rb') as f:
+                    source_hash.update(f.read())
+        get_code_version.source_hash = source_hash.hexdigest()[:12]
+    return get_code_version.source_hash
+
+
+class PrecomputedSchema:
+    """
+    OpenAPI schema generated once per code version, stored in SCHEMA_ROOT and kept in memory
+    """
+
+    def __init__(self):
+        self.version = None
+        self.content = None
+        self.etag = None
+
+    def get_path(self, version):
+        return os.path.join(settings.SCHEMA_ROOT, f'openapi-{version}.json')
+
+    def generate(self, version=None):
+        version = version or get_code_version()
+        generator = swagger_settings.DEFAULT_GENERATOR_CLASS(api_info)
+        content = OpenAPICodecJson(validators=[]).encode(generator.get_schema(request=None, public=True))
+        os.makedirs(settings.SCHEMA_ROOT, exist_ok=True)
+        tmp_path = f'{self.get_path(version)}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, self.get_path(version))
+        return content
+
+    def load(self):
+        version = get_code_version()
+        if self.version != version:
+            try:
+                with open(self.get_path(version), 'rb') as f:
+                    content = f.read()
+            except FileNotFoundError:
+                content = self.generate(version)
+            self.content = content
+            self.etag = f'"{hashlib.sha1(content).hexdigest()}"'
+            self.version = version
+        return self
+
+
+precomputed_schema = PrecomputedSchema()
+
+
+@require_GET
+@condition(etag_func=lambda request, version=None: precomputed_schema.load().etag)
+def schema_json(request, version=None):
+    schema = precomputed_schema.load()
+    if version is not None and version != schema.version:
+        return redirect('schema-json-versioned', version=schema.version)
+    response = HttpResponse(schema.content, content_type='application/json')
+    if version is None:
+        patch_cache_control(response, public=True, no_cache=True)
+    else:
+        patch_cache_control(response, public=True, max_age=settings.SCHEMA_CACHE_MAX_AGE, immutable=True)
+    return response
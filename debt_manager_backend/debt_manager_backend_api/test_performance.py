@@ -0,0 +1,199 @@
+import re
+import time
+from unittest import skipIf
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core import mail
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from oauth2_provider.models import AccessToken
+from rest_framework import status
+from rest_framework.reverse import reverse
+from .models import Currency, CurrencyOwner, Debtor, Transaction
+from .tests import ApiUserTestClient
+
+User = get_user_model()
+
+SIZES = [10, 1000, 100000]
+# findings of the slow query detector are saved inside the request and would be counted
+no_slow_query_detector = override_settings(SLOW_QUERY_THRESHOLD=float('inf'), SLOW_QUERY_REPEAT_THRESHOLD=10 ** 9)
+# queries are counted on the default database only
+single_database = skipIf(len(settings.SHARD_DATABASES) > 1, 'query budgets are measured without DATABASE_SHARDS')
+
+
+@single_database
+@no_slow_query_detector
+class QueryBudgetTestCase(ApiUserTestClient):
+    """
+    Every endpoint must run the same number of queries whatever the amount of owner data,
+    paginated endpoints must also stay far from linear time growth.
+    For each size an owner with that many debtors is seeded, the first debtor has that many transactions.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        currency = Currency.objects.get(name='руб')
+        cls.owners = {}
+        for size in SIZES:
+            owner = User.objects.create(username=f'budget{size}@test.com', email=f'budget{size}@test.com')
+            CurrencyOwner.objects.create(currency=currency, owner=owner, current=True)
+            Debtor.objects.bulk_create([Debtor(name=f'debtor {i}', owner=owner) for i in range(size)], batch_size=1000)
+            debtors = list(Debtor.objects.filter(owner=owner).order_by('id').values_list('id', flat=True))
+            Transaction.objects.bulk_create(
+                [Transaction(date=f'2020-{i % 12 + 1:02}-{i % 28 + 1:02}', sum=i % 17 - 8 or 1,
+                             comment=f'comment {i}', debtor_id=debtors[0]) for i in range(size)],
+                batch_size=1000)
+            Transaction.objects.bulk_create([Transaction(sum=1, debtor_id=d) for d in debtors[1:]], batch_size=1000)
+            tr_id = Transaction.objects.filter(debtor_id=debtors[0]).order_by('id').values_list('id', flat=True)[0]
+            cls.owners[size] = (owner, debtors[0], tr_id)
+
+    def login_owner(self, owner):
+        token, _ = AccessToken.objects.get_or_create(
+            token=f'budget-token-{owner.id}',
+            defaults={'user': owner, 'scope': 'read write', 'application': self.application,
+                      'expires': timezone.now() + timezone.timedelta(seconds=300)})
+        self.client.credentials(Authorization=f'Bearer {token.token}')
+
+    def measure(self, request, repeat=1):
+        """
+        Return response, query count and the best time of repeat runs of request()
+        """
+        best = None
+        for _ in range(repeat):
+            with CaptureQueriesContext(connection) as queries:
+                start = time.perf_counter()
+                response = request()
+                elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return response, len(queries), best
+
+    def assertBudget(self, budget, make_request, expected_status=status.HTTP_200_OK, repeat=1, max_growth=None):
+        """
+        make_request(debtor_id, tr_id) is run for every size, query count must not exceed budget and must be
+        the same for all sizes. With max_growth time for the largest size must be below max_growth times the
+        time for the smallest one.
+        """
+        counts, durations = [], []
+        for size in SIZES:
+            owner, debtor_id, tr_id = self.owners[size]
+            self.login_owner(owner)
+            response, count, duration = self.measure(lambda: make_request(debtor_id, tr_id), repeat)
+            self.assertEqual(response.status_code, expected_status, f'size {size}')
+            counts.append(count)
+            durations.append(duration)
+        self.assertLessEqual(max(counts), budget, f'query counts per size {dict(zip(SIZES, counts))}')
+        self.assertEqual(len(set(counts)), 1, f'query counts per size {dict(zip(SIZES, counts))}')
+        if max_growth is not None:
+            self.assertLess(durations[-1], durations[0] * max_growth,
+                            f'durations per size {dict(zip(SIZES, durations))}')
+
+    def test_debtor_list(self):
+        self.assertBudget(5, lambda debtor_id, tr_id: self.client.get(reverse('debtor-list')),
+                          repeat=3, max_growth=100)
+
+    def test_debtor_retrieve(self):
+        self.assertBudget(5, lambda debtor_id, tr_id: self.client.get(reverse('debtor-detail', args=(debtor_id,))))
+
+    def test_debtor_create(self):
+        self.assertBudget(4, lambda debtor_id, tr_id: self.client.post(reverse('debtor-list'), {'name': 'new'}),
+                          expected_status=status.HTTP_201_CREATED)
+
+    def test_debtor_update(self):
+        self.assertBudget(6, lambda debtor_id, tr_id: self.client.put(reverse('debtor-detail', args=(debtor_id,)),
+                                                                      {'name': 'renamed'}))
+
+    def test_debtor_delete(self):
+        self.assertBudget(6, lambda debtor_id, tr_id: self.client.delete(reverse('debtor-detail', args=(debtor_id,))),
+                          expected_status=status.HTTP_204_NO_CONTENT)
+
+    def test_transaction_list(self):
+        self.assertBudget(7, lambda debtor_id, tr_id: self.client.get(reverse('debtor-transaction-list',
+                                                                              args=(debtor_id,))),
+                          repeat=3, max_growth=100)
+
+    def test_transaction_list_without_count(self):
+        # no aggregate query at all
+        self.assertBudget(7, lambda debtor_id, tr_id: self.client.get(
+            reverse('debtor-transaction-list', args=(debtor_id,)), {'count': 'false', 'omit': 'total_balance'}),
+                          max_growth=100)
+
+    def test_transaction_list_filtered(self):
+        self.assertBudget(7, lambda debtor_id, tr_id: self.client.get(
+            reverse('debtor-transaction-list', args=(debtor_id,)), {'date_from': '2020-06-01', 'sign': 'lent'}),
+                          repeat=3, max_growth=100)
+
+    def test_transaction_create(self):
+        self.assertBudget(6, lambda debtor_id, tr_id: self.client.post(
+            reverse('debtor-transaction-list', args=(debtor_id,)), {'sum': 5, 'comment': 'new'}),
+                          expected_status=status.HTTP_201_CREATED)
+
+    def test_transaction_update(self):
+        self.assertBudget(6, lambda debtor_id, tr_id: self.client.put(
+            reverse('debtor-transaction-detail', args=(debtor_id, tr_id)),
+            {'sum': 7, 'date': '2020-01-01', 'comment': 'updated'}))
+
+    def test_transaction_delete(self):
+        self.assertBudget(6, lambda debtor_id, tr_id: self.client.delete(
+            reverse('debtor-transaction-detail', args=(debtor_id, tr_id))),
+                          expected_status=status.HTTP_204_NO_CONTENT)
+
+    def test_report(self):
+        # report contains every transaction, so only the query count is fixed
+        self.assertBudget(10, lambda debtor_id, tr_id: self.client.get(
+            reverse('debtor-report', args=(debtor_id,)), {'extension': 'xlsx'}))
+
+    def test_cached_report(self):
+        self.test_report()
+        # the stored file is sent, no transaction is read
+        self.assertBudget(5, lambda debtor_id, tr_id: self.client.get(reverse('debtor-report', args=(debtor_id,)),
+                                                                      {'extension': 'xlsx'}), max_growth=100)
+
+
+@single_database
+@no_slow_query_detector
+class RegistrationQueryBudgetTestCase(ApiUserTestClient):
+    """
+    Registration and activation query counts must not depend on the number of pending registrations
+    with the same email. Duplicates are deleted on activation in batches, so sizes stay below the sqlite
+    batch size of 999 parameters.
+    """
+    DUPLICATES = [1, 10, 100]
+
+    def setUp(self):
+        self.client.credentials()
+
+    def register(self, email):
+        data = {"username": email, "first_name": "test", "last_name": "test", "email": email,
+                "password1": "SlojniyParol123", "password2": "SlojniyParol123", "currency": "dollars"}
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('user-list'), data)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return len(queries)
+
+    def test_registration_activation_budget(self):
+        register_counts, activate_counts = [], []
+        for duplicates in self.DUPLICATES:
+            email = f'pending{duplicates}@test.com'
+            Currency.objects.get_or_create(name='dollars')
+            currency = Currency.objects.create(name=f'pending currency {duplicates}')
+            User.objects.bulk_create([User(username=f'{email}{i}', email=email, is_active=False)
+                                      for i in range(duplicates)])
+            pending = User.objects.filter(email=email)
+            CurrencyOwner.objects.bulk_create([CurrencyOwner(currency=currency, owner=u, current=True)
+                                               for u in pending])
+            mail.outbox.clear()
+            register_counts.append(self.register(email))
+            link = re.search(r'http://testserver(/api/v1/user/activate/\S+/)', mail.outbox[0].body).group(1)
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(link)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            activate_counts.append(len(queries))
+            self.assertEqual(User.objects.filter(email=email).count(), 1)
+            self.assertFalse(Currency.objects.get(id=currency.id).is_active)
+        self.assertLessEqual(max(register_counts), 14, register_counts)
+        self.assertEqual(len(set(register_counts)), 1, register_counts)
+        self.assertLessEqual(max(activate_counts), 18, activate_counts)
+        self.assertEqual(len(set(activate_counts)), 1, activate_counts)
@@ -1,28 +1,82 @@
+import asyncio
+import base64
+import hashlib
 import json
 from django.contrib.auth import get_user_model
-from rest_framework.test import APITestCase, APIClient
+from rest_framework.test import APITestCase, APIClient, APIRequestFactory
+from rest_framework.request import Request
+from rest_framework.renderers import JSONRenderer
 from oauth2_provider.models import AccessToken, Application
 from django.utils import timezone
-from .models import Currency, Debtor, Transaction, CurrencyOwner
+from django.utils.http import http_date
+from .models import Currency, Debtor, Transaction, CurrencyOwner, SlowQueryRecord, OwnerShard, IdempotencyKey, \
+    ChangeJournal
 from rest_framework.reverse import reverse
 from rest_framework import status
+from rest_framework.response import Response
 import shutil
-from io import BytesIO
+from io import BytesIO, StringIO
 import mimetypes
 import os
 from django.conf import settings
 import xlrd
 from django.core import mail
 import re
+import datetime
+import decimal
+import uuid
+from unittest import mock, skipIf
+from rest_framework.exceptions import ErrorDetail
 from .views import RecaptchaAPIView
+from .management.commands.benchmark_api import Command as BenchmarkCommand
+from .renderers import FastJSONRenderer, MessagePackRenderer, orjson, msgpack
+from .serializers import DebtorSerializer, TransactionSerializer, ValuesRowMapper
+from .swagger import precomputed_schema
+from .slow_queries import analyze_queries, normalize_sql
+from .log import JSONFormatter, QueueListenerHandler
+from .conditional import response_cache
+from .report_cache import ReportCache
+from .db.routers import ReplicaRouter, ReplicaStickinessMiddleware, STICKY_COOKIE, use_primary
+from .db.sharding import ShardRouter, use_shard, get_owner_shard, lock_owner_writes
+from .db.pool import ConnectionPool, PoolTimeout
+from .coalesce import get_flight_cache, run_single_flight, single_flight
+from .events import PostgresNotifyBackend, broker, publish_bulk_change
+from .journal import get_owner_version
+from .streams import EventStreamRouter
+import threading
+from django.test import SimpleTestCase, RequestFactory, TransactionTestCase
+from asgiref.sync import async_to_sync, sync_to_async
+from asgiref.testing import ApplicationCommunicator
+from django.http import HttpResponse
+import time
+import logging
 from django.core import management
-from django.db import connection
+from django.test import override_settings
+from django.core.exceptions import ImproperlyConfigured
+import tempfile
+import pstats
+from django.db import connection, router, transaction
+from django.test.utils import CaptureQueriesContext
+from django.core.cache import cache
 
 User = get_user_model()
 
 
 # Create your tests here.
 
+def use_temp_cache_dir(test_case):
+    """
+    File caches of the test in a temporary directory instead of BASE_DIR/cache, like LOG_DIR in logs_test
+    """
+    cache_dir = tempfile.mkdtemp()
+    test_case.addCleanup(shutil.rmtree, cache_dir)
+    coalesce = {**settings.CACHES['coalesce'], 'LOCATION': os.path.join(cache_dir, 'coalesce')}
+    settings_override = override_settings(CACHE_DIR=cache_dir, REPORT_CACHE_DIR=os.path.join(cache_dir, 'reports'),
+                                          CACHES={**settings.CACHES, 'coalesce': coalesce})
+    settings_override.enable()
+    test_case.addCleanup(settings_override.disable)
+
+
 class ApiUserTestClient(APITestCase):
     """
     Helper base class for API test
@@ -124,6 +178,10 @@ class ApiUserTestClient(APITestCase):
         }
 
     def setUp(self):
+        # cached page aggregates and single flight results are keyed by journal ids, which are reused after
+        # test rollbacks
+        cache.clear()
+        use_temp_cache_dir(self)
         self.login()
 
     def tearDown(self):
@@ -231,6 +289,31 @@ class DebtorViewSetTestCase(ApiUserTestClient):
             ]
         }
 
+        self.list_debtors_page_1_id_name = {
+            "next": "http://testserver/api/v1/debtor/?fields=id%2Cname&page=2&size=1",
+            "previous": None,
+            "count": 3,
+            "results": [
+                {
+                    "id": 1,
+                    "name": "test1"
+                }
+            ]
+        }
+
+        self.list_debtors_page_1_without_balance = {
+            "next": "http://testserver/api/v1/debtor/?omit=balance%2Ccurrency&page=2&size=1",
+            "previous": None,
+            "count": 3,
+            "total_balance": 2.0,
+            "results": [
+                {
+                    "id": 1,
+                    "name": "test1"
+                }
+            ]
+        }
+
         self.debtor_searched_result = [
             {
                 "id": 1,
@@ -345,6 +428,15 @@ class DebtorViewSetTestCase(ApiUserTestClient):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(response.data['results'], self.debtor_searched_result)
 
+    def test_get_debtor_list_sparse_fieldset(self):
+        response = self.client.get(reverse('debtor-list'), {'page': 1, 'size': 1, 'fields': 'id,name'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, self.list_debtors_page_1_id_name)
+
+        response = self.client.get(reverse('debtor-list'), {'page': 1, 'size': 1, 'omit': 'balance,currency'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, self.list_debtors_page_1_without_balance)
+
     def test_get_debtor_list_active_currency_not_set(self):
         CurrencyOwner.objects.filter(current=True).update(current=False)
         response = self.client.get(reverse('debtor-list'), {'page': 1, 'size': 1})
@@ -416,7 +508,8 @@ class DebtorViewSetTestCase(ApiUserTestClient):
     def test_report_xlsx(self):
         response = self.client.get(reverse('debtor-report', args=(1,)), {'extension': 'xlsx'})
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        byte_obj = BytesIO(response.content)
+        # streamed when the report is stored
+        byte_obj = BytesIO(response.getvalue())
 
         ext = mimetypes.guess_extension(response._headers['content-type'][1])
         with open(os.path.join(settings.BASE_DIR, 'test_temp', f'response{ext}'), 'wb') as f:
@@ -528,6 +621,51 @@ class TransactionViewSetTestCase(ApiUserTestClient):
             ]
         }
 
+        self.transaction_list_lent = {
+            "next": None,
+            "previous": None,
+            "count": 1,
+            "total_balance": 1.0,
+            "currency": "руб",
+            "debtor_props": {
+                "name": "test1"
+            },
+            "filtered_balance": 4.0,
+            "results": [
+                {
+                    "id": 2,
+                    "date": "2020-03-03",
+                    "sum": 4.0,
+                    "comment": "c2"
+                }
+            ]
+        }
+
+        self.transaction_list_without_comment = {
+            "next": None,
+            "previous": None,
+            "count": 2,
+            "total_balance": 1.0,
+            "results": [
+                {
+                    "id": 1,
+                    "date": "2020-03-03",
+                    "sum": -3.0
+                },
+                {
+                    "id": 2,
+                    "date": "2020-03-03",
+                    "sum": 4.0
+                }
+            ]
+        }
+
+        self.wrong_date_range_error = {
+            "non_field_errors": [
+                "date_from is later than date_to"
+            ]
+        }
+
     def test_get_transaction_list(self):
         response = self.client.get(reverse('debtor-transaction-list', args=(1,)), {'page': 1, 'size': 2})
         self.assertEqual(response.status_code, status.HTTP_200_OK)
@@ -537,6 +675,36 @@ class TransactionViewSetTestCase(ApiUserTestClient):
         self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
         self.assertEqual(response.data, self.deleted_debtor)
 
+    def test_get_transaction_list_filters(self):
+        response = self.client.get(reverse('debtor-transaction-list', args=(1,)), {'sign': 'lent'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, self.transaction_list_lent)
+
+        response = self.client.get(reverse('debtor-transaction-list', args=(1,)), {'min_sum': 0, 'max_sum': 10})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, self.transaction_list_lent)
+
+        response = self.client.get(reverse('debtor-transaction-list', args=(1,)), {'search': 'c1'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([tr['id'] for tr in response.data['results']], [1])
+        self.assertEqual(response.data['filtered_balance'], -3.0)
+
+        response = self.client.get(reverse('debtor-transaction-list', args=(1,)), {'date_from': '2020-03-04'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['results'], [])
+        self.assertEqual(response.data['filtered_balance'], None)
+
+        response = self.client.get(reverse('debtor-transaction-list', args=(1,)),
+                                   {'date_from': '2020-03-04', 'date_to': '2020-03-03'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data, self.wrong_date_range_error)
+
+    def test_get_transaction_list_sparse_fieldset(self):
+        response = self.client.get(reverse('debtor-transaction-list', args=(1,)),
+                                   {'omit': 'comment,currency,debtor_props'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, self.transaction_list_without_comment)
+
     def test_create_transaction(self):
         response = self.client.post(reverse('debtor-transaction-list', args=(1,)), self.new_transaction)
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
@@ -584,6 +752,1422 @@ class TransactionViewSetTestCase(ApiUserTestClient):
         self.assertEqual(response.data, self.zero_sum_error)
 
 
+class IdempotencyTestCase(ApiUserTestClient):
+
+    def post_transaction(self, key, data=None, debtor_id=1):
+        return self.client.post(reverse('debtor-transaction-list', args=(debtor_id,)),
+                                data or {'sum': 5, 'comment': 'retried'}, HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_replay(self):
+        first = self.post_transaction('key-1')
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        with CaptureQueriesContext(connection) as queries:
+            second = self.post_transaction('key-1')
+        self.assertEqual(second.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertFalse([q for q in queries if Transaction._meta.db_table in q['sql']])
+        self.assertEqual(Transaction.objects.filter(comment='retried').count(), 1)
+
+        self.assertEqual(self.post_transaction('key-2').status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Transaction.objects.filter(comment='retried').count(), 2)
+
+    def test_delete_replay(self):
+        url = reverse('debtor-detail', args=(1,))
+        self.assertEqual(self.client.delete(url, HTTP_IDEMPOTENCY_KEY='delete').status_code,
+                         status.HTTP_204_NO_CONTENT)
+        response = self.client.delete(url, HTTP_IDEMPOTENCY_KEY='delete')
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(response['Idempotent-Replayed'], 'true')
+        self.assertEqual(self.client.delete(url).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_key_reused_for_other_request(self):
+        self.post_transaction('key')
+        response = self.post_transaction('key', {'sum': 6})
+        self.assertEqual(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+        self.assertEqual(response.data['detail'].code, 'idempotency_key_mismatch')
+
+    def test_failed_request_runs_again(self):
+        self.assertEqual(self.post_transaction('key', debtor_id=3).status_code, status.HTTP_403_FORBIDDEN)
+        self.assertIsNone(IdempotencyKey.objects.get(key='key').status_code)
+        response = self.post_transaction('key', debtor_id=3)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertNotIn('Idempotent-Replayed', response)
+
+    def test_expired_key(self):
+        self.post_transaction('key')
+        IdempotencyKey.objects.update(created_at=timezone.now() - settings.IDEMPOTENCY_KEY_TTL * 2)
+        response = self.post_transaction('key')
+        self.assertNotIn('Idempotent-Replayed', response)
+        self.assertEqual(Transaction.objects.filter(comment='retried').count(), 2)
+        self.assertEqual(IdempotencyKey.objects.count(), 1)
+
+    def test_invalid_key(self):
+        response = self.post_transaction('k' * 256)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class SyncTestCase(ApiUserTestClient):
+
+    def sync(self, since=None, **params):
+        if since is not None:
+            params['since'] = since
+        response = self.client.get(reverse('sync'), params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def test_changes_since_cursor(self):
+        # fixture rows are created without the api and are not journaled
+        data = self.sync()
+        self.assertEqual((data['cursor'], data['has_more'], data['reset']), ('default:0', False, False))
+
+        debtor_id = self.client.post(reverse('debtor-list'), {'name': 'new'}).data['id']
+        tr_url = reverse('debtor-transaction-list', args=(debtor_id,))
+        tr_id = self.client.post(tr_url, {'sum': 5, 'comment': 'first'}).data['id']
+        self.client.put(reverse('debtor-transaction-detail', args=(debtor_id, tr_id)), {'sum': 7, 'comment': 'x'})
+        data = self.sync()
+        self.assertEqual([d['id'] for d in data['debtors']], [debtor_id])
+        self.assertEqual(data['debtors'][0]['balance'], 7)
+        self.assertEqual(len(data['transactions']), 1)
+        self.assertEqual(data['transactions'][0]['debtor'], debtor_id)
+        self.assertEqual(data['transactions'][0]['sum'], 7)
+        self.assertIn('updated_at', data['transactions'][0])
+        self.assertEqual(data['deleted'], {'debtors': [], 'transactions': []})
+        cursor = data['cursor']
+
+        self.assertEqual(self.sync(cursor)['transactions'], [])
+        self.client.delete(reverse('debtor-transaction-detail', args=(debtor_id, tr_id)))
+        self.client.delete(reverse('debtor-detail', args=(1,)))
+        data = self.sync(cursor)
+        self.assertEqual((data['debtors'], data['transactions']), ([], []))
+        self.assertEqual(data['deleted'], {'debtors': [1], 'transactions': [tr_id]})
+        self.assertEqual(Transaction.objects.get(id=tr_id).is_active, False)
+
+    def test_pages(self):
+        for i in range(5):
+            self.client.post(reverse('debtor-transaction-list', args=(1,)), {'sum': i + 1})
+        data = self.sync(size=2)
+        self.assertTrue(data['has_more'])
+        ids = [t['id'] for t in data['transactions']]
+        while data['has_more']:
+            data = self.sync(data['cursor'], size=2)
+            ids += [t['id'] for t in data['transactions']]
+        self.assertEqual(len(set(ids)), 5)
+
+    def test_only_own_changes(self):
+        self.client.post(reverse('debtor-list'), {'name': 'mine'})
+        ChangeJournal.objects.create(owner_id=2, model='debtor', object_id=4)
+        data = self.sync()
+        self.assertEqual([d['name'] for d in data['debtors']], ['mine'])
+        self.assertEqual(data['deleted']['debtors'], [])
+
+    def test_sparse_fieldset_ignored(self):
+        debtor_id = self.client.post(reverse('debtor-list'), {'name': 'new'}).data['id']
+        self.client.post(reverse('debtor-transaction-list', args=(debtor_id,)), {'sum': 5})
+        for params in [{'omit': 'id'}, {'fields': 'name'}]:
+            data = self.sync(**params)
+            self.assertEqual(set(data['debtors'][0]), {'id', 'name', 'balance', 'updated_at'})
+            self.assertEqual(data['transactions'][0]['debtor'], debtor_id)
+            self.assertEqual(data['deleted'], {'debtors': [], 'transactions': []})
+
+    def test_cursor_of_other_shard(self):
+        data = self.sync('shard9:5')
+        self.assertTrue(data['reset'])
+        self.assertEqual(data['cursor'], 'default:0')
+        with override_settings(SHARD_DATABASES=['default', 'shard9']):
+            # plain ids do not tell the shard
+            self.assertTrue(self.sync(5)['reset'])
+
+    @override_settings(SHARD_DATABASES=['default'])
+    def test_large_journal_ids(self):
+        entry = ChangeJournal.objects.create(id=settings.SHARD_ID_BLOCK * 3, owner_id=1, model='debtor',
+                                             object_id=1)
+        data = self.sync()
+        self.assertEqual(data['cursor'], f'default:{entry.id}')
+        self.assertFalse(self.sync(data['cursor'])['reset'])
+        self.assertFalse(self.sync(entry.id)['reset'])
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse('sync'), {'since': 'x'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class DebtorBulkTestCase(ApiUserTestClient):
+
+    def bulk(self, data, **extra):
+        return self.client.post(reverse('debtor-bulk'), data, format='json', **extra)
+
+    def test_merge(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.bulk({'operation': 'merge', 'ids': [2, 5, 2], 'target': 1})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {'debtors': [{'id': 1, 'name': 'test1', 'balance': 2.0}],
+                                         'total_balance': 2.0})
+        updates = [q for q in queries if q['sql'].startswith('UPDATE') and Transaction._meta.db_table in q['sql']]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(Transaction.objects.get(id=3).debtor_id, 1)
+        self.assertEqual(list(Debtor.objects.filter(owner=1, is_active=True).values_list('id', flat=True)), [1])
+        self.assertEqual(set(ChangeJournal.objects.values_list('model', 'object_id')),
+                         {('debtor', 1), ('debtor', 2), ('debtor', 5), ('transaction', 3)})
+
+    def test_rename(self):
+        response = self.bulk({'operation': 'rename', 'names': [{'id': 2, 'name': 'b'}, {'id': 1, 'name': 'a'}]})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['debtors'], [{'id': 1, 'name': 'a', 'balance': 1.0},
+                                                    {'id': 2, 'name': 'b', 'balance': 1.0}])
+        self.assertEqual(ChangeJournal.objects.filter(model='debtor').count(), 2)
+
+    def test_delete(self):
+        response = self.bulk({'operation': 'delete', 'ids': [1, 2]})
+        self.assertEqual(response.data, {'debtors': [], 'total_balance': None})
+        self.assertFalse(Transaction.objects.filter(debtor__in=[1, 2], is_active=True).exists())
+        self.assertEqual(self.client.get(reverse('debtor-list')).data['count'], 1)
+
+    def test_owner_check(self):
+        for data in [{'operation': 'merge', 'ids': [2], 'target': 4}, {'operation': 'delete', 'ids': [1, 3]},
+                     {'operation': 'rename', 'names': [{'id': 1, 'name': 'a'}, {'id': 4, 'name': 'b'}]}]:
+            self.assertEqual(self.bulk(data).status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEqual(Debtor.objects.get(id=1).name, 'test1')
+        self.assertEqual(Transaction.objects.filter(is_active=True).count(), 4)
+        self.assertFalse(ChangeJournal.objects.exists())
+
+    def test_validation(self):
+        self.assertEqual(set(self.bulk({'operation': 'merge', 'ids': [1, 2], 'target': 1}).data), {'target'})
+        self.assertEqual(set(self.bulk({'operation': 'merge', 'ids': [1]}).data), {'target'})
+        self.assertEqual(set(self.bulk({'operation': 'delete', 'ids': []}).data), {'ids'})
+        self.assertEqual(set(self.bulk({'operation': 'delete', 'ids': list(range(1001))}).data), {'ids'})
+        self.assertEqual(set(self.bulk({'operation': 'split', 'ids': [1]}).data), {'operation'})
+
+    def test_event_payload_size(self):
+        backend = mock.Mock()
+        ids = list(range(10 ** 8, 10 ** 8 + settings.DEBTOR_BULK_MAX_IDS))
+        with mock.patch('debt_manager_backend_api.events.get_backend', return_value=backend):
+            publish_bulk_change(1, Debtor, 'merged', ids, debtor=10 ** 9)
+        _, owner_id, event = backend.publish.call_args[0]
+        self.assertEqual(event['count'], settings.DEBTOR_BULK_MAX_IDS)
+        self.assertLessEqual(len(PostgresNotifyBackend.get_payload(owner_id, event).encode()),
+                             PostgresNotifyBackend.max_payload)
+
+    def test_replay(self):
+        self.assertEqual(self.bulk({'operation': 'delete', 'ids': [2]}, HTTP_IDEMPOTENCY_KEY='bulk').status_code,
+                         status.HTTP_200_OK)
+        response = self.bulk({'operation': 'delete', 'ids': [2]}, HTTP_IDEMPOTENCY_KEY='bulk')
+        self.assertEqual(response['Idempotent-Replayed'], 'true')
+
+
+class AdminTestCase(ApiUserTestClient):
+    # the shard filter counts rows on every shard
+    databases = '__all__'
+
+    def setUp(self):
+        super().setUp()
+        admin_user = User.objects.create(username='admin', email='admin@test.com', is_staff=True, is_superuser=True)
+        self.client.force_login(admin_user)
+
+    @staticmethod
+    def changelist_url(model_name):
+        return reverse(f'admin:debt_manager_backend_api_{model_name}_changelist')
+
+    def test_changelists(self):
+        for model_name in ['debtor', 'transaction', 'currency', 'currencyowner', 'uniqemailuser']:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(self.changelist_url(model_name))
+            self.assertEqual(response.status_code, status.HTTP_200_OK, model_name)
+            cl = response.context['cl']
+            self.assertNotIn('delete_selected', cl.model_admin.get_actions(response.wsgi_request))
+            # one query for the page, no query per row
+            self.assertLess(len(queries), 15, model_name)
+        response = self.client.get(self.changelist_url('transaction'), {'date__year': 2020, 'date__month': 3})
+        self.assertEqual(response.context['cl'].result_count, 4)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(self.changelist_url('transaction'))
+        self.assertFalse([q for q in queries if 'DISTINCT' in q['sql'] or 'MIN(' in q['sql']])
+
+    def test_exact_search(self):
+        response = self.client.get(self.changelist_url('debtor'), {'q': 'test1'})
+        self.assertEqual([d.id for d in response.context['cl'].result_list], [1])
+        response = self.client.get(self.changelist_url('debtor'), {'q': 'test'})
+        self.assertEqual(response.context['cl'].result_count, 0)
+        response = self.client.get(self.changelist_url('transaction'), {'q': '1'})
+        self.assertEqual(sorted(t.id for t in response.context['cl'].result_list), [1, 2])
+        response = self.client.get(self.changelist_url('uniqemailuser'), {'q': 'admin@test.com'})
+        self.assertEqual([u.username for u in response.context['cl'].result_list], ['admin'])
+
+    @override_settings(ESTIMATED_COUNT_THRESHOLD=1000)
+    def test_estimated_count(self):
+        with mock.patch('debt_manager_backend_api.db.estimates.get_row_estimate', return_value=5000000):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(self.changelist_url('transaction'))
+        self.assertEqual(response.context['cl'].result_count, 5000000)
+        self.assertFalse([q for q in queries if 'COUNT(' in q['sql'] and Transaction._meta.db_table in q['sql']])
+        with mock.patch('debt_manager_backend_api.db.estimates.get_row_estimate', return_value=10):
+            response = self.client.get(self.changelist_url('transaction'))
+        self.assertEqual(response.context['cl'].result_count, 4)
+
+    def test_delete_debtors_action(self):
+        response = self.client.post(self.changelist_url('debtor'), {
+            'action': 'delete_selected_debtors', '_selected_action': [1, 2, 3, 4]})
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+        self.assertEqual(list(Debtor.objects.filter(is_active=True).values_list('id', flat=True)), [5])
+        self.assertEqual(Transaction.objects.filter(is_active=True).count(), 0)
+        self.assertEqual(set(ChangeJournal.objects.values_list('owner_id', 'object_id')), {(1, 1), (1, 2), (2, 4)})
+
+    def test_delete_transactions_action(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(self.changelist_url('transaction'), {
+                'action': 'delete_selected_transactions', '_selected_action': [1, 3, 4]})
+        updates = [q for q in queries if q['sql'].startswith('UPDATE') and Transaction._meta.db_table in q['sql']]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(list(Transaction.objects.filter(is_active=True).values_list('id', flat=True)), [2])
+        self.assertEqual(sorted(ChangeJournal.objects.values_list('owner_id', 'model', 'object_id')),
+                         [(1, 'transaction', 1), (1, 'transaction', 3), (2, 'transaction', 4)])
+
+    def test_delete_transactions_events(self):
+        backend = mock.Mock()
+        with mock.patch('debt_manager_backend_api.events.get_backend', return_value=backend):
+            self.client.post(self.changelist_url('transaction'), {
+                'action': 'delete_selected_transactions', '_selected_action': [1, 2, 3, 4]})
+        events = [call[0][2] for call in backend.publish.call_args_list]
+        self.assertEqual(sorted((event['debtor'], event['count']) for event in events), [(1, 2), (2, 1), (4, 1)])
+        self.assertFalse([event for event in events if 'ids' in event])
+
+    def test_change_form_writes(self):
+        version = get_owner_version(1)
+        response = self.client.post(reverse('admin:debt_manager_backend_api_debtor_change', args=(1,)),
+                                    {'name': 'renamed', 'owner': 2, 'is_active': ''})
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+        debtor = Debtor.objects.get(id=1)
+        self.assertEqual((debtor.name, debtor.owner_id, debtor.is_active), ('renamed', 1, True))
+        self.assertGreater(get_owner_version(1), version)
+
+        version = get_owner_version(1)
+        response = self.client.post(reverse('admin:debt_manager_backend_api_transaction_change', args=(1,)),
+                                    {'date': '2020-03-01', 'sum': 7, 'comment': 'changed', 'debtor': 4})
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+        self.assertEqual(Transaction.objects.values_list('sum', 'debtor_id').get(id=1), (7, 1))
+        self.assertGreater(get_owner_version(1), version)
+
+    def test_delete_form_soft_deletes(self):
+        response = self.client.post(reverse('admin:debt_manager_backend_api_transaction_delete', args=(3,)),
+                                    {'post': 'yes'})
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+        self.assertFalse(Transaction.objects.get(id=3).is_active)
+        response = self.client.post(reverse('admin:debt_manager_backend_api_debtor_delete', args=(1,)),
+                                    {'post': 'yes'})
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+        self.assertFalse(Debtor.objects.get(id=1).is_active)
+        self.assertFalse(Transaction.objects.filter(debtor=1, is_active=True).exists())
+        self.assertEqual(sorted(ChangeJournal.objects.values_list('owner_id', 'model', 'object_id')),
+                         [(1, 'debtor', 1), (1, 'transaction', 3)])
+
+    @override_settings(ADMIN_ACTION_MAX_ROWS=1)
+    def test_action_row_limit(self):
+        self.client.post(self.changelist_url('transaction'), {
+            'action': 'delete_selected_transactions', '_selected_action': [1, 2]})
+        self.assertEqual(Transaction.objects.filter(is_active=True).count(), 4)
+
+    def test_user_admin_forms(self):
+        self.assertEqual(self.client.get(reverse('admin:debt_manager_backend_api_uniqemailuser_add')).status_code,
+                         status.HTTP_200_OK)
+        response = self.client.get(reverse('admin:debt_manager_backend_api_uniqemailuser_change', args=(1,)))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class ConditionalGetTestCase(ApiUserTestClient):
+
+    def tearDown(self):
+        super().tearDown()
+        response_cache.clear()
+
+    def test_not_modified(self):
+        url = reverse('debtor-transaction-list', args=(1,))
+        response = self.client.get(url)
+        etag = response['ETag']
+        self.assertIn('no-cache', response['Cache-Control'])
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response.content, b'')
+        ledger_tables = [Debtor._meta.db_table, Transaction._meta.db_table]
+        self.assertFalse([q for q in queries if any(f'"{table}"' in q['sql'] for table in ledger_tables)])
+
+        self.assertNotEqual(self.client.get(url, {'size': 1})['ETag'], etag)
+        self.assertNotEqual(self.client.get(url, HTTP_ACCEPT='application/msgpack')['ETag'], etag)
+
+        self.client.post(url, {'sum': 5})
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.data['count'], 3)
+
+    def test_etag_per_owner(self):
+        etag = self.client.get(reverse('debtor-list'))['ETag']
+        self.assertEqual(self.client.get(reverse('user-current'), HTTP_IF_NONE_MATCH=etag).status_code,
+                         status.HTTP_200_OK)
+        AccessToken.objects.create(user_id=2, scope='read write', token='second-user-token',
+                                   expires=timezone.now() + timezone.timedelta(seconds=300),
+                                   application=self.application)
+        response = self.client.get(reverse('debtor-list'), HTTP_IF_NONE_MATCH=etag,
+                                   HTTP_AUTHORIZATION='Bearer second-user-token')
+        self.assertNotEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_not_journaled_state(self):
+        urls = [reverse('debtor-list'), reverse('debtor-transaction-list', args=(1,)), reverse('user-current')]
+        etags = [self.client.get(url)['ETag'] for url in urls]
+        CurrencyOwner.objects.filter(owner=self.user).update(current=False)
+        CurrencyOwner.objects.create(currency=Currency.objects.create(name='usd'), owner=self.user, current=True)
+        for url, etag in zip(urls, etags):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, status.HTTP_200_OK, url)
+            self.assertEqual(response.data['currency'], 'usd', url)
+
+        etag = self.client.get(urls[2])['ETag']
+        User.objects.filter(id=self.user.id).update(first_name='changed')
+        response = self.client.get(urls[2], HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['first_name'], 'changed')
+
+    @override_settings(RESPONSE_CACHE_MAX_BYTES=100000)
+    def test_response_cache(self):
+        url = reverse('debtor-list')
+        first = self.client.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            second = self.client.get(url)
+        self.assertEqual(second.content, first.content)
+        self.assertEqual(second['Content-Type'], first['Content-Type'])
+        self.assertFalse([q for q in queries if f'"{Debtor._meta.db_table}"' in q['sql']])
+
+        self.client.delete(reverse('debtor-detail', args=(1,)))
+        self.assertNotEqual(self.client.get(url).content, first.content)
+
+
+class ReportCacheTestCase(ApiUserTestClient):
+
+    def setUp(self):
+        super().setUp()
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        settings_override = override_settings(REPORT_CACHE_DIR=self.cache_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.url = reverse('debtor-report', args=(1,))
+
+    def test_cached_report(self):
+        first = self.client.get(self.url, {'extension': 'xlsx'})
+        with CaptureQueriesContext(connection) as queries:
+            second = self.client.get(self.url, {'extension': 'xlsx'})
+        self.assertEqual(second.getvalue(), first.getvalue())
+        self.assertEqual(second['Content-Disposition'], first['Content-Disposition'])
+        self.assertFalse([q for q in queries if f'"{Transaction._meta.db_table}"' in q['sql']])
+
+        self.client.post(reverse('debtor-transaction-list', args=(1,)), {'sum': 5})
+        third = self.client.get(self.url, {'extension': 'xlsx'})
+        self.assertNotEqual(third['ETag'], first['ETag'])
+        self.assertNotEqual(third.getvalue(), first.getvalue())
+        # the report of the previous version is removed
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+
+    def test_not_modified(self):
+        # the fixture data is not journaled
+        self.client.post(reverse('debtor-transaction-list', args=(1,)), {'sum': 5})
+        response = self.client.get(self.url, {'extension': 'xlsx'})
+        self.assertNotIn('Last-Modified', response)
+        not_modified = self.client.get(self.url, {'extension': 'xlsx'}, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(not_modified.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(not_modified['ETag'], response['ETag'])
+
+        CurrencyOwner.objects.filter(owner=self.user).update(current=False)
+        CurrencyOwner.objects.create(currency=Currency.objects.create(name='usd'), owner=self.user, current=True)
+        for headers in [{'HTTP_IF_NONE_MATCH': response['ETag']},
+                        {'HTTP_IF_MODIFIED_SINCE': http_date(time.time() + 60)}]:
+            response = self.client.get(self.url, {'extension': 'xlsx'}, **headers)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    @override_settings(REPORT_DELIVERY='x-accel', REPORT_ACCEL_SECRET='accel-secret')
+    def test_x_accel_delivery(self):
+        for _ in range(2):
+            response = self.client.get(self.url, {'extension': 'xlsx'})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.content, b'')
+            self.assertIn('attachment', response['Content-Disposition'])
+            uri, query = response['X-Accel-Redirect'].split('?')
+            params = dict(param.split('=') for param in query.split('&'))
+            self.assertTrue(uri.startswith('/protected/reports/1-'))
+            self.assertLessEqual(int(params['expires']), time.time() + 60)
+            # as nginx secure_link checks it
+            digest = hashlib.md5(f'{params["expires"]}{uri} accel-secret'.encode()).digest()
+            self.assertEqual(params['md5'], base64.urlsafe_b64encode(digest).decode().rstrip('='))
+            with open(os.path.join(self.cache_dir, uri[len('/protected/reports/'):]), 'rb') as f:
+                self.assertEqual(f.read()[:2], b'PK')
+
+        with override_settings(REPORT_ACCEL_SECRET=None), self.assertRaises(ImproperlyConfigured):
+            self.client.get(self.url, {'extension': 'xlsx'})
+
+    def test_least_recently_used_eviction(self):
+        report_cache = ReportCache()
+        with override_settings(REPORT_CACHE_MAX_BYTES=25):
+            for debtor_id in range(3):
+                report_cache.set(debtor_id, 'xlsx', 'key', b'x' * 10)
+                # distinct modification times
+                time.sleep(0.01)
+            self.assertIsNone(report_cache.get(0, 'xlsx', 'key'))
+            self.assertIsNotNone(report_cache.get(1, 'xlsx', 'key'))
+            time.sleep(0.01)
+            report_cache.set(3, 'xlsx', 'key', b'x' * 10)
+            self.assertIsNotNone(report_cache.get(1, 'xlsx', 'key'))
+            self.assertIsNone(report_cache.get(2, 'xlsx', 'key'))
+            self.assertIsNone(report_cache.set(4, 'xlsx', 'key', b'x' * 30))
+
+
+class PaginationModesTestCase(ApiUserTestClient):
+
+    def test_without_count(self):
+        url = reverse('debtor-transaction-list', args=(1,))
+        response = self.client.get(url, {'count': 'false', 'size': 1})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(list(response.data), list(self.transaction_list))
+        self.assertIsNone(response.data['count'])
+        self.assertEqual(response.data['total_balance'], 1.0)
+        self.assertEqual(response.data['next'],
+                         'http://testserver/api/v1/debtor/1/transaction/?count=false&page=2&size=1')
+        response = self.client.get(url, {'count': 'false', 'size': 1, 'page': 2})
+        self.assertIsNone(response.data['next'])
+        self.assertEqual(response.data['previous'], 'http://testserver/api/v1/debtor/1/transaction/?count=false&size=1')
+        self.assertEqual(len(response.data['results']), 1)
+        for page in [3, 'last']:
+            response = self.client.get(url, {'count': 'false', 'size': 1, 'page': page})
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_count_and_balance_in_one_query(self):
+        url = reverse('debtor-transaction-list', args=(1,))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.data, self.transaction_list)
+        aggregates = [q['sql'] for q in queries if 'COUNT(' in q['sql'] or 'SUM(' in q['sql']]
+        self.assertEqual(len(aggregates), 1, aggregates)
+
+        # served from the cache until the owner writes
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url, {'page': 1})
+        self.assertFalse([q for q in queries if 'COUNT(' in q['sql']])
+        self.client.post(url, {'sum': 5})
+        response = self.client.get(url, {'page': 1})
+        self.assertEqual((response.data['count'], response.data['total_balance']), (3, 6.0))
+
+    def test_debtor_count_skips_balances(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('debtor-list'))
+        self.assertEqual(response.data['count'], 3)
+        count = [q['sql'] for q in queries if 'COUNT(' in q['sql']]
+        self.assertEqual(len(count), 1)
+        self.assertNotIn('SUM(', count[0])
+
+
+class ValuesRowMapperTestCase(ApiUserTestClient):
+
+    def setUp(self):
+        super().setUp()
+        Transaction.objects.create(date='2020-03-04', sum=0.1, comment='', debtor_id=2)
+        Transaction.objects.create(date='2020-03-05', sum=-1e-7, comment='Ёлка "x"\n', debtor_id=2)
+        self.debtors = Debtor.objects.filter(owner_id=1, is_active=True).order_by('id')
+        self.transactions = Transaction.objects.filter(is_active=True).order_by('-date', 'id')
+
+    def get_request(self, params=None):
+        return Request(APIRequestFactory().get('/', params))
+
+    def assertSameJson(self, serializer_class, queryset, params=None):
+        request = self.get_request(params)
+        serialized = serializer_class(queryset, many=True, context={'request': request}).data
+        mapper = ValuesRowMapper.for_request(serializer_class, request)
+        mapped = mapper.to_representation(mapper.get_values(queryset))
+        self.assertEqual(JSONRenderer().render(mapped), JSONRenderer().render(serialized))
+
+    def test_debtor_values_mapper(self):
+        self.assertSameJson(DebtorSerializer, self.debtors)
+        self.assertSameJson(DebtorSerializer, self.debtors, {'fields': 'id,balance'})
+        self.assertSameJson(DebtorSerializer, self.debtors, {'omit': 'balance'})
+
+    def test_transaction_values_mapper(self):
+        self.assertSameJson(TransactionSerializer, self.transactions)
+        self.assertSameJson(TransactionSerializer, self.transactions, {'omit': 'comment'})
+
+    def test_values_mapper_cache(self):
+        first = ValuesRowMapper.for_request(TransactionSerializer, self.get_request({'fields': 'sum,id,unknown'}))
+        second = ValuesRowMapper.for_request(TransactionSerializer, self.get_request({'fields': 'id,sum'}))
+        self.assertIs(first, second)
+
+
+@skipIf(orjson is None or msgpack is None, 'orjson and msgpack are required')
+class RendererTestCase(ApiUserTestClient):
+
+    def setUp(self):
+        super().setUp()
+        self.payloads = [
+            {'next': None, 'count': 2, 'total_balance': 1.0, 'currency': 'руб', 'results': [
+                {'id': 1, 'date': '2020-03-03', 'sum': -3.0, 'comment': 'c1'},
+                {'id': 2, 'date': '2020-03-03', 'sum': 4.5, 'comment': 'line\u2028separator \u2029 "quoted"'},
+            ]},
+            {'detail': ErrorDetail('not found', code='not_found'), 'errors': [ErrorDetail('zero amount')]},
+            {
+                'datetime': datetime.datetime(2020, 3, 3, 10, 0, 0, 123456, tzinfo=datetime.timezone.utc),
+                'naive_datetime': datetime.datetime(2020, 3, 3, 10, 0),
+                'date': datetime.date(2020, 3, 3),
+                'time': datetime.time(10, 30),
+                'timedelta': datetime.timedelta(hours=1),
+                'decimal': decimal.Decimal('1.25'),
+                'uuid': uuid.UUID('12345678123456781234567812345678'),
+                'bytes': b'bytes',
+                'tuple': (1, 2),
+                1: 'int key',
+            },
+            {'small_float': -1e-07, 'large_float': 1e+16},
+            [],
+            # out of 64 bit range, not representable in msgpack
+            {'big_int': 2 ** 70},
+        ]
+
+    def test_fast_json_equivalence(self):
+        for payload in self.payloads:
+            expected = JSONRenderer().render(payload)
+            rendered = FastJSONRenderer().render(payload)
+            self.assertEqual(json.loads(rendered), json.loads(expected))
+        for payload in self.payloads[:3]:
+            self.assertEqual(FastJSONRenderer().render(payload), JSONRenderer().render(payload))
+        self.assertEqual(FastJSONRenderer().render(self.payloads[0], 'application/json; indent=4'),
+                         JSONRenderer().render(self.payloads[0], 'application/json; indent=4'))
+
+    def test_fast_json_api_output(self):
+        for url in [reverse('debtor-list'), reverse('debtor-transaction-list', args=(1,))]:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.content, JSONRenderer().render(response.data))
+
+    def test_messagepack_equivalence(self):
+        for payload in self.payloads[:-1]:
+            rendered = MessagePackRenderer().render(payload)
+            expected = json.loads(JSONRenderer().render(payload))
+            # bytes are packed as native msgpack binary
+            unpacked = msgpack.unpackb(rendered, raw=False, strict_map_key=False)
+            self.assertEqual(json.loads(json.dumps(unpacked, default=bytes.decode)), expected)
+
+    def test_messagepack_api(self):
+        response = self.client.get(reverse('debtor-transaction-list', args=(1,)), HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['content-type'], 'application/msgpack')
+        self.assertEqual(msgpack.unpackb(response.content, raw=False), self.transaction_list)
+
+        data = msgpack.packb({'date': '2020-04-03', 'sum': -3.0, 'comment': 'c3'})
+        response = self.client.post(reverse('debtor-transaction-list', args=(1,)), data,
+                                    content_type='application/msgpack', HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(msgpack.unpackb(response.content, raw=False)['comment'], 'c3')
+
+        response = self.client.post(reverse('debtor-transaction-list', args=(1,)), b'\xc1',
+                                    content_type='application/msgpack')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_fast_json_parser(self):
+        response = self.client.post(reverse('debtor-transaction-list', args=(1,)),
+                                    {'date': '2020-04-03', 'sum': -3.0, 'comment': 'Ёлка'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['comment'], 'Ёлка')
+
+        response = self.client.post(reverse('debtor-transaction-list', args=(1,)), '{"sum": NaN}',
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class MetricsTestCase(ApiUserTestClient):
+
+    def get_sample(self, metrics, name, **labels):
+        label_str = ','.join(f'{k}="{v}"' for k, v in sorted(labels.items()))
+        for line in metrics.splitlines():
+            if line.startswith(f'{name}{{') and all(f'{k}="{v}"' in line for k, v in labels.items()):
+                return float(line.rsplit(' ', 1)[1])
+        self.fail(f'{name}{{{label_str}}} not found')
+
+    def test_metrics(self):
+        response = self.client.get(reverse('debtor-list'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.get(reverse('debtor-report', args=(1,)), {'extension': 'xlsx'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        metrics = response.content.decode()
+        self.assertGreaterEqual(self.get_sample(metrics, 'http_request_duration_seconds_count',
+                                                route='debtor-list', method='GET', status='200'), 1)
+        self.assertGreater(self.get_sample(metrics, 'http_request_db_queries_sum', route='debtor-list'), 0)
+        self.assertGreater(self.get_sample(metrics, 'http_response_size_bytes_sum', route='debtor-report'), 0)
+        for phase in ['paginate', 'total_balance', 'currency']:
+            self.assertGreaterEqual(self.get_sample(metrics, 'app_phase_duration_seconds_count',
+                                                    route='debtor-list', phase=phase), 1)
+        for phase in ['report_query', 'report_render']:
+            self.assertGreaterEqual(self.get_sample(metrics, 'app_phase_duration_seconds_count',
+                                                    route='debtor-report', phase=phase), 1)
+
+
+class SlowQueryTestCase(ApiUserTestClient):
+
+    def test_analyze_queries(self):
+        def query(sql, duration=0.001):
+            return {'alias': 'default', 'sql': sql, 'params': (), 'many': False, 'duration': duration}
+
+        self.assertEqual(normalize_sql('SELECT  *\n FROM t WHERE id IN (%s, %s, %s)'),
+                         'SELECT * FROM t WHERE id IN (...)')
+        queries = [query('SELECT 1', 0.5), query('SELECT 2', 0.9)] + \
+                  [query(f'SELECT * FROM t WHERE id IN ({", ".join(["%s"] * i)})') for i in range(1, 4)]
+        with override_settings(SLOW_QUERY_THRESHOLD=0.2, SLOW_QUERY_REPEAT_THRESHOLD=3):
+            slow, repeated = analyze_queries(queries)
+        self.assertEqual([q['sql'] for q in slow], ['SELECT 2', 'SELECT 1'])
+        self.assertEqual(repeated, [('SELECT * FROM t WHERE id IN (...)', 3)])
+
+    def test_slow_query_record(self):
+        with override_settings(SLOW_QUERY_THRESHOLD=0, SLOW_QUERY_EXPLAIN_LIMIT=1), \
+                self.assertLogs('django', logging.WARNING) as logs:
+            response = self.client.get(reverse('debtor-transaction-list', args=(1,)))
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            response = self.client.get(reverse('debtor-transaction-list', args=(1,)))
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn(self.access_token.token, '\n'.join(logs.output))
+        records = SlowQueryRecord.objects.filter(kind='slow', route='debtor-transaction-list')
+        self.assertTrue(records.exists())
+        self.assertEqual(sum(r.occurrences for r in records), 2)
+        self.assertTrue(all(r.sql.startswith('SELECT') and r.explain for r in records))
+        self.assertFalse(any(self.access_token.token in r.explain for r in SlowQueryRecord.objects.all()))
+
+        SlowQueryRecord.objects.all().delete()
+        response = self.client.get(reverse('debtor-list'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(SlowQueryRecord.objects.exists())
+
+
+class LoadBenchmarkTestCase(APITestCase):
+
+    def setUp(self):
+        use_temp_cache_dir(self)
+
+    def test_seed_and_benchmark(self):
+        management.call_command('seed_load', users=3, debtors=2, transactions=3, stdout=StringIO())
+        self.assertEqual(User.objects.filter(username__startswith='load').count(), 3)
+        self.assertEqual(CurrencyOwner.objects.filter(owner__username__startswith='load', current=True).count(), 3)
+        self.assertTrue(Transaction.objects.filter(debtor__owner__username__startswith='load').exists())
+
+        with tempfile.NamedTemporaryFile(suffix='.json') as output:
+            management.call_command('benchmark_api', requests=4, concurrency=1, writes=True, output=output.name)
+            report = json.load(output)
+        self.assertEqual(report['users'], 3)
+        for name, result in report['endpoints'].items():
+            self.assertEqual(result['requests'], 4)
+            self.assertEqual(result['errors'], 0, name)
+            self.assertLessEqual(result['p50_ms'], result['p99_ms'])
+            self.assertGreater(result['throughput_rps'], 0)
+        self.assertIn('transaction_create', report['endpoints'])
+        with self.assertRaises(management.CommandError):
+            management.call_command('benchmark_api', requests=0)
+        empty = BenchmarkCommand().run_endpoint(lambda *item: 200, [], concurrency=2)
+        self.assertEqual(empty, {'requests': 0, 'errors': 0, 'p50_ms': None, 'p95_ms': None, 'p99_ms': None,
+                                 'mean_ms': None, 'throughput_rps': None})
+
+        management.call_command('seed_load', users=2, clear=True, stdout=StringIO())
+        self.assertEqual(User.objects.filter(username__startswith='load').count(), 2)
+
+
+class LoggingTestCase(ApiUserTestClient):
+
+    class ListHandler(logging.Handler):
+        def __init__(self):
+            super().__init__()
+            self.lines = []
+
+        def emit(self, record):
+            self.lines.append(self.format(record))
+
+    def test_queued_json_log(self):
+        target = self.ListHandler()
+        target.setFormatter(JSONFormatter())
+        handler = QueueListenerHandler([target])
+        logger = logging.getLogger('django')
+        logger.addHandler(handler)
+        try:
+            response = self.client.get(reverse('debtor-report', args=(1,)), {'extension': 'pdf'},
+                                       HTTP_X_REQUEST_ID='req-1')
+            self.assertEqual(response['X-Request-ID'], 'req-1')
+            try:
+                raise ValueError('boom')
+            except ValueError:
+                logger.exception('outside of request')
+        finally:
+            logger.removeHandler(handler)
+            handler.close()
+        entries = [json.loads(line) for line in target.lines]
+        report_entry = next(e for e in entries if e['message'] == 'report format not supported: pdf')
+        self.assertEqual(report_entry['request_id'], 'req-1')
+        self.assertEqual(report_entry['route'], 'debtor-report')
+        self.assertEqual(report_entry['level'], 'ERROR')
+        self.assertEqual(entries[-1]['request_id'], None)
+        self.assertIn('ValueError: boom', entries[-1]['exc_info'])
+
+    def test_request_id_generated(self):
+        response = self.client.get(reverse('debtor-list'), HTTP_X_REQUEST_ID='bad id\n')
+        self.assertRegex(response['X-Request-ID'], '^[0-9a-f]{32}$')
+
+
+@override_settings(REPLICA_DATABASES=['replica0', 'replica1'], REPLICA_STICKY_SECONDS=10)
+class ReplicaRouterTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.router = ReplicaRouter()
+
+    def request(self, method, cookies=None, status_code=200):
+        request = getattr(RequestFactory(), method)('/api/v1/debtor/')
+        request.COOKIES.update(cookies or {})
+        used = []
+
+        def view(request):
+            used.append(self.router.db_for_read(Debtor))
+            return HttpResponse(status=status_code)
+        response = ReplicaStickinessMiddleware(view)(request)
+        return used[0], response
+
+    def test_routing(self):
+        self.assertIn(self.router.db_for_read(Debtor), ['replica0', 'replica1'])
+        self.assertEqual(self.router.db_for_write(Debtor), 'default')
+        with use_primary():
+            self.assertEqual(self.router.db_for_read(Debtor), 'default')
+        self.assertFalse(self.router.allow_migrate('replica0', 'debt_manager_backend_api'))
+        self.assertTrue(self.router.allow_migrate('default', 'debt_manager_backend_api'))
+        instance = Debtor(name='x')
+        instance._state.db = 'default'
+        self.assertEqual(self.router.db_for_read(Debtor, instance=instance), 'default')
+        with override_settings(REPLICA_DATABASES=[]):
+            self.assertEqual(self.router.db_for_read(Debtor), 'default')
+
+    def test_router_chain(self):
+        # ShardRouter answers for owner data before ReplicaRouter is asked
+        for model in [Debtor, Transaction, ChangeJournal, Currency]:
+            self.assertIn(router.db_for_read(model), ['replica0', 'replica1'], model)
+        self.assertEqual(router.db_for_write(Transaction), 'default')
+        with use_primary():
+            self.assertEqual(router.db_for_read(Debtor), 'default')
+        debtor = Debtor(id=1)
+        debtor._state.db = 'replica1'
+        self.assertEqual(router.db_for_read(Transaction, instance=debtor), 'replica1')
+        self.assertEqual(router.db_for_write(Transaction, instance=debtor), 'default')
+        self.assertFalse(router.allow_migrate('replica0', 'debt_manager_backend_api', model_name='debtor'))
+
+    def test_atomic_reads_primary(self):
+        connection.in_atomic_block = True
+        try:
+            self.assertEqual(self.router.db_for_read(Debtor), 'default')
+        finally:
+            connection.in_atomic_block = False
+
+    def test_stickiness(self):
+        db, response = self.request('get')
+        self.assertTrue(db.startswith('replica'))
+        self.assertNotIn(STICKY_COOKIE, response.cookies)
+
+        db, response = self.request('post', status_code=400)
+        self.assertEqual(db, 'default')
+        self.assertNotIn(STICKY_COOKIE, response.cookies)
+
+        db, response = self.request('post', status_code=201)
+        self.assertEqual(db, 'default')
+        cookie = response.cookies[STICKY_COOKIE]
+        self.assertEqual(cookie['max-age'], 10)
+
+        db, _ = self.request('get', {STICKY_COOKIE: cookie.value})
+        self.assertEqual(db, 'default')
+        db, _ = self.request('get', {STICKY_COOKIE: str(time.time() - 1)})
+        self.assertTrue(db.startswith('replica'))
+        db, _ = self.request('get', {STICKY_COOKIE: 'garbage'})
+        self.assertTrue(db.startswith('replica'))
+
+
+@override_settings(SHARD_DATABASES=['default', 'shard1'])
+class ShardRouterTestCase(SimpleTestCase):
+
+    def test_routing(self):
+        router = ShardRouter()
+        self.assertEqual(router.db_for_read(Debtor), 'default')
+        self.assertIsNone(router.db_for_read(User))
+        with use_shard('shard1'):
+            self.assertEqual(router.db_for_read(Transaction), 'shard1')
+            self.assertEqual(router.db_for_write(Debtor), 'shard1')
+            self.assertIsNone(router.db_for_write(CurrencyOwner))
+            # a debtor created for a user of the default database goes to the shard
+            self.assertEqual(router.db_for_write(Debtor, instance=User(id=1)), 'shard1')
+        debtor = Debtor(id=1)
+        debtor._state.db = 'shard1'
+        self.assertEqual(router.db_for_write(Transaction, instance=debtor), 'shard1')
+        self.assertTrue(router.allow_relation(debtor, User(id=1)))
+        self.assertTrue(router.allow_migrate('shard1', 'debt_manager_backend_api', 'transaction'))
+        self.assertFalse(router.allow_migrate('shard1', 'debt_manager_backend_api', 'currency'))
+        self.assertFalse(router.allow_migrate('shard1', 'auth', 'user'))
+        self.assertIsNone(router.allow_migrate('default', 'debt_manager_backend_api', 'debtor'))
+
+    @skipIf('shard1' not in settings.DATABASES, 'set DATABASE_SHARDS to run sharding tests')
+    @override_settings(SHARD_REPLICAS={'shard1': ['shard1_replica0']})
+    def test_shard_replicas(self):
+        with use_shard('shard1'):
+            self.assertEqual(router.db_for_read(Debtor), 'shard1_replica0')
+            self.assertEqual(router.db_for_write(Debtor), 'shard1')
+            with use_primary():
+                self.assertEqual(router.db_for_read(Debtor), 'shard1')
+        debtor = Debtor(id=1)
+        debtor._state.db = 'shard1_replica0'
+        self.assertEqual(router.db_for_read(Transaction, instance=debtor), 'shard1_replica0')
+        self.assertEqual(router.db_for_write(Transaction, instance=debtor), 'shard1')
+        self.assertFalse(router.allow_migrate('shard1_replica0', 'debt_manager_backend_api', model_name='debtor'))
+
+
+@skipIf(len(settings.SHARD_DATABASES) < 2, 'set DATABASE_SHARDS to run sharding tests')
+class ShardingTestCase(ApiUserTestClient):
+    databases = '__all__'
+
+    def setUp(self):
+        super().setUp()
+        self.shard = settings.SHARD_DATABASES[1]
+
+    def test_move_owner(self):
+        response = self.client.get(reverse('debtor-transaction-list', args=(1,)))
+        self.assertEqual(response.data, self.transaction_list)
+        debtor_ids = list(Debtor.objects.filter(owner=self.user).values_list('id', flat=True))
+
+        management.call_command('move_owner_shard', str(self.user.id), self.shard, stdout=StringIO())
+        self.assertEqual(get_owner_shard(self.user.id), self.shard)
+        self.assertFalse(Debtor.objects.using('default').filter(owner=self.user).exists())
+        self.assertEqual(list(Debtor.objects.using(self.shard).filter(owner=self.user).values_list('id', flat=True)),
+                         debtor_ids)
+        response = self.client.get(reverse('debtor-transaction-list', args=(1,)))
+        self.assertEqual(response.data, self.transaction_list)
+
+        response = self.client.post(reverse('debtor-transaction-list', args=(1,)), {'sum': 5})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        created = Transaction.objects.using(self.shard).get(comment='', sum=5)
+        self.assertGreaterEqual(created.id, settings.SHARD_ID_BLOCK)
+        self.assertEqual(response.data['id'], created.id)
+        # the journal is rebuilt on the shard, cursors from the default database start over
+        data = self.client.get(reverse('sync'), {'since': 1}).data
+        self.assertTrue(data['reset'])
+        self.assertIn(created.id, [t['id'] for t in data['transactions']])
+        self.assertEqual(sorted(d['id'] for d in data['debtors']), sorted(debtor_ids[:2] + debtor_ids[3:]))
+
+        # the other user is still in the default database
+        self.assertTrue(Debtor.objects.using('default').filter(owner_id=2).exists())
+
+        management.call_command('move_owner_shard', self.user.username, 'default', stdout=StringIO())
+        self.assertTrue(Transaction.objects.using('default').filter(id=created.id).exists())
+        self.assertFalse(Debtor.objects.using(self.shard).exists())
+
+    def test_admin_fan_out(self):
+        management.call_command('move_owner_shard', str(self.user.id), self.shard, stdout=StringIO())
+        admin_user = User.objects.create(username='admin', email='admin@test.com', is_staff=True, is_superuser=True)
+        self.client.force_login(admin_user)
+        response = self.client.get(reverse('admin:debt_manager_backend_api_debtor_changelist'),
+                                   {'shard': self.shard})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.context['cl'].result_count, Debtor.objects.using(self.shard).count())
+        self.assertContains(response, f'{self.shard} (4)')
+        response = self.client.get(reverse('admin:debt_manager_backend_api_debtor_change', args=(1,)))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.context['original']._state.db, self.shard)
+
+    def test_writes_refused_while_moving(self):
+        OwnerShard.objects.create(owner=self.user, shard='default', moving=True)
+        response = self.client.get(reverse('debtor-list'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.post(reverse('debtor-list'), {'name': 'new'})
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+
+    def test_write_started_before_move(self):
+        def start_move(using, owner_ids):
+            # the request passed the moving check in initial()
+            OwnerShard.objects.update_or_create(owner=self.user, defaults={'shard': 'default', 'moving': True})
+            lock_owner_writes(using, owner_ids)
+
+        # the refused write rolls back the test transaction without a savepoint
+        with mock.patch('debt_manager_backend_api.journal.lock_owner_writes', side_effect=start_move), \
+                transaction.atomic():
+            response = self.client.post(reverse('debtor-list'), {'name': 'new'})
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertFalse(Debtor.objects.filter(name='new').exists())
+
+        OwnerShard.objects.filter(owner=self.user).update(moving=False)
+        with mock.patch('debt_manager_backend_api.management.commands.move_owner_shard.lock_owner_writes') as lock:
+            management.call_command('move_owner_shard', str(self.user.id), self.shard, stdout=StringIO())
+        lock.assert_called_once_with('default', [self.user.id], exclusive=True)
+
+
+class ConnectionPoolTestCase(SimpleTestCase):
+
+    class FakeConnection:
+        def __init__(self):
+            self.closed = False
+            self.healthy = True
+
+        def close(self):
+            self.closed = True
+
+    def make_pool(self, **kwargs):
+        opened = []
+
+        def connect():
+            opened.append(self.FakeConnection())
+            return opened[-1]
+        pool = ConnectionPool('test', connect, lambda conn: conn.healthy, **kwargs)
+        return pool, opened
+
+    def test_reuse(self):
+        pool, opened = self.make_pool()
+        conn = pool.getconn()
+        pool.putconn(conn)
+        self.assertIs(pool.getconn(), conn)
+        self.assertEqual(len(opened), 1)
+
+    def test_max_size(self):
+        pool, opened = self.make_pool(max_size=2, timeout=0.05)
+        first = pool.getconn()
+        pool.getconn()
+        with self.assertRaises(PoolTimeout):
+            pool.getconn()
+        threading.Timer(0.01, pool.putconn, [first]).start()
+        pool.timeout = 1
+        self.assertIs(pool.getconn(), first)
+        self.assertEqual(pool.size, 2)
+
+    def test_idle_recycling(self):
+        pool, opened = self.make_pool(min_size=1, max_idle=0)
+        pool.fill()
+        extra = [pool.getconn(), pool.getconn()]
+        for conn in extra:
+            pool.putconn(conn)
+        time.sleep(0.01)
+        conn = pool.getconn()
+        # the connections above min_size that idled longest are closed
+        self.assertEqual(pool.size, 1)
+        self.assertIs(conn, extra[1])
+        self.assertTrue(opened[0].closed)
+
+    def test_health_check(self):
+        pool, opened = self.make_pool(check_after=0)
+        conn = pool.getconn()
+        conn.healthy = False
+        pool.putconn(conn)
+        new = pool.getconn()
+        self.assertIsNot(new, conn)
+        self.assertTrue(conn.closed)
+        self.assertEqual(pool.size, 1)
+
+    def test_discard_and_close(self):
+        pool, opened = self.make_pool()
+        conn = pool.getconn()
+        pool.putconn(conn, discard=True)
+        self.assertTrue(conn.closed)
+        self.assertEqual(pool.size, 0)
+        pool.putconn(pool.getconn())
+        pool.close()
+        self.assertTrue(opened[1].closed)
+        self.assertEqual(pool.size, 0)
+
+    def test_concurrent_checkouts(self):
+        pool, opened = self.make_pool(max_size=3, timeout=5)
+        in_use = []
+        errors = []
+        lock = threading.Lock()
+
+        def worker():
+            try:
+                for _ in range(50):
+                    conn = pool.getconn()
+                    with lock:
+                        self.assertNotIn(conn, in_use)
+                        in_use.append(conn)
+                        self.assertLessEqual(len(in_use), 3)
+                    time.sleep(0.0005)
+                    with lock:
+                        in_use.remove(conn)
+                    pool.putconn(conn)
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=worker) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(opened), 3)
+        self.assertEqual(pool.idle, 3)
+
+
+class CoalesceTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        settings_override = override_settings(
+            CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+                    'coalesce': {'BACKEND': 'debt_manager_backend_api.cache_backends.FileBasedCache',
+                                 'LOCATION': self.cache_dir}},
+            SINGLE_FLIGHT_WAIT=5, SINGLE_FLIGHT_POLL_INTERVAL=0.01)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def test_concurrent_calls_compute_once(self):
+        calls = []
+
+        @single_flight(lambda n: f'{n}')
+        def slow_square(n):
+            calls.append(n)
+            time.sleep(0.2)
+            return n * n
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(slow_square(3))) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [9] * 5)
+        self.assertEqual(calls, [3])
+
+    def test_concurrent_processes_compute_once(self):
+        counter = os.path.join(self.cache_dir, 'counter')
+
+        def compute():
+            with open(counter, 'a') as f:
+                f.write('x')
+            time.sleep(0.3)
+            return 'result'
+        pids = []
+        for _ in range(4):
+            pid = os.fork()
+            if pid == 0:
+                # the cache connection of the parent is not shared
+                get_flight_cache().close()
+                os._exit(0 if run_single_flight('process', compute) == 'result' else 1)
+            pids.append(pid)
+        exit_codes = [os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1]) for pid in pids]
+        self.assertEqual(exit_codes, [0] * 4)
+        with open(counter) as f:
+            self.assertEqual(f.read(), 'x')
+
+    def test_wait_timeout_computes(self):
+        holder = threading.Thread(target=run_single_flight, args=('stuck', lambda: time.sleep(0.5)))
+        holder.start()
+        time.sleep(0.05)
+        with override_settings(SINGLE_FLIGHT_WAIT=0.05), self.assertLogs('django', logging.WARNING):
+            self.assertEqual(run_single_flight('stuck', lambda: 'computed'), 'computed')
+        holder.join()
+
+    def test_failed_holder_releases_lock(self):
+        def fail():
+            raise ValueError()
+        with self.assertRaises(ValueError):
+            run_single_flight('failing', fail)
+        self.assertEqual(run_single_flight('failing', lambda: 'computed'), 'computed')
+
+    def test_none_key_skips_coalescing(self):
+        calls = []
+
+        @single_flight(lambda: None)
+        def count():
+            calls.append(1)
+            return len(calls)
+        self.assertEqual([count(), count()], [1, 2])
+
+    def test_response_stored_as_data(self):
+        @single_flight(lambda: 'response')
+        def view():
+            return Response({'a': 1}, status=status.HTTP_201_CREATED)
+        view()
+        response = view()
+        self.assertEqual((response.data, response.status_code), ({'a': 1}, status.HTTP_201_CREATED))
+
+    def test_add_is_exclusive(self):
+        cache = get_flight_cache()
+        self.assertTrue(cache.add('key', 'first', 60))
+        self.assertFalse(cache.add('key', 'second', 60))
+        self.assertEqual(cache.get('key'), 'first')
+        cache.set('expired', 'old', -1)
+        self.assertTrue(cache.add('expired', 'new', 60))
+        self.assertEqual(cache.get('expired'), 'new')
+
+
+class EventStreamTestCase(TransactionTestCase):
+    # streams query the database from another thread, data must be committed
+    databases = '__all__'
+
+    def setUp(self):
+        use_temp_cache_dir(self)
+        self.user = User.objects.create(username='events@test.com', email='events@test.com')
+        application = Application.objects.create(name='events', user=self.user,
+                                                 client_type=Application.CLIENT_CONFIDENTIAL,
+                                                 authorization_grant_type=Application.GRANT_AUTHORIZATION_CODE)
+        AccessToken.objects.create(user=self.user, scope='read write', token='events-token', application=application,
+                                   expires=timezone.now() + timezone.timedelta(seconds=300))
+        self.debtor = Debtor.objects.create(name='debtor', owner=self.user)
+        Transaction.objects.create(sum=5, debtor=self.debtor)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer events-token')
+        self.application = EventStreamRouter(None)
+
+    def get_scope(self, query_string=b'access_token=events-token', headers=()):
+        return {'type': 'http', 'method': 'GET', 'path': settings.EVENT_STREAM_PATH, 'query_string': query_string,
+                'headers': list(headers)}
+
+    @staticmethod
+    def parse_events(body):
+        events = []
+        for block in body.decode().split('\n\n'):
+            fields = dict(line.split(': ', 1) for line in block.split('\n') if ': ' in line and line[0] != ':')
+            if 'event' in fields:
+                events.append((fields['event'], json.loads(fields['data']), fields.get('id')))
+        return events
+
+    def test_change_events(self):
+        async def stream():
+            communicator = ApplicationCommunicator(self.application, self.get_scope())
+            await communicator.send_input({'type': 'http.request'})
+            start = await communicator.receive_output(5)
+            self.assertEqual(start['status'], status.HTTP_200_OK)
+            self.assertIn((b'content-type', b'text/event-stream'), start['headers'])
+            self.assertTrue((await communicator.receive_output(5))['body'].startswith(b'retry: '))
+
+            url = reverse('debtor-transaction-list', args=(self.debtor.id,))
+            response = await sync_to_async(self.client.post)(url, {'sum': -2})
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            [(name, event, event_id)] = self.parse_events((await communicator.receive_output(5))['body'])
+            self.assertEqual(name, 'transaction')
+            self.assertEqual((event['action'], event['id'], event['debtor']),
+                             ('created', response.data['id'], self.debtor.id))
+            self.assertEqual((event['balance'], event['total_balance']), (3, 3))
+            self.assertEqual(event_id, str(event['version']))
+
+            await sync_to_async(self.client.delete)(reverse('debtor-detail', args=(self.debtor.id,)))
+            [(name, event, _)] = self.parse_events((await communicator.receive_output(5))['body'])
+            self.assertEqual((name, event['action'], event['total_balance']), ('debtor', 'deleted', None))
+
+            await communicator.send_input({'type': 'http.disconnect'})
+            await communicator.wait(5)
+            self.assertEqual(broker.subscriptions, {})
+        async_to_sync(stream)()
+
+    def test_reset_and_authentication(self):
+        async def request(scope):
+            communicator = ApplicationCommunicator(self.application, scope)
+            await communicator.send_input({'type': 'http.request'})
+            start = await communicator.receive_output(5)
+            body = (await communicator.receive_output(5))['body']
+            await communicator.send_input({'type': 'http.disconnect'})
+            await communicator.wait(5)
+            return start['status'], self.parse_events(body)
+
+        self.assertEqual(async_to_sync(request)(self.get_scope(b''))[0], status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(async_to_sync(request)(self.get_scope(b'access_token=wrong'))[0],
+                         status.HTTP_401_UNAUTHORIZED)
+        self.client.post(reverse('debtor-transaction-list', args=(self.debtor.id,)), {'sum': 1})
+        version = get_owner_version(self.user.id)
+        headers = [(b'authorization', b'Bearer events-token'), (b'last-event-id', str(version - 1).encode())]
+        self.assertEqual(async_to_sync(request)(self.get_scope(b'', headers)),
+                         (status.HTTP_200_OK, [('reset', {}, str(version))]))
+        headers[1] = (b'last-event-id', str(version).encode())
+        self.assertEqual(async_to_sync(request)(self.get_scope(b'', headers)), (status.HTTP_200_OK, []))
+
+    def test_event_while_connecting(self):
+        event = {'type': 'debtor', 'action': 'updated', 'id': self.debtor.id, 'debtor': self.debtor.id, 'version': 7}
+
+        def get_version(owner_id):
+            # committed after the stream authenticated, before it read the version
+            broker.publish(owner_id, event)
+            return 7
+
+        async def stream():
+            headers = [(b'authorization', b'Bearer events-token'), (b'last-event-id', b'6')]
+            communicator = ApplicationCommunicator(self.application, self.get_scope(b'', headers))
+            await communicator.send_input({'type': 'http.request'})
+            await communicator.receive_output(5)
+            events = self.parse_events((await communicator.receive_output(5))['body'])
+            events += self.parse_events((await communicator.receive_output(5))['body'])
+            await communicator.send_input({'type': 'http.disconnect'})
+            await communicator.wait(5)
+            return events
+        with mock.patch('debt_manager_backend_api.streams.get_owner_version', side_effect=get_version):
+            events = async_to_sync(stream)()
+        self.assertEqual(events, [('reset', {}, '7'), ('debtor', event, '7')])
+
+    def test_bulk_events(self):
+        other = Debtor.objects.create(name='other', owner=self.user)
+        Transaction.objects.create(sum=2, debtor=other)
+
+        async def merge():
+            subscription = broker.subscribe(self.user.id)
+            try:
+                response = await sync_to_async(self.client.post)(
+                    reverse('debtor-bulk'), {'operation': 'merge', 'ids': [other.id], 'target': self.debtor.id},
+                    format='json')
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                return await asyncio.wait_for(subscription.queue.get(), 5)
+            finally:
+                broker.unsubscribe(subscription)
+        event = async_to_sync(merge)()
+        self.assertEqual((event['action'], event['count'], event['debtor']), ('merged', 1, self.debtor.id))
+        self.assertEqual((event['balance'], event['total_balance'], event['version']),
+                         (7, 7, get_owner_version(self.user.id)))
+
+    def test_event_order(self):
+        def get_balances(owner_id, debtor_id):
+            time.sleep(0.2)
+            return {'balance': 1, 'total_balance': 1}
+
+        async def deliver():
+            subscription = broker.subscribe(1)
+            try:
+                broker.dispatch(1, {'type': 'transaction', 'action': 'created', 'debtor': 1, 'version': 1})
+                broker.dispatch(1, {'type': 'debtor', 'action': 'updated', 'debtor': 1, 'version': 2})
+                return [(await asyncio.wait_for(subscription.queue.get(), 5))['version'] for _ in range(2)]
+            finally:
+                broker.unsubscribe(subscription)
+        with mock.patch('debt_manager_backend_api.events.get_balances', side_effect=get_balances):
+            self.assertEqual(async_to_sync(deliver)(), [1, 2])
+        self.assertEqual(broker.pending, {})
+
+    @override_settings(EVENT_QUEUE_SIZE=2)
+    def test_slow_subscriber_disconnected(self):
+        async def overflow():
+            subscription = broker.subscribe(1)
+            for version in range(3):
+                await broker.deliver(1, {'type': 'debtor', 'action': 'updated', 'version': version})
+            self.assertEqual(broker.subscriptions, {})
+            return [subscription.queue.get_nowait() for _ in range(2)]
+        self.assertEqual(async_to_sync(overflow)()[-1], None)
+
+
+@override_settings(BATCH_MAX_WORKERS=1)
+class BatchTestCase(ApiUserTestClient):
+
+    def test_batch(self):
+        paths = ['/api/v1/user/current/', '/api/v1/debtor/', '/api/v1/debtor/1/transaction/?size=1']
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('batch'), [{'path': path} for path in paths], format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len([q for q in queries if 'oauth2_provider_accesstoken' in q['sql']]), 1)
+        for path, sub_response in zip(paths, response.data):
+            direct = self.client.get(path)
+            self.assertEqual(sub_response['status'], direct.status_code)
+            self.assertEqual(json.loads(json.dumps(sub_response['body'])), json.loads(direct.content))
+            self.assertEqual(sub_response['headers']['ETag'], direct['ETag'])
+
+    def test_writes_run_in_order(self):
+        url = reverse('debtor-transaction-list', args=(1,))
+        response = self.client.post(reverse('batch'), [
+            {'method': 'POST', 'path': url, 'body': {'sum': 5, 'comment': 'batched'}},
+            {'path': url},
+            {'path': reverse('batch')},
+            {'path': '/api/v1/missing/'},
+        ], format='json')
+        created, listed, nested, missing = response.data
+        self.assertEqual(created['status'], status.HTTP_201_CREATED)
+        self.assertEqual(listed['body']['count'], 3)
+        self.assertIn(created['body']['id'], [t['id'] for t in listed['body']['results']])
+        self.assertEqual((nested['status'], missing['status']), (status.HTTP_404_NOT_FOUND, status.HTTP_404_NOT_FOUND))
+
+    def test_sub_request_headers(self):
+        url = reverse('debtor-list')
+        etag = self.client.get(url)['ETag']
+        response = self.client.post(reverse('batch'), [
+            {'path': url, 'headers': {'If-None-Match': etag, 'Authorization': 'Bearer other-token'}},
+        ], format='json')
+        self.assertEqual(response.data[0]['status'], status.HTTP_304_NOT_MODIFIED)
+
+    def test_validation(self):
+        response = self.client.post(reverse('batch'), {'path': '/api/v1/debtor/'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(reverse('batch'), [{'path': '/api/v1/debtor/'}] * 21, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(reverse('batch'), [{'path': 'api/v1/debtor/', 'method': 'TRACE'}], format='json')
+        self.assertEqual(set(response.data[0]), {'path', 'method'})
+        self.client.credentials()
+        self.assertEqual(self.client.post(reverse('batch'), [], format='json').status_code,
+                         status.HTTP_401_UNAUTHORIZED)
+
+
+class ParallelBatchTestCase(TransactionTestCase):
+    # batched reads run in pool threads with their own connections, data must be committed
+    databases = '__all__'
+
+    def setUp(self):
+        use_temp_cache_dir(self)
+
+    @override_settings(BATCH_MAX_WORKERS=3)
+    def test_parallel_reads(self):
+        user = User.objects.create(username='batch@test.com', email='batch@test.com')
+        application = Application.objects.create(name='batch', user=user, client_type=Application.CLIENT_CONFIDENTIAL,
+                                                 authorization_grant_type=Application.GRANT_AUTHORIZATION_CODE)
+        AccessToken.objects.create(user=user, scope='read write', token='batch-token', application=application,
+                                   expires=timezone.now() + timezone.timedelta(seconds=300))
+        CurrencyOwner.objects.create(currency=Currency.objects.create(name='руб'), owner=user, current=True)
+        debtors = [Debtor.objects.create(name=f'debtor {i}', owner=user) for i in range(3)]
+        for i, debtor in enumerate(debtors):
+            Transaction.objects.create(sum=i + 1, debtor=debtor)
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION='Bearer batch-token')
+        response = client.post(reverse('batch'), [
+            {'path': reverse('debtor-transaction-list', args=(debtor.id,))} for debtor in debtors], format='json')
+        self.assertEqual([r['status'] for r in response.data], [status.HTTP_200_OK] * 3)
+        self.assertEqual([r['body']['total_balance'] for r in response.data], [1, 2, 3])
+
+
+class ProfilingTestCase(ApiUserTestClient):
+
+    def setUp(self):
+        super().setUp()
+        self.profile_dir = tempfile.mkdtemp()
+        self.settings_override = override_settings(PROFILE_DIR=self.profile_dir)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        super().tearDown()
+        self.settings_override.disable()
+        shutil.rmtree(self.profile_dir)
+
+    def test_profile_not_staff(self):
+        response = self.client.get(reverse('debtor-list'), {'profile': 1})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn('X-Profile-Id', response)
+        response = self.client.get(reverse('profile-list'))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_profile_capture(self):
+        User.objects.filter(id=self.user.id).update(is_staff=True)
+        response = self.client.get(reverse('debtor-list'))
+        self.assertNotIn('X-Profile-Id', response)
+        response = self.client.get(reverse('debtor-transaction-list', args=(1,)), HTTP_X_PROFILE='1')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        capture_id = response['X-Profile-Id']
+
+        response = self.client.get(reverse('profile-list'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([c['id'] for c in response.data], [capture_id])
+        self.assertEqual(response.data[0]['path'], reverse('debtor-transaction-list', args=(1,)))
+
+        response = self.client.get(reverse('profile-detail', args=(capture_id,)), {'file': 'sql'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['query_count'], len(response.data['queries']))
+        self.assertGreater(response.data['query_count'], 0)
+        self.assertFalse(any('params' in q for q in response.data['queries']))
+
+        response = self.client.get(reverse('profile-detail', args=(capture_id,)))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        prof_path = os.path.join(self.profile_dir, 'downloaded.prof')
+        with open(prof_path, 'wb') as f:
+            f.write(b''.join(response.streaming_content))
+        self.assertGreater(pstats.Stats(prof_path).total_calls, 0)
+
+        response = self.client.get(reverse('profile-detail', args=('20200101000000-00000000',)))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
 class UserTestCase(ApiUserTestClient):
 
     def setUp(self):
@@ -894,3 +2478,40 @@ class RecaptchaAPIViewTestCase(APITestCase):
         r, http_status = self.google_response_parser(self.google_success_token_check)
         self.assertEqual(http_status, status.HTTP_200_OK)
         self.assertEqual(r, self.google_success_token_check)
+
+
+class PrecomputedSchemaTestCase(APITestCase):
+
+    def setUp(self):
+        self.schema_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(SCHEMA_ROOT=self.schema_root, CODE_VERSION='test-version')
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.schema_root)
+        precomputed_schema.version = None
+
+    def test_generate_schema(self):
+        management.call_command('generate_schema')
+        with open(os.path.join(self.schema_root, 'openapi-test-version.json'), 'rb') as f:
+            content = f.read()
+        self.assertIn('/v1/debtor/', json.loads(content)['paths'])
+
+        response = self.client.get(reverse('schema-json'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.content, content)
+        self.assertIn('no-cache', response['Cache-Control'])
+
+        response = self.client.get(reverse('schema-json'), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_versioned_schema(self):
+        response = self.client.get(reverse('schema-json-versioned', args=('test-version',)))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertTrue(os.path.exists(os.path.join(self.schema_root, 'openapi-test-version.json')))
+
+        response = self.client.get(reverse('schema-json-versioned', args=('old-version',)))
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+        self.assertEqual(response['Location'], reverse('schema-json-versioned', args=('test-version',)))
@@ -15,17 +15,21 @@ Including another URLconf
 """
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import DebtorViewSet, TransactionViewSet, UserViewSet, RecaptchaAPIView
+from .views import DebtorViewSet, TransactionViewSet, UserViewSet, RecaptchaAPIView, ProfileCaptureViewSet, \
+    SyncView, BatchView
 from rest_framework_nested import routers
 
 router_v1 = DefaultRouter()
 router_v1.register('debtor', DebtorViewSet, basename='debtor')
 router_v1.register('user', UserViewSet, basename='user')
+router_v1.register('profile', ProfileCaptureViewSet, basename='profile')
 transaction_router = routers.NestedDefaultRouter(router_v1, 'debtor', lookup='debtor')
 transaction_router.register('transaction', TransactionViewSet, basename='debtor-transaction')
 
 urlpatterns = [
     path('recaptcha-v3/', RecaptchaAPIView.as_view(), name='captcha'),
+    path('v1/sync/', SyncView.as_view(), name='sync'),
+    path('v1/batch/', BatchView.as_view(), name='batch'),
     path('v1/', include(router_v1.urls)),
     path('v1/', include(transaction_router.urls)),
     path('auth/', include('oauth2_provider.urls', namespace='oauth2_provider')),
@@ -1,10 +1,13 @@
+import json
 import logging
 from datetime import datetime
 from django.contrib.auth import get_user_model
-from django.db import transaction
+from django.db import DEFAULT_DB_ALIAS, transaction
 from django.db.models import Sum, Q
 from django.template.response import SimpleTemplateResponse
 from django.utils.encoding import force_bytes
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
 from django.utils.http import urlsafe_base64_encode, urlsafe_base64_decode
 from drf_yasg import openapi
 from oauth2_provider.contrib.rest_framework import TokenHasReadWriteScope
@@ -14,13 +17,16 @@ from rest_framework.reverse import reverse
 from rest_framework.viewsets import GenericViewSet
 from rest_framework.views import APIView
 from rest_framework import viewsets, mixins
-from .models import Debtor, Transaction, CurrencyOwner
+from .models import ChangeJournal, Debtor, Transaction, Currency, CurrencyOwner
 from .serializers import DebtorSerializer, TransactionSerializer, UserRegistrationSerializer, \
-    RecaptchaRequestSerializer, RecaptchaResponseSerializer, SwaggerUserRegistrationSerializer
+    RecaptchaRequestSerializer, RecaptchaResponseSerializer, SwaggerUserRegistrationSerializer, ValuesRowMapper, \
+    DebtorSyncSerializer, TransactionSyncSerializer, SyncQuerySerializer, BatchRequestSerializer, \
+    BatchResponseSerializer, DebtorBulkSerializer, DebtorBulkResponseSerializer
 from .pagination import DebtorPagination, TransactionPagination
+from .filters import TransactionFilter
 from .permissions import DebtorPermission, IsAuthenticatedOrCreateOnly
 from rest_framework.decorators import action
-from django.http import HttpResponse
+from django.http import HttpResponse, FileResponse
 import mimetypes
 import xlsxwriter
 import requests
@@ -32,6 +38,19 @@ from .tokens import account_activation_token
 from django.conf import settings
 from drf_yasg.utils import swagger_auto_schema
 from .swagger import SwaggerAutoSchemaWithoutParam
+from .instrumentation import track_phase
+from .coalesce import single_flight
+from .report_cache import report_cache
+from .delivery import send_report_file
+from .db.routers import use_primary
+from .db.sharding import ShardMixin, current_shard
+from .journal import get_owner_version, journaled_write
+from .conditional import ConditionalGetMixin, get_current_currency
+from .events import record_change_event
+from .batch import run_batch
+from .bulk import delete_debtors, merge_debtors, rename_debtors
+from .idempotency import IdempotencyMixin
+from .profiling import ProfilingMixin, CAPTURE_ID_RE, get_capture_path, list_captures
 
 lh = logging.getLogger('django')
 mimetypes.init()
@@ -45,18 +64,28 @@ class ReportGenerator:
     def __init__(self, ext, pk):
         extension = {'xlsx': self.xlsx_report}
         self.debtor = pk
+        # report_cache key and current currency set by the view, the same report is generated once for
+        # concurrent requests
+        self.key = None
+        self.currency = None
         try:
             self._report_generator = extension[ext]
         except KeyError:
             raise KeyError
 
     def xlsx_report(self, pk):
-        tr_list = Transaction.objects.filter(is_active=True, debtor=pk).order_by('-date')
-        if not tr_list:
-            raise IndexError
-        debtor_name = tr_list[0].debtor.name
-        balance = tr_list.aggregate(Sum('sum'))
-        currency = CurrencyOwner.objects.get(owner=tr_list[0].debtor.owner, current=True).currency.name
+        with track_phase('report_query'):
+            tr_list = Transaction.objects.filter(is_active=True, debtor=pk).order_by('-date')
+            if not tr_list:
+                raise IndexError
+            debtor_name = tr_list[0].debtor.name
+            balance = tr_list.aggregate(Sum('sum'))
+            currency = self.currency or \
+                CurrencyOwner.objects.get(owner=tr_list[0].debtor.owner, current=True).currency.name
+        with track_phase('report_render'):
+            return self.xlsx_workbook(tr_list, debtor_name, balance, currency)
+
+    def xlsx_workbook(self, tr_list, debtor_name, balance, currency):
         output = BytesIO()
         workbook = xlsxwriter.Workbook(output, options={'default_format_properties': {'align': 'justify'}})
         worksheet = workbook.add_worksheet('balance sheet report')
@@ -70,9 +99,9 @@ class ReportGenerator:
         column_name = ['id', 'date', 'change', 'currency', 'comment']
         for i, v in enumerate(column_name):
             worksheet.write_string(0, i, v)
+        date_format = workbook.add_format({'num_format': 'dd-mm-yyyy'})
         for row, v in enumerate(tr_list, start=1):
             worksheet.write_number(row, 0, v.id)
-            date_format = workbook.add_format({'num_format': 'dd-mm-yyyy'})
             worksheet.write(row, 1, v.date, date_format)
             if v.sum > 0:
                 worksheet.write_string(row, 2, f'gave a loan of {v.sum}')
@@ -83,11 +112,40 @@ class ReportGenerator:
         workbook.close()
         return output
 
+    @single_flight(lambda self: self.key)
     def get_report(self):
         return self._report_generator(self.debtor)
 
 
-class DebtorViewSet(viewsets.ModelViewSet):
+def list_flight_key(view, request, *args, **kwargs):
+    """
+    Single flight key of a list response, none when the view does not know the owner data version
+    """
+    version = getattr(view, 'data_version', None)
+    if version is None:
+        return None
+    # the envelope carries the current currency
+    return f'{type(view).__name__} {request.user.id} {version} {view.data_state!r} {request.get_full_path()} ' \
+           f'{request.accepted_media_type}'
+
+
+class ValuesListMixin:
+    """
+    Fast read path for list action, rows are fetched with values() and rendered by ValuesRowMapper
+    """
+
+    @single_flight(list_flight_key)
+    def list(self, request, *args, **kwargs):
+        mapper = ValuesRowMapper.for_request(self.get_serializer_class(), request)
+        queryset = mapper.get_values(self.filter_queryset(self.get_queryset()))
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(mapper.to_representation(page))
+        return Response(mapper.to_representation(queryset))
+
+
+class DebtorViewSet(ShardMixin, ProfilingMixin, IdempotencyMixin, ConditionalGetMixin, ValuesListMixin,
+                    viewsets.ModelViewSet):
     serializer_class = DebtorSerializer
     permission_classes = [permissions.IsAuthenticated, TokenHasReadWriteScope, DebtorPermission]
     pagination_class = DebtorPagination
@@ -98,12 +156,56 @@ class DebtorViewSet(viewsets.ModelViewSet):
         if getattr(self, 'swagger_fake_view', False):
             # queryset just for schema generation metadata
             return Debtor.objects.none()
-        return Debtor.objects.filter(is_active=True, owner=self.request.user).order_by('id')
+        queryset = Debtor.objects.filter(is_active=True, owner=self.request.user).order_by('id')
+        if self.request.method == 'GET':
+            queryset = queryset.defer(*self.get_serializer_class().get_deferred_fields(self.request))
+        return queryset
+
+    def perform_create(self, serializer):
+        with journaled_write(Debtor, [self.request.user.id]):
+            record_change_event(self.request.user.id, serializer.save(), 'created')
+
+    def perform_update(self, serializer):
+        with journaled_write(Debtor, [self.request.user.id]):
+            record_change_event(self.request.user.id, serializer.save(), 'updated')
 
     def perform_destroy(self, instance):
-        instance.is_active = False
-        instance.save(update_fields=['is_active'])
-        Transaction.objects.filter(debtor=instance).update(is_active=False)
+        with journaled_write(Debtor, [self.request.user.id]):
+            instance.is_active = False
+            instance.save(update_fields=['is_active', 'updated_at'])
+            # transactions of a deleted debtor are deleted with it on sync clients, not journaled one by one
+            Transaction.objects.filter(debtor=instance).update(is_active=False, updated_at=timezone.now())
+            record_change_event(self.request.user.id, instance, 'deleted')
+
+    @swagger_auto_schema(request_body=DebtorBulkSerializer, responses={200: DebtorBulkResponseSerializer})
+    @action(detail=False, methods=['post'], url_path='bulk', url_name='bulk')
+    def bulk(self, request):
+        """
+        Merge, rename or delete up to DEBTOR_BULK_MAX_IDS debtors in one transaction, all of them must belong
+        to the user. Returns the merged or renamed debtors with their balances and the new total balance.
+        """
+        serialized = DebtorBulkSerializer(data=request.data)
+        serialized.is_valid(raise_exception=True)
+        data = serialized.validated_data
+        owner_id = request.user.id
+        # the owner check fails with 403 after taking locks, nested in a request transaction only the block rolls back
+        with journaled_write(Debtor, [owner_id], savepoint=True):
+            if data['operation'] == 'merge':
+                merge_debtors(owner_id, data['ids'], data['target'])
+                changed = [data['target']]
+            elif data['operation'] == 'rename':
+                rename_debtors(owner_id, data['names'])
+                changed = list(data['names'])
+            else:
+                delete_debtors(owner_id, data['ids'])
+                changed = []
+            # read in the write transaction, from the primary database
+            mapper = ValuesRowMapper.for_request(DebtorSerializer, request)
+            debtors = mapper.to_representation(mapper.get_values(
+                Debtor.objects.filter(id__in=changed).order_by('id'))) if changed else []
+            total_balance = Transaction.objects.filter(is_active=True, debtor__owner=owner_id)\
+                .aggregate(balance=Sum('sum'))['balance']
+        return Response({'debtors': debtors, 'total_balance': total_balance})
 
     @swagger_auto_schema(manual_parameters=[openapi.Parameter('extension', openapi.IN_QUERY,
                                                               description="report file extention",
@@ -124,29 +226,60 @@ class DebtorViewSet(viewsets.ModelViewSet):
             raise exceptions.NotFound()
         self.check_object_permissions(self.request, debtor)
         try:
-            report_obj = ReportGenerator(ext, debtor).get_report()
+            generator = ReportGenerator(ext, debtor)
         except KeyError:
             lh.error(f'report format not supported: {ext}')
             raise exceptions.UnsupportedMediaType(ext)
-        except IndexError:
-            lh.error('The debtor has no transactions')
-            raise exceptions.NotFound(detail='The debtor has no transactions')
-        report_obj.seek(0)
         try:
-            mimetypes.types_map[f'.{ext}']
+            content_type = mimetypes.types_map[f'.{ext}']
         except KeyError:
             lh.error('mimetype is not in mime.types file or windows registry')
             raise exceptions.UnsupportedMediaType(ext)
-        response = HttpResponse(report_obj.read(), mimetypes.types_map[f'.{ext}'])
-        report_date = datetime.now().strftime('%d-%m_%Y')
-        response['Content-Disposition'] = f'attachment; filename="report_{report_date}.{ext}"'
+        version = get_owner_version(debtor.owner_id)
+        currency = CurrencyOwner.objects.filter(owner=debtor.owner_id, current=True)\
+            .values_list('currency__name', flat=True).first()
+        generator.key = report_cache.get_key(debtor.id, ext, version, currency)
+        generator.currency = currency
+        etag = f'"{generator.key}"'
+        # no Last-Modified: currency switches are not journaled, only the ETag changes with them
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = self.get_report_response(generator, ext, content_type)
+            report_date = datetime.now().strftime('%d-%m_%Y')
+            response['Content-Disposition'] = f'attachment; filename="report_{report_date}.{ext}"'
+        response['ETag'] = etag
+        patch_cache_control(response, private=True, no_cache=True)
         return response
 
+    def get_report_response(self, generator, ext, content_type):
+        """
+        Report file from report_cache, generated and stored on a miss, sent with send_report_file once stored
+        """
+        debtor_id = generator.debtor.id
+        path = report_cache.get(debtor_id, ext, generator.key) if report_cache.enabled else None
+        if path is not None:
+            try:
+                return send_report_file(path, content_type)
+            except FileNotFoundError:
+                # evicted by another worker in between
+                pass
+        try:
+            content = generator.get_report().getvalue()
+        except IndexError:
+            lh.error('The debtor has no transactions')
+            raise exceptions.NotFound(detail='The debtor has no transactions')
+        path = report_cache.set(debtor_id, ext, generator.key, content) if report_cache.enabled else None
+        if path is None:
+            return HttpResponse(content, content_type)
+        return send_report_file(path, content_type)
+
 
-class TransactionViewSet(viewsets.ModelViewSet):
+class TransactionViewSet(ShardMixin, ProfilingMixin, IdempotencyMixin, ConditionalGetMixin, ValuesListMixin,
+                         viewsets.ModelViewSet):
     permission_classes = [permissions.IsAuthenticated, TokenHasReadWriteScope]
     serializer_class = TransactionSerializer
     pagination_class = TransactionPagination
+    filter_backends = [TransactionFilter]
 
     def call_debtor_check(self):
         try:
@@ -167,7 +300,10 @@ class TransactionViewSet(viewsets.ModelViewSet):
         debtor = self.call_debtor_check()
         # add context using in paginator class
         self.request.parser_context['debtor'] = debtor
-        return Transaction.objects.filter(is_active=True, debtor=self.kwargs['debtor_pk']).order_by('-date')
+        queryset = Transaction.objects.filter(is_active=True, debtor=self.kwargs['debtor_pk']).order_by('-date')
+        if self.request.method == 'GET':
+            queryset = queryset.defer(*self.get_serializer_class().get_deferred_fields(self.request))
+        return queryset
 
     def create(self, request, *args, **kwargs):
         debtor = self.call_debtor_check()
@@ -198,15 +334,26 @@ class TransactionViewSet(viewsets.ModelViewSet):
         self.perform_destroy(instance)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+    def perform_create(self, serializer):
+        with journaled_write(Transaction, [self.request.user.id]):
+            record_change_event(self.request.user.id, serializer.save(), 'created')
+
+    def perform_update(self, serializer):
+        with journaled_write(Transaction, [self.request.user.id]):
+            record_change_event(self.request.user.id, serializer.save(), 'updated')
+
     def perform_destroy(self, instance):
-        instance.is_active = False
-        instance.save(update_fields=['is_active'])
+        with journaled_write(Transaction, [self.request.user.id]):
+            instance.is_active = False
+            instance.save(update_fields=['is_active', 'updated_at'])
+            record_change_event(self.request.user.id, instance, 'deleted')
 
 
-class UserViewSet(GenericViewSet, mixins.CreateModelMixin):
+class UserViewSet(ProfilingMixin, ConditionalGetMixin, GenericViewSet, mixins.CreateModelMixin):
     serializer_class = UserRegistrationSerializer
     queryset = User.objects.all()
     permission_classes = [IsAuthenticatedOrCreateOnly]
+    etag_actions = {'get_current_user'}
 
     @swagger_auto_schema(auto_schema=SwaggerAutoSchemaWithoutParam, extra_overrides={'exluded_params': ['page']},
                          responses={200: SwaggerUserRegistrationSerializer})
@@ -215,6 +362,11 @@ class UserViewSet(GenericViewSet, mixins.CreateModelMixin):
         serializer = self.get_serializer(request.user)
         return Response(serializer.data)
 
+    def get_etag_state(self, request):
+        # profile edits are not journaled
+        user = request.user
+        return [get_current_currency(user.id), user.username, user.first_name, user.last_name, user.email]
+
     def perform_create(self, serializer):
         new_user = serializer.save()
         current_site = get_current_site(self.request)
@@ -241,7 +393,9 @@ class UserViewSet(GenericViewSet, mixins.CreateModelMixin):
     def activate_user(self, request, uidb64, token):
         try:
             uid = urlsafe_base64_decode(uidb64)
-            user = User.objects.get(pk=uid)
+            # the activation link may be opened before the registration reached a replica
+            with use_primary():
+                user = User.objects.get(pk=uid)
         except(TypeError, ValueError, OverflowError, User.DoesNotExist):
             user = None
         if user is not None and account_activation_token.check_token(user, token):
@@ -259,14 +413,126 @@ class UserViewSet(GenericViewSet, mixins.CreateModelMixin):
                 (Q(username__iexact=user.username) | Q(email__iexact=user.email)),
                 is_active=False
             )
-            currency_to_check = set()
-            for u in user_to_delete:
-                [currency_to_check.add(i.currency) for i in CurrencyOwner.objects.filter(owner=u)]
-                u.delete()
-            for cur in currency_to_check:
-                if not CurrencyOwner.objects.filter(currency=cur):
-                    cur.is_active = False
-                    cur.save()
+            currency_to_check = list(CurrencyOwner.objects.filter(owner__in=user_to_delete)
+                                     .values_list('currency', flat=True).distinct())
+            user_to_delete.delete()
+            Currency.objects.filter(id__in=currency_to_check)\
+                .exclude(id__in=CurrencyOwner.objects.values('currency')).update(is_active=False)
+
+
+class ProfileCaptureViewSet(viewsets.ViewSet):
+    permission_classes = [permissions.IsAdminUser, TokenHasReadWriteScope]
+    lookup_value_regex = CAPTURE_ID_RE
+
+    def read_capture(self, pk):
+        try:
+            with open(get_capture_path(pk, 'json')) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise exceptions.NotFound()
+
+    def list(self, request):
+        captures = []
+        for capture_id in list_captures():
+            try:
+                capture = self.read_capture(capture_id)
+            except exceptions.NotFound:
+                # removed by a concurrent request
+                continue
+            del capture['queries']
+            captures.append(capture)
+        return Response(captures)
+
+    @swagger_auto_schema(manual_parameters=[openapi.Parameter('file', openapi.IN_QUERY,
+                                                              description="prof - cProfile stats file, "
+                                                                          "sql - captured queries",
+                                                              type=openapi.TYPE_STRING)],
+                         responses={200: openapi.Response('Profile file',
+                                                          schema=openapi.Schema(type=openapi.TYPE_FILE))})
+    def retrieve(self, request, pk=None):
+        file = request.GET.get('file', 'prof')
+        if file == 'sql':
+            return Response(self.read_capture(pk))
+        if file != 'prof':
+            raise exceptions.ParseError(detail=f'unknown file: {file}')
+        try:
+            return FileResponse(open(get_capture_path(pk, 'prof'), 'rb'), as_attachment=True,
+                                filename=f'{pk}.prof')
+        except FileNotFoundError:
+            raise exceptions.NotFound()
+
+
+class SyncView(ShardMixin, APIView):
+    """
+    Debtors and transactions of the user changed after the ?since= cursor, in journal order.
+    Rows changed several times are returned once in their current state, deleted rows only by id;
+    the transactions of a deleted debtor are deleted with it.
+    The cursor names the shard of the journal, reset is true when it belongs to another shard
+    and the client then replaces its data.
+    """
+    permission_classes = [permissions.IsAuthenticated, TokenHasReadWriteScope]
+
+    def get_rows(self, serializer_class, queryset):
+        # sync rows are complete, ?fields= and ?omit= of the list endpoints do not apply
+        mapper = ValuesRowMapper.for_fields(serializer_class, serializer_class.Meta.fields)
+        return mapper.to_representation(mapper.get_values(queryset.order_by('id')))
+
+    @swagger_auto_schema(query_serializer=SyncQuerySerializer)
+    def get(self, request):
+        query = SyncQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        (cursor_shard, since), size = query.validated_data['since'], query.validated_data['size']
+        shard = current_shard.get() or DEFAULT_DB_ALIAS
+        if cursor_shard is None and len(settings.SHARD_DATABASES) == 1:
+            # plain journal ids, cursors of a single database
+            cursor_shard = shard
+        reset = since > 0 and cursor_shard != shard
+        if reset:
+            since = 0
+        entries = list(ChangeJournal.objects.filter(owner=request.user, id__gt=since).order_by('id')
+                       .values_list('id', 'model', 'object_id')[:size + 1])
+        has_more = len(entries) > size
+        entries = entries[:size]
+        changed = {'debtor': set(), 'transaction': set()}
+        for _, model, object_id in entries:
+            changed[model].add(object_id)
+        debtors = self.get_rows(DebtorSyncSerializer, Debtor.objects.filter(
+            owner=request.user, is_active=True, id__in=changed['debtor'])) if changed['debtor'] else []
+        transactions = self.get_rows(TransactionSyncSerializer, Transaction.objects.filter(
+            debtor__owner=request.user, is_active=True, id__in=changed['transaction'])) \
+            if changed['transaction'] else []
+        return Response({
+            'cursor': f'{shard}:{entries[-1][0] if entries else since}',
+            'has_more': has_more,
+            'reset': reset,
+            'debtors': debtors,
+            'transactions': transactions,
+            'deleted': {
+                'debtors': sorted(changed['debtor'] - {row['id'] for row in debtors}),
+                'transactions': sorted(changed['transaction'] - {row['id'] for row in transactions}),
+            },
+        })
+
+
+class BatchView(APIView):
+    """
+    Several API requests in one round trip, authenticated once. The body is an array of at most
+    BATCH_MAX_REQUESTS sub-requests, the response the array of their responses in the same order.
+    Sub-requests run in order, consecutive GET requests in parallel.
+    """
+    permission_classes = [permissions.IsAuthenticated, TokenHasReadWriteScope]
+
+    @swagger_auto_schema(request_body=BatchRequestSerializer(many=True),
+                         responses={200: BatchResponseSerializer(many=True)})
+    def post(self, request):
+        if not isinstance(request.data, list):
+            raise exceptions.ValidationError('Expected an array of requests.')
+        if len(request.data) > settings.BATCH_MAX_REQUESTS:
+            raise exceptions.ValidationError(f'At most {settings.BATCH_MAX_REQUESTS} requests are allowed.')
+        serialized = BatchRequestSerializer(data=request.data, many=True)
+        serialized.is_valid(raise_exception=True)
+        sub_requests = [(r['method'], r['path'], r['headers'], r['body']) for r in serialized.validated_data]
+        return Response(run_batch(request, sub_requests, exclude_view=BatchView))
 
 
 class RecaptchaAPIView(APIView):